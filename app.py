@@ -1,9 +1,34 @@
 from flask import Flask, render_template, request, session, redirect, url_for, jsonify
 from flask_socketio import SocketIO, join_room, leave_room, emit, disconnect
 import os
+import re
 import sys
+import threading
 from datetime import datetime
-from collections import defaultdict
+import logging
+import bus
+import chatcore
+import chatlog
+import dmstore
+import payloads
+import ratelimit
+import searchindex
+import store
+
+# Shared message bus for running several workers, e.g. unix:///tmp/dccn-chat-bus.sock
+# (start the broker with: python3 bus.py). Unset, this process keeps everything itself.
+MESSAGE_BUS = os.environ.get('CHAT_MESSAGE_BUS')
+# Messages survive restarts in this file ('' keeps them in memory only). With a
+# message bus the broker's store is used instead (python3 bus.py --store ...).
+STORE_PATH = os.environ.get('CHAT_STORE', bus.STORE_PATH)
+STORE_DURABILITY = os.environ.get('CHAT_DURABILITY', store.DEFAULT_DURABILITY)  # off, normal or full
+# Also serve CLI clients (client.py) on this TCP port, on the same chat core as the
+# browsers. Needs a single process: not together with CHAT_MESSAGE_BUS.
+TCP_PORT = int(os.environ.get('CHAT_TCP_PORT') or 0)
+# Messages the 'search' event can find, newest first (0 turns search off). The index
+# is per process, so it is off by default with a message bus: a worker only sees
+# the messages posted through it.
+SEARCH_MAX_DOCS = int(os.environ.get('CHAT_SEARCH_MAX_DOCS') or (0 if MESSAGE_BUS else searchindex.MAX_DOCS))
 
 # Determine the best async mode
 if sys.platform == 'win32':
@@ -12,23 +37,231 @@ else:
     try:
         import eventlet
         async_mode = 'eventlet'
+        if MESSAGE_BUS or TCP_PORT:
+            eventlet.monkey_patch()  # The bus client and the TCP frontend use plain sockets
     except ImportError:
         try:
             from gevent import monkey
             async_mode = 'gevent'
+            if MESSAGE_BUS or TCP_PORT:
+                monkey.patch_all()
         except ImportError:
             async_mode = 'threading'
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
-socketio = SocketIO(app, async_mode=async_mode)
 
-# Store connected users: {socket_id: {'username': str, 'rooms': set, 'sid': str}}
+# Presence and DM history shared by every worker on the bus
+message_store = store.MessageStore(STORE_PATH, STORE_DURABILITY) if STORE_PATH and not MESSAGE_BUS else None
+chat_bus, client_manager = bus.connect(MESSAGE_BUS, message_store)
+if client_manager is not None:
+    # Relay emits through the broker so rooms and DMs span all workers
+    socketio = SocketIO(app, async_mode=async_mode, client_manager=client_manager)
+else:
+    socketio = SocketIO(app, async_mode=async_mode)
+
+# Users, rooms and DMs live in the chat core; this module is its Socket.IO transport
+core = chatcore.ChatCore(chat_bus, search_index=searchindex.SearchIndex(SEARCH_MAX_DOCS) if SEARCH_MAX_DOCS else None)
+
+# Logging: level, format and sampling come from CHAT_LOG_* (see chatlog.py)
+log_listener = chatlog.setup()
+log = chatlog.get_logger('app')
+msg_log = chatlog.get_logger('messages')  # Hot path: DEBUG only, and sampled
+sample_messages = chatlog.Sampler(chatlog.sample_every())
+
+if core.search is not None and message_store is not None:
+    # Messages from before a restart; anything sent from here on is added live
+    searchindex.load_in_background(core.search, message_store, on_done=lambda count: chatlog.event(
+        log, logging.INFO, "search index loaded", messages=count))
+
+# Store users connected to this worker: {socket_id: {'username': str, 'rooms': set, 'sid': str, 'user': WebUser}}
 users = {}
-# Store user socket mappings: {username: socket_id}
-user_sockets = {}
-# Store private messages: {(user1, user2): [messages]}
-private_messages = defaultdict(list)
+
+# Rooms besides 'general' are made by joining them and go away with their last member
+ROOM_NAME = re.compile(r'[a-z0-9][a-z0-9_-]{0,31}')
+MAX_ROOMS = 20  # Rooms one connection may be in, 'general' included
+
+def room_name(name):
+    """Normalized room name, or None if it is not a valid one."""
+    if not isinstance(name, str):
+        return None
+    name = name.strip().lower().lstrip('#')
+    return name if ROOM_NAME.fullmatch(name) else None
+
+# Presence changes are sent as versioned deltas, batched once per tick
+PRESENCE_TICK = 0.25  # Seconds
+
+class PresenceBatcher:
+    """Collects user_added/user_removed changes and emits them in one
+    'presence_delta' per room and tick instead of a full user list per
+    join/leave.
+
+    Each change carries the room's presence version; clients apply them
+    in version order and ask for a snapshot ('get_presence') on a gap.
+    """
+
+    def __init__(self, tick=PRESENCE_TICK):
+        self.tick = tick
+        self.pending = {}  # {room: [[version, 'user_added' | 'user_removed', username], ...]}
+        self._started = False
+        self._lock = threading.Lock()  # Guards pending and _started
+
+    def add(self, room, version, change, username):
+        with self._lock:
+            self.pending.setdefault(room, []).append([version, change, username])
+            start, self._started = not self._started, True  # Only one add() starts the loop
+        if start:
+            socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.tick)
+            # Swap under the lock, so no change lands in the dict being sent;
+            # changes added meanwhile go out next tick
+            with self._lock:
+                pending, self.pending = self.pending, {}
+            for room, changes in pending.items():
+                changes.sort()
+                emit_room('presence_delta', {'room': room, 'changes': changes}, room)
+
+presence = PresenceBatcher()
+
+# Rate limits for send_message, as messages per second/burst or 'off' (see ratelimit.py)
+limiter = ratelimit.RateLimiter(
+    ratelimit.parse_limit(os.environ.get('CHAT_RATE_LIMIT_USER', '10/20')),
+    ratelimit.parse_limit(os.environ.get('CHAT_RATE_LIMIT_IP', 'off')),
+    ratelimit.parse_limit(os.environ.get('CHAT_RATE_LIMIT_GLOBAL', 'off')))
+
+def client_ip():
+    if request.headers.get('X-Forwarded-For'):
+        return request.headers.get('X-Forwarded-For').split(',')[0]  # For when behind a proxy
+    return request.remote_addr
+
+# Browsers may ask for short keys and deflated history replies when they connect (see
+# payloads.py); CHAT_COMPACT=off sends every client the plain JSON events.
+COMPACT_PAYLOADS = os.environ.get('CHAT_COMPACT', 'on').lower() != 'off'
+DEFLATE_MIN = int(os.environ.get('CHAT_DEFLATE_MIN') or payloads.DEFLATE_MIN)  # Bytes
+COMPACT_ROOM = 'c:'  # Compact clients are in 'c:<room>' rather than '<room>'
+
+def wire_room(room):
+    """The Socket.IO room this connection uses for a chat room or inbox."""
+    state = users.get(request.sid)
+    return COMPACT_ROOM + room if state and state.get('compact') else room
+
+def emit_room(event, data, room):
+    """Emit to everyone in a room, each in the encoding they asked for.
+
+    Each encoding is serialized once for all of its members; without
+    COMPACT_PAYLOADS nobody is in the compact room and it is skipped.
+    """
+    socketio.emit(event, data, room=room)
+    if COMPACT_PAYLOADS:
+        socketio.emit(event, payloads.compact(data), room=COMPACT_ROOM + room)
+
+def pack(data, deflate=True):
+    """A payload for this connection alone: compacted and deflated as it asked."""
+    state = users.get(request.sid) or {}
+    if state.get('compact'):
+        data = payloads.compact(data)
+    if deflate and state.get('deflate'):
+        data = payloads.deflate(data, DEFLATE_MIN)
+    return data
+
+# Optional batching of public messages: collect them for up to CHAT_BATCH_WINDOW_MS
+# (or CHAT_BATCH_MAX messages) and emit one 'new_messages' list. 0 sends each at once.
+BATCH_WINDOW = float(os.environ.get('CHAT_BATCH_WINDOW_MS') or 0) / 1000
+BATCH_MAX = int(os.environ.get('CHAT_BATCH_MAX') or 100)
+
+class MessageBatcher:
+    """Emits public messages to their rooms in batches.
+
+    A room's first message of a batch starts a timer for `window`
+    seconds; the batch goes out when it fires or once it holds max_size
+    messages, as one 'new_messages' event: one packet per member instead
+    of one per message. benchmarks/bench_batching.py shows the trade-off.
+    """
+
+    def __init__(self, window=BATCH_WINDOW, max_size=BATCH_MAX):
+        self.window = window
+        self.max_size = max_size
+        self.pending = {}  # {room: [message, ...]}
+        self._lock = threading.Lock()
+
+    def add(self, room, message):
+        with self._lock:
+            batch = self.pending.setdefault(room, [])
+            batch.append(message)
+            count = len(batch)
+        if count == 1:
+            socketio.start_background_task(self._flush_later, room)
+        elif count >= self.max_size:
+            self.flush(room)
+
+    def _flush_later(self, room):
+        socketio.sleep(self.window)
+        self.flush(room)
+
+    def flush(self, room):
+        with self._lock:
+            messages = self.pending.pop(room, None)
+        if messages:
+            emit_room('new_messages', {'room': room, 'messages': messages}, room)
+
+message_batcher = MessageBatcher() if BATCH_WINDOW > 0 else None
+
+class WebUser:
+    """A browser user in the chat core, shared by all of their tabs."""
+    __slots__ = ('sock', 'name', 'addr', 'transport', 'member_id', 'tabs')
+
+    def __init__(self, name, ip):
+        self.sock = 'web:' + name  # Registry key
+        self.name = name
+        self.addr = (ip, 0)
+        self.transport = web
+        self.member_id = None
+        self.tabs = set()  # Socket.IO sids
+
+class WebTransport(chatcore.Transport):
+    """Shows the core's events to browsers.
+
+    Members of a room are in its Socket.IO room, so one emit_room()
+    reaches all of them however many sessions the core passes in.
+    """
+    name = 'web'
+
+    def deliver(self, event, sessions, exclude=None):
+        room = event.room
+        if event.kind == chatcore.MESSAGE:
+            if message_batcher is not None:
+                message_batcher.add(room, event.data)
+            else:
+                emit_room('new_message', event.data, room)
+            return
+        joined = event.kind == chatcore.JOINED
+        presence.add(room, event.version, 'user_added' if joined else 'user_removed', event.sender)
+        if not event.quiet:
+            verb = 'joined' if joined else 'left'
+            emit_room('user_' + verb,
+                      {'room': room, 'username': event.sender, 'message': f'{event.sender} has {verb} #{room}'},
+                      room)
+
+    def deliver_dm(self, event, session, echo):
+        # Every tab of the user gets it, in order with the rest of their inbox
+        message = {'id': event.data['id'], 'from': event.sender, 'message': event.text,
+                   'timestamp': event.timestamp, 'is_private': True}
+        if echo:
+            message['to'] = event.to
+        emit_room('private_message', chat_bus.sequence(inbox(session.name), 'private_message', message),
+                  inbox(session.name))
+
+    def notify(self, session, text, error=False):
+        emit_room('server_notice', {'message': text, 'error': error}, inbox(session.name))
+
+    def disconnect(self, session, kicked=False):
+        for sid in list(session.tabs):
+            socketio.server.disconnect(sid, namespace='/')
+
+web = WebTransport()
 
 @app.route('/')
 def index():
@@ -38,32 +271,15 @@ def index():
 
 @app.route('/login', methods=['POST'])
 def login():
-    print("\n=== DEBUG: Login route hit ===")
-    print(f"Form data: {request.form}")
-    
     username = request.form.get('username')
-    print(f"DEBUG: Username from form: {username}")
-    
     if not username:
-        print("DEBUG: No username provided, redirecting to index")
+        log.debug("login without username")
         return redirect(url_for('index'))
     
-    # Get the client's IP address
-    if request.headers.get('X-Forwarded-For'):
-        ip = request.headers.get('X-Forwarded-For').split(',')[0]  # For when behind a proxy
-    else:
-        ip = request.remote_addr
-    
-    print("\n" + "="*50)
-    print(f"🔔 NEW LOGIN DETECTED")
-    print(f"👤 Username: {username}")
-    print(f"🌐 IP Address: {ip}")
-    print(f"🕒 Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    print(f"📱 User Agent: {request.user_agent}")
-    print("="*50 + "\n")
+    chatlog.event(log, logging.INFO, "login", user=username, ip=client_ip(),
+                  agent=request.headers.get('User-Agent', ''))
     
     session['username'] = username
-    print(f"DEBUG: Session set for user: {session.get('username')}")
     return redirect(url_for('chat'))
 
 @app.route('/api/online_users')
@@ -71,9 +287,9 @@ def get_online_users():
     if 'username' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    online_users = [{'username': user_data['username']} 
-                   for user_data in users.values() 
-                   if user_data['username'] != session['username']]
+    online_users = [{'username': username}
+                    for username in chat_bus.usernames()
+                    if username != session['username']]
     
     return jsonify({'users': online_users})
 
@@ -81,7 +297,7 @@ def get_online_users():
 def chat():
     if 'username' not in session:
         return redirect(url_for('index'))
-    return render_template('chat.html', username=session['username'])
+    return render_template('chat.html', username=session['username'], compact_keys=payloads.COMPACT_KEYS)
 
 @app.route('/logout')
 def logout():
@@ -89,96 +305,173 @@ def logout():
     return redirect(url_for('index'))
 
 @socketio.on('connect')
-def handle_connect():
+def handle_connect(auth=None):
     if 'username' in session:
         username = session['username']
+        user = core.registry.find(username, exact=True)
+        if user is None:
+            user = WebUser(username, client_ip())
+            if not core.connect(user):
+                user = core.registry.find(username, exact=True)  # Another tab got there first
+        if user is None or user.transport is not web:
+            chatlog.event(log, logging.WARNING, "connect refused", user=username,
+                          reason='kicked' if core.registry.is_kicked(username) else 'name taken')
+            return False
+        user.tabs.add(request.sid)
+        options = auth if isinstance(auth, dict) and COMPACT_PAYLOADS else {}
         users[request.sid] = {
             'username': username,
-            'rooms': {'general'},
-            'sid': request.sid
+            'rooms': set(),
+            'sid': request.sid,
+            'user': user,
+            'compact': bool(options.get('compact')),  # Payload encoding, see payloads.py
+            'deflate': bool(options.get('deflate'))
         }
-        user_sockets[username] = request.sid
-        join_room('general')
-        emit('user_joined', 
-             {'username': username, 'message': f'{username} has joined the chat'}, 
-             room='general')
-        emit('update_users', 
-             {'users': [u['username'] for u in users.values()]}, 
-             room='general')
+        join_room(wire_room(inbox(username)))  # DMs reach every tab the user has open
+        enter_room(bus.GENERAL)
+
+def inbox(username):
+    """Room (and sequence) for a user's private messages."""
+    return 'user:' + username
+
+def enter_room(room, create=True):
+    """Add this connection to a room. Returns False if the room does not exist."""
+    join_room(wire_room(room))  # Before the core announces us, so this tab sees it too
+    if core.enter(users[request.sid]['user'], room, request.sid, create) is None:
+        leave_room(wire_room(room))
+        return False
+    users[request.sid]['rooms'].add(room)
+    handle_get_presence({'room': room})
+    return True
+
+@socketio.on('join_room')
+def handle_join_room(data):
+    """Join a room, creating it unless data['create'] is false.
+
+    The reply carries the room's newest events (its replay window) and
+    last seq, so the client can show recent history and resume from it.
+    """
+    if 'username' not in session or request.sid not in users or not isinstance(data, dict):
+        return {'status': 'error', 'message': 'Not authenticated'}
+    room = room_name(data.get('room'))
+    if room is None:
+        return {'status': 'error', 'message': 'Room names are 1-32 letters, digits, - or _'}
+    rooms = users[request.sid]['rooms']
+    if room not in rooms and len(rooms) >= MAX_ROOMS:
+        return {'status': 'error', 'message': f'You can be in at most {MAX_ROOMS} rooms'}
+    if not enter_room(room, data.get('create', True) is not False):
+        return {'status': 'error', 'message': f'No room named #{room}'}
+    events, _, last = chat_bus.replay(room, 0)
+    return pack({'status': 'joined', 'room': room, 'events': events, 'last': last})
+
+@socketio.on('leave_room')
+def handle_leave_room(data):
+    if 'username' not in session or request.sid not in users or not isinstance(data, dict):
+        return {'status': 'error', 'message': 'Not authenticated'}
+    room = room_name(data.get('room'))
+    if room is None or room not in users[request.sid]['rooms']:
+        return {'status': 'error', 'message': 'Not in that room'}
+    if room == bus.GENERAL:
+        return {'status': 'error', 'message': f'#{bus.GENERAL} cannot be left'}
+    leave_room(wire_room(room))
+    users[request.sid]['rooms'].discard(room)
+    core.exit(users[request.sid]['user'], room, request.sid)
+    return {'status': 'left', 'room': room}
+
+@socketio.on('list_rooms')
+def handle_list_rooms(data=None):
+    """Every room with its member count: {'rooms': [[room, members], ...]}."""
+    if 'username' not in session:
+        return {'rooms': []}
+    return {'rooms': chat_bus.rooms()}
+
+@socketio.on('resume')
+def handle_resume(data):
+    """Catch a (re)connecting client up on what it missed.
+
+    data is {'rooms': {room: seq}, 'inbox': seq} with the last seq the
+    client saw in each room it was in and in its DM inbox (null on first
+    load); rooms other than 'general' are joined again first. Each room
+    replies with the missed events, whether that covers the whole gap
+    (otherwise it is the newest window and the client resyncs from it),
+    and the room's last seq: {'rooms': [[room, {...}], ...], 'inbox': {...}}.
+    """
+    if 'username' not in session or request.sid not in users or not isinstance(data, dict):
+        return {}
+    wanted = data.get('rooms') if isinstance(data.get('rooms'), dict) else {}
+    reply = {'rooms': []}
+    for name, seq in list(wanted.items())[:MAX_ROOMS]:
+        room = room_name(name)
+        if room is None or room not in users[request.sid]['rooms'] and not enter_room(room):
+            continue
+        events, complete, last = chat_bus.replay(room, seq if isinstance(seq, int) else None)
+        reply['rooms'].append([room, {'events': events, 'complete': complete, 'last': last}])
+    seq = data.get('inbox')
+    events, complete, last = chat_bus.replay(inbox(session['username']), seq if isinstance(seq, int) else None)
+    reply['inbox'] = {'events': events, 'complete': complete, 'last': last}
+    return pack(reply)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     if request.sid in users:
-        user_data = users[request.sid]
-        username = user_data['username']
-        
-        # Remove user from tracking
-        users.pop(request.sid, None)
-        user_sockets.pop(username, None)
-        
-        # Notify others
-        emit('user_left', 
-             {'username': username, 'message': f'{username} has left the chat'}, 
-             room='general')
-        emit('update_users', 
-             {'users': [u['username'] for u in users.values()]}, 
-             room='general')
+        # Remove user from tracking; the core announces it once their last tab has left
+        user = users.pop(request.sid)['user']
+        core.leave(user, request.sid, quiet=core.registry.is_kicked(user.name))
+        user.tabs.discard(request.sid)
+        if not user.tabs:
+            core.disconnect(user)
+
+@socketio.on('get_presence')
+def handle_get_presence(data=None):
+    """A room's user list, sent on joining it and when a client sees a version gap."""
+    room = data.get('room', bus.GENERAL) if isinstance(data, dict) else bus.GENERAL
+    if request.sid not in users or room not in users[request.sid]['rooms']:
+        return
+    version, online = chat_bus.snapshot(room)
+    emit('presence_snapshot', pack({'room': room, 'version': version, 'users': online}, deflate=False), room=request.sid)
 
 @socketio.on('send_message')
 def handle_send_message(data):
-    print("\n=== NEW MESSAGE RECEIVED ===")
-    print(f"Session data: {dict(session)}")
-    print(f"Message data: {data}")
-    
     if 'username' not in session:
-        print("No username in session, ignoring message")
+        chatlog.event(log, logging.WARNING, "message rejected", reason="not authenticated", sid=request.sid)
         return {'status': 'error', 'message': 'Not authenticated'}
     
     username = session['username']
     message = data.get('message', '').strip()
     recipient = data.get('recipient')  # None for public messages
+    room = data.get('room') or bus.GENERAL
     timestamp = data.get('timestamp') or datetime.now().strftime('%H:%M:%S')
     
     if not message:
-        print("Empty message, ignoring")
         return {'status': 'error', 'message': 'Message cannot be empty'}
+    if request.sid not in users:
+        return {'status': 'error', 'message': 'Not connected'}
+    if not recipient and room not in users[request.sid]['rooms']:
+        return {'status': 'error', 'message': 'Join the room first'}
+    if core.is_suspended(username):
+        return {'status': 'error', 'message': 'You are suspended and cannot send messages'}
     
-    message_data = {
-        'sender': username,
-        'message': message,
-        'timestamp': timestamp,
-        'is_private': bool(recipient)
-    }
+    throttle = limiter.check(username, client_ip())
+    if throttle is not None:
+        scope, wait = throttle
+        user_state = users.get(request.sid)
+        if user_state is not None and not user_state.get('throttled'):
+            # Once per burst of refused messages, not for every one
+            user_state['throttled'] = True
+            chatlog.event(log, logging.WARNING, "throttled", user=username, scope=scope)
+        return {'status': 'throttled', 'scope': scope, 'retry_after': round(wait, 2),
+                'message': f'You are sending too fast; try again in {wait:.1f}s'}
+    users[request.sid]['throttled'] = False
+    user = users[request.sid]['user']
     
-    print(f"Processing message: {message_data}")
+    # No formatting at all unless DEBUG is on, and then only 1 in CHAT_LOG_SAMPLE
+    if msg_log.isEnabledFor(logging.DEBUG) and sample_messages():
+        chatlog.event(msg_log, logging.DEBUG, "message", sender=username,
+                      recipient=recipient, length=len(message))
     
     if recipient:
-        # Private message
-        print(f"Processing private message to {recipient}")
-        if recipient in user_sockets:
-            # Store message in the conversation history
-            key = tuple(sorted([username, recipient]))
-            private_messages.setdefault(key, []).append(message_data)
-            
-            # Send to recipient
-            print(f"Sending private message to {recipient} (socket: {user_sockets[recipient]})")
-            emit('private_message', {
-                'from': username,
-                'message': message,
-                'timestamp': timestamp,
-                'is_private': True
-            }, room=user_sockets[recipient])
-            
-            # Send confirmation to sender
-            print(f"Sending confirmation to sender {username}")
-            emit('private_message', {
-                'from': username,
-                'to': recipient,
-                'message': message,
-                'timestamp': timestamp,
-                'is_private': True
-            }, room=request.sid)
-            
+        # Private message: stored, then sent to the recipient and echoed to every tab of the sender
+        if core.send_dm(user, recipient, message, timestamp) is not None:
             return {
                 'status': 'delivered',
                 'is_private': True,
@@ -187,19 +480,10 @@ def handle_send_message(data):
                 'timestamp': timestamp
             }
         else:
-            print(f"Recipient {recipient} not found in user_sockets")
             return {'status': 'error', 'message': 'Recipient not found'}
     else:
-        # Public message
-        print(f"Broadcasting public message to room 'general'")
-        emit('new_message', {
-            'username': username,
-            'message': message,
-            'timestamp': timestamp,
-            'is_private': False
-        }, room='general')
-        
-        print("Message broadcasted successfully")
+        # Public message, to the room's members on every frontend
+        core.post(user, room, message, timestamp)
         return {'status': 'broadcasted', 'timestamp': timestamp}
 
 @socketio.on('get_private_messages')
@@ -211,35 +495,63 @@ def handle_get_private_messages(data):
     if not other_user:
         return
     
+    # Newest page by default; 'before' (a message id) pages further back
+    try:
+        before = data.get('before')
+        before = int(before) if before is not None else None
+        limit = int(data.get('limit') or dmstore.DEFAULT_PAGE)
+    except (TypeError, ValueError):
+        return
+    
     username = session['username']
-    key = tuple(sorted([username, other_user]))
-    messages = private_messages.get(key, [])
+    messages, has_more = chat_bus.dm_history(username, other_user, before, limit)
     
-    emit('private_messages', {
+    emit('private_messages', pack({
         'with_user': other_user,
-        'messages': messages
-    })
+        'messages': messages,
+        'before': before,
+        'has_more': has_more
+    }))
 
-@socketio.on('disconnect')
-def handle_disconnect():
-    if request.sid in users:
-        username = users[request.sid]
-        del users[request.sid]
-        leave_room('general')
-        emit('user_left', {'username': username, 'message': f'{username} has left the chat'}, room='general')
-        emit('update_users', list(users.values()), room='general')
+@socketio.on('search')
+def handle_search(data):
+    """Full-text search over the messages this user can see, newest first.
 
-@socketio.on('send_message')
-def handle_send_message(data):
-    if 'username' in session:
-        message = data.get('message', '').strip()
-        if message:
-            timestamp = datetime.now().strftime('%I:%M %p')
-            emit('new_message', {
-                'username': session['username'],
-                'message': message,
-                'timestamp': timestamp
-            }, room='general')
+    data: {'query': words, 'sender', 'room', 'since', 'until' (Unix times),
+    'before', 'limit'}. Answered with a 'search_results' page; pass the
+    last result's id as 'before' for the next one.
+    """
+    if 'username' not in session or request.sid not in users:
+        return {'status': 'error', 'message': 'Not connected'}
+    if not isinstance(data, dict):
+        return {'status': 'error', 'message': 'Invalid search'}
+    if core.search is None:
+        return {'status': 'error', 'message': 'Search is turned off on this server'}
+    query = data.get('query') or ''
+    room = room_name(data['room']) if data.get('room') else None
+    if data.get('room') and room is None:
+        return {'status': 'error', 'message': 'Invalid room name'}
+    try:
+        since, until, before = (data.get(key) for key in ('since', 'until', 'before'))
+        messages, has_more = core.search.search(
+            session['username'], str(query),
+            sender=str(data['sender']) if data.get('sender') else None,
+            room=room,
+            since=float(since) if since is not None else None,
+            until=float(until) if until is not None else None,
+            before=int(before) if before is not None else None,
+            limit=int(data.get('limit') or searchindex.DEFAULT_PAGE))
+    except (TypeError, ValueError):
+        return {'status': 'error', 'message': 'Invalid search'}
+    except searchindex.SearchError as e:
+        return {'status': 'error', 'message': str(e)}
+    emit('search_results', pack({
+        'query': query,
+        'messages': messages,
+        'before': before,
+        'has_more': has_more
+    }))
+    return {'status': 'ok'}
 
 def find_available_port(start_port=3000, max_attempts=10):
     """Find an available port starting from start_port"""
@@ -285,6 +597,15 @@ if __name__ == '__main__':
     print(f"2. Open a web browser and go to: http://{local_ip}:{port}")
     print("\n💡 Tip: If you can't connect, check your firewall settings")
     print("      or try temporarily disabling it for testing")
+    if TCP_PORT and MESSAGE_BUS:
+        print("\n⚠️  CHAT_TCP_PORT is ignored with CHAT_MESSAGE_BUS (the bridge needs one process)")
+    elif TCP_PORT:
+        import history
+        import server
+        # CLI clients share the core: rooms, DMs, names and moderation span both frontends
+        core.history = history.ChatHistory(store=message_store)
+        server.serve(core, '0.0.0.0', TCP_PORT)
+        print(f"\n💻 CLI clients:     python3 client.py {local_ip} {TCP_PORT}")
     print("\n🛑 Press Ctrl+C to stop the server")
     print("="*60 + "\n")
     
@@ -294,7 +615,7 @@ if __name__ == '__main__':
         socketio.run(app, 
                    host='0.0.0.0', 
                    port=port, 
-                   debug=True,
+                   debug=log.isEnabledFor(logging.DEBUG),
                    allow_unsafe_werkzeug=True,
                    use_reloader=False)
     except Exception as e:
@@ -305,3 +626,9 @@ if __name__ == '__main__':
         print(f"3. Try temporarily disabling your firewall: sudo ufw disable")
         print("\nError details:", str(e))
         print("!"*60 + "\n")
+    finally:
+        if TCP_PORT and not MESSAGE_BUS:
+            server.shutdown_flag.set()
+        if message_store is not None:
+            message_store.close()
+        log_listener.stop()
@@ -0,0 +1,172 @@
+# benchmarks/bench_batching.py
+"""Throughput gained and latency added by app.py's message batching.
+
+Replays the web chat's fan-out without Flask: every emit to 'general'
+is encoded once as a Socket.IO text packet ('42["event", data]') and
+written as one length-prefixed frame to each member's socket, like the
+WebSocket frame the real server sends. A reader thread drains every
+socket and timestamps what arrives on one of them.
+
+Messages arrive at a fixed rate; with a window, they are collected the
+way MessageBatcher does (first message starts the timer, BATCH_MAX caps
+the size) and sent as one 'new_messages' event. Reported per setting:
+sender CPU per message, the rate that CPU budget would sustain, and
+end-to-end latency as seen by a member.
+
+Run from the project root:
+    python3 benchmarks/bench_batching.py
+    python3 benchmarks/bench_batching.py --rate 5000 --members 100 500
+"""
+import argparse
+import json
+import selectors
+import socket
+import struct
+import threading
+import time
+
+MEMBER_COUNTS = (10, 100, 500)
+WINDOWS_MS = (0, 10, 25, 50)
+RATE = 1000  # Messages per second offered to the room
+DURATION = 2.0  # Seconds per setting
+BATCH_MAX = 100
+MESSAGE = "hello @everyone, this is a typical chat line with a bit of text in it"
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, max(0, int(p * len(ordered) + 0.5) - 1))]
+
+def encode(event, data):
+    packet = ('42' + json.dumps([event, data], separators=(',', ':'))).encode('utf-8')
+    return struct.pack('!I', len(packet)) + packet
+
+class Room:
+    """Socket pairs for every member plus a thread that drains them."""
+
+    def __init__(self, members):
+        self.pairs = [socket.socketpair() for _ in range(members)]
+        for writer, reader in self.pairs:
+            reader.setblocking(False)
+        self.latencies = []  # Seconds from creation to arrival, member 0 only
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def send(self, frame):
+        for writer, _ in self.pairs:
+            writer.sendall(frame)
+
+    def _drain(self):
+        sel = selectors.DefaultSelector()
+        for i, (_, reader) in enumerate(self.pairs):
+            sel.register(reader, selectors.EVENT_READ, i)
+        buffer = b''
+        while not self._stop.is_set():
+            for key, _ in sel.select(0.05):
+                try:
+                    data = key.fileobj.recv(1 << 20)
+                except BlockingIOError:
+                    continue
+                if key.data != 0:
+                    continue
+                # Parse member 0's frames to time each message
+                now = time.perf_counter()
+                buffer += data
+                while len(buffer) >= 4:
+                    size = struct.unpack('!I', buffer[:4])[0]
+                    if len(buffer) < 4 + size:
+                        break
+                    event, payload = json.loads(buffer[6:4 + size])
+                    buffer = buffer[4 + size:]
+                    messages = payload['messages'] if event == 'new_messages' else [payload]
+                    self.latencies.extend(now - m['t'] for m in messages)
+        sel.close()
+
+    def close(self, expected):
+        deadline = time.time() + 10
+        while len(self.latencies) < expected and time.time() < deadline:
+            time.sleep(0.01)
+        self._stop.set()
+        self._thread.join()
+        for writer, reader in self.pairs:
+            writer.close()
+            reader.close()
+
+def run(members, window, rate, duration):
+    room = Room(members)
+    count = int(rate * duration)
+    interval = 1.0 / rate
+    pending, deadline = [], None
+    cpu = 0.0
+    emits = 0
+
+    def flush():
+        nonlocal pending, deadline, cpu, emits
+        start = time.thread_time()
+        room.send(encode('new_messages', {'messages': pending}))
+        cpu += time.thread_time() - start
+        pending, deadline = [], None
+        emits += 1
+
+    begin = time.perf_counter()
+    for i in range(count):
+        due = begin + i * interval
+        # Sleep until the next message, sending a batch whose window closes first
+        while True:
+            now = time.perf_counter()
+            if deadline is not None and deadline <= min(now, due):
+                flush()
+                continue
+            if now >= due:
+                break
+            time.sleep(min(due, deadline or due) - now)
+        message = {'username': 'bench', 'message': MESSAGE, 'timestamp': '12:00:00', 'seq': i,
+                   't': time.perf_counter()}
+        if window == 0:
+            start = time.thread_time()
+            room.send(encode('new_message', message))
+            cpu += time.thread_time() - start
+            emits += 1
+            continue
+        start = time.thread_time()
+        pending.append(message)
+        cpu += time.thread_time() - start
+        if deadline is None:
+            deadline = time.perf_counter() + window
+        if len(pending) >= BATCH_MAX:
+            flush()
+    if pending:
+        time.sleep(max(0.0, deadline - time.perf_counter()))
+        flush()
+    elapsed = time.perf_counter() - begin
+    room.close(count)
+    return count, emits, cpu, elapsed, room.latencies
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark batching public messages into new_messages events")
+    parser.add_argument('--rate', type=float, default=RATE, help="messages per second (default: %(default)s)")
+    parser.add_argument('--duration', type=float, default=DURATION, help="seconds per setting (default: %(default)s)")
+    parser.add_argument('--members', type=int, nargs='+', default=MEMBER_COUNTS, help="room sizes")
+    parser.add_argument('--windows', type=float, nargs='+', default=WINDOWS_MS, help="batch windows in ms (0 = off)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    print(f"{args.rate:.0f} messages/s for {args.duration:.1f}s per setting, batches capped at {BATCH_MAX}")
+    print(f"{'members':>8} {'window':>7} {'batch':>6} {'cpu/msg':>9} {'max msg/s':>10} "
+          f"{'lag':>6} {'p50 ms':>7} {'p99 ms':>7}")
+    for members in args.members:
+        baseline = None
+        for window_ms in args.windows:
+            count, emits, cpu, elapsed, latencies = run(members, window_ms / 1000, args.rate, args.duration)
+            per_message = cpu / count
+            if baseline is None:
+                baseline = per_message
+            latencies.sort()
+            p50, p99 = percentile(latencies, 0.50), percentile(latencies, 0.99)
+            # lag > 1.0 means the sender could not keep up with the offered rate
+            print(f"{members:>8} {window_ms:>5.0f}ms {count / emits:>6.1f} {per_message * 1e6:>7.1f}us "
+                  f"{1 / per_message:>10.0f} {elapsed / args.duration:>6.2f} "
+                  f"{p50 * 1e3:>7.2f} {p99 * 1e3:>7.2f}   ({baseline / per_message:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# benchmarks/bench_broadcast.py
+"""Per-recipient cost of server.fan_out() for 10, 1k and 10k clients.
+
+Compares encoding the payload once per recipient (the old behaviour)
+against the shared encode-once payload, and per-message send() against
+one vectored sendmsg() for a backlog of queued payloads.
+
+Run from the project root:
+    python3 benchmarks/bench_broadcast.py
+"""
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chatcore
+import outbound
+import protocol
+import server
+
+CLIENT_COUNTS = (10, 1_000, 10_000)
+MESSAGE = "hello @everyone, this is a typical chat line with a bit of text in it"
+
+class FakeSocket:
+    """Stands in for a client socket; fan_out() only queues, never sends."""
+    __slots__ = ()
+
+def setup_clients(count):
+    server.core = chatcore.ChatCore()
+    server.registry = server.core.registry
+    for i in range(count):
+        sock = FakeSocket()
+        # Large enough that no round below hits the slow consumer policy
+        queue = outbound.OutboundQueue(sock, maxlen=1 << 20)
+        session = server.ClientState(sock, None, f"user{i}", protocol.LineDecoder(64), queue)
+        server.core.connect(session)
+        server.core.enter(session, quiet=True)
+
+def drain_queues():
+    for session in server.registry.members:
+        session.queue._items.clear()
+
+def room():
+    return server.core.members(chatcore.GENERAL, server.tcp)
+
+def encode_per_recipient(message, sender_name):
+    """The old fan-out loop: format once, encode for every recipient."""
+    timestamp = server.get_timestamp()
+    formatted_message = f"[{timestamp}] {sender_name}: {message.strip()}"
+    for session in room():
+        session.queue.put(f"{formatted_message}\n".encode('utf-8'))
+
+def encode_once(message, sender_name):
+    server.fan_out(f"[{server.get_timestamp()}] {sender_name}: {message.strip()}", room())
+
+def time_fanout(fanout, count, rounds):
+    drain_queues()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fanout(MESSAGE, "bench")
+    elapsed = time.perf_counter() - start
+    drain_queues()
+    return elapsed / (rounds * count) * 1e9
+
+def bench_fanout():
+    print("Fan-out cost per recipient (ns)")
+    print(f"{'clients':>8} {'encode each':>12} {'encode once':>12} {'speedup':>8}")
+    for count in CLIENT_COUNTS:
+        setup_clients(count)
+        rounds = max(5, 200_000 // count)
+        # Warm up, then take the best of three to smooth out noise
+        time_fanout(encode_once, count, 1)
+        per_each = min(time_fanout(encode_per_recipient, count, rounds) for _ in range(3))
+        per_once = min(time_fanout(encode_once, count, rounds) for _ in range(3))
+        print(f"{count:>8} {per_each:>12.0f} {per_once:>12.0f} {per_each / per_once:>7.2f}x")
+
+def drain(sock, total):
+    received = 0
+    while received < total:
+        received += len(sock.recv(1 << 20))
+
+def bench_vectored(backlog=outbound.SENDMSG_BATCH, batches=2_000):
+    payload = f"[12:00:00 PM] bench: {MESSAGE}\n".encode('utf-8')
+    writer, reader = socket.socketpair()
+    total = len(payload) * backlog
+
+    start = time.perf_counter()
+    for _ in range(batches):
+        for _ in range(backlog):
+            writer.sendall(payload)
+        drain(reader, total)
+    per_send = (time.perf_counter() - start) / (batches * backlog) * 1e9
+
+    if not outbound.HAS_SENDMSG:
+        print(f"\nsendmsg() not available; send() costs {per_send:.0f} ns per payload")
+        return
+    buffers = [payload] * backlog
+    start = time.perf_counter()
+    for _ in range(batches):
+        sent = writer.sendmsg(buffers)
+        assert sent == total
+        drain(reader, total)
+    per_sendmsg = (time.perf_counter() - start) / (batches * backlog) * 1e9
+
+    print(f"\nWriting a backlog of {backlog} payloads ({len(payload)} bytes each), ns per payload")
+    print(f"  send() each:      {per_send:>8.0f}")
+    print(f"  one sendmsg():    {per_sendmsg:>8.0f}  ({per_send / per_sendmsg:.2f}x)")
+    writer.close()
+    reader.close()
+
+if __name__ == "__main__":
+    bench_fanout()
+    bench_vectored()
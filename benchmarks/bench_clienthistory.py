@@ -0,0 +1,79 @@
+# benchmarks/bench_clienthistory.py
+"""Cost of client.py's local history (clienthistory.py) as it grows.
+
+Fills a scratch history file with chat lines, then times what the
+client does with it: append() on the reader thread, the writer
+committing in the background, /history and /find for rare and common
+words, with the FTS5 index and with the LIKE scan used without it.
+
+Run from the project root:
+    python3 benchmarks/bench_clienthistory.py
+    python3 benchmarks/bench_clienthistory.py --lines 500000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clienthistory
+
+LINES = 300_000
+ROUNDS = 20
+WORDS = ("hello world chat routing lecture notes python socket thread message queue latency "
+         "the a of to and is in it").split()
+UNIQUE_EVERY = 1000  # Every so many lines carries a word of its own
+
+def timed(function, rounds=ROUNDS):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = function()
+    return (time.perf_counter() - start) / rounds, len(result)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the CLI client's local history")
+    parser.add_argument('--lines', type=int, default=LINES, help="lines in the history (default: %(default)s)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as directory:
+        history = clienthistory.ClientHistory(os.path.join(directory, 'bench.db'), 'localhost:5000')
+        print(f"{args.lines} lines, FTS5 index: {'yes' if history.indexed else 'no'}")
+        lines = [f"\033[90m[12:00:00 PM]\033[0m user{i % 50}: " + ' '.join(random.choices(WORDS, k=10))
+                 + (f" unique{i}" if i % UNIQUE_EVERY == 0 else "") for i in range(args.lines)]
+        start = time.perf_counter()
+        for line in lines:
+            history.append(line)
+        appended = time.perf_counter() - start
+        history.store.flush()
+        committed = time.perf_counter() - start
+        print(f"append (reader thread)  {appended / args.lines * 1e6:>9.2f} us/line")
+        print(f"committed (writer)      {args.lines / committed:>9.0f} lines/s")
+        print(f"file size               {os.path.getsize(history.store.path) / args.lines:>9.0f} bytes/line")
+
+        newest_unique = (args.lines - 1) // UNIQUE_EVERY * UNIQUE_EVERY
+        queries = [
+            ('/history 20', lambda: history.recent(20)),
+            ('/history 200', lambda: history.recent(200)),
+            ('/find <newest unique>', lambda: history.find(f"unique{newest_unique}")),
+            ('/find unique0', lambda: history.find("unique0")),
+            ('/find the', lambda: history.find("the")),
+            ('/find rout lect', lambda: history.find("rout lect")),
+            ('/find <no match>', lambda: history.find("zzzz")),
+        ]
+        print(f"\n{'query':<24} {'rows':>5} {'fts ms':>8} {'scan ms':>8}")
+        for label, query in queries:
+            history.indexed = True
+            fts, rows = timed(query)
+            history.indexed = False
+            scan, _ = timed(query, 2)
+            print(f"{label:<24} {rows:>5} {fts * 1e3:>8.2f} {scan * 1e3:>8.1f}")
+        history.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# benchmarks/bench_core.py
+"""Cost of the chat core itself, without sockets or a frontend.
+
+Transports here only count what they are handed, so the numbers are
+what chatcore.ChatCore adds on top of whatever server.py and app.py do
+per member:
+
+    publish   fan-out of one prepared Event to a room, for one transport
+              and for two (a bridged TCP + web chat); the core's part is
+              a dictionary lookup and one deliver() per transport
+    post      a whole public message: history/bus append, sequencing, publish
+    dm        a direct message: lookup, DM store append, both deliveries
+    join      enter() then exit() of one more member of a room this size
+
+Run from the project root:
+    python3 benchmarks/bench_core.py
+    python3 benchmarks/bench_core.py --members 10 1000 --rounds 20000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chatcore
+
+MEMBER_COUNTS = (10, 1_000, 10_000)
+ROUNDS = 50_000
+MESSAGE = "hello @everyone, this is a typical chat line with a bit of text in it"
+
+class CountingTransport(chatcore.Transport):
+    """Touches every member it is given, as a frontend's fan-out loop would."""
+
+    def __init__(self, name):
+        self.name = name
+        self.delivered = 0
+
+    def deliver(self, event, sessions, exclude=None):
+        for session in sessions:
+            if session is not exclude:
+                self.delivered += 1
+
+    def deliver_dm(self, event, session, echo):
+        self.delivered += 1
+
+class Session:
+    __slots__ = ('sock', 'name', 'transport', 'member_id')
+
+    def __init__(self, name, transport):
+        self.sock = name
+        self.name = name
+        self.transport = transport
+        self.member_id = None
+
+def make_core(members, transports):
+    core = chatcore.ChatCore()
+    sessions = []
+    for i in range(members):
+        session = Session(f"user{i}", transports[i % len(transports)])
+        core.connect(session)
+        core.enter(session, quiet=True)
+        sessions.append(session)
+    return core, sessions
+
+def timed(function, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    return (time.perf_counter() - start) / rounds
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the transport-independent chat core")
+    parser.add_argument('--members', type=int, nargs='+', default=MEMBER_COUNTS, help="room sizes")
+    parser.add_argument('--rounds', type=int, default=ROUNDS, help="operations per row, divided by room size (default: %(default)s)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    print(f"{'members':>8} {'transports':>10} {'publish':>12} {'per member':>11} {'post':>10} {'dm':>9} {'join':>9}")
+    for members in args.members:
+        for count in (1, 2):
+            transports = [CountingTransport(f"t{i}") for i in range(count)]
+            core, sessions = make_core(members, transports)
+            sender = sessions[0]
+            rounds = max(10, args.rounds // members)
+            event = chatcore.Event(chatcore.MESSAGE, chatcore.GENERAL, sender.name, MESSAGE, '12:00:00', {})
+            publish = timed(lambda: core.publish(event), rounds)
+            post = timed(lambda: core.post(sender, chatcore.GENERAL, MESSAGE, '12:00:00'), rounds)
+            dm = timed(lambda: core.send_dm(sender, sessions[-1].name, MESSAGE, '12:00:00'), args.rounds // 10)
+            extra = Session("extra", transports[0])
+            core.connect(extra)
+
+            def join():
+                core.enter(extra, quiet=True)
+                core.exit(extra, chatcore.GENERAL, quiet=True)
+            join = timed(join, rounds)
+            print(f"{members:>8} {count:>10} {publish * 1e6:>10.1f}us {publish / members * 1e9:>9.0f}ns "
+                  f"{post * 1e6:>8.1f}us {dm * 1e6:>7.1f}us {join * 1e6:>7.1f}us")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# benchmarks/bench_payloads.py
+"""Bytes on the wire and CPU per message for the web chat's payload encodings.
+
+Builds the Socket.IO packets app.py would send for three typical
+payloads -- one 'new_message', a 'new_messages' batch and a
+'private_messages' history page -- in each encoding from payloads.py:
+
+    json      the plain events every client gets by default
+    compact   short keys
+    deflate   plain JSON, zlib-compressed as a binary attachment
+    both      short keys, then deflated
+
+and times encoding them (the server's side, paid once per emit) and
+decoding them (the browser's side, paid by each member; Python's json
+and zlib stand in for the browser's). Deflate only applies to replies
+of payloads.DEFLATE_MIN bytes or more, so the live events are shown
+without it.
+
+Run from the project root:
+    python3 benchmarks/bench_payloads.py
+    python3 benchmarks/bench_payloads.py --batch 50 --page 200
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import payloads
+
+BATCH = 20  # Messages in a new_messages batch
+PAGE = 50   # Messages in a private_messages page
+ROUNDS = 2000
+TEXTS = ("hello @everyone, this is a typical chat line with a bit of text in it",
+         "ok", "see you at 3?", "did anyone get the notes from today's lecture on routing?")
+
+def public_message(i):
+    return {'room': 'general', 'username': f'user{i % 40}', 'message': TEXTS[i % len(TEXTS)],
+            'timestamp': '12:00:00', 'is_private': False, 'seq': 1792197212023 + i}
+
+def direct_message(i):
+    return {'sender': 'alice' if i % 2 else 'bob', 'message': TEXTS[i % len(TEXTS)],
+            'timestamp': '12:00:00', 'is_private': True, 'id': 1000 + i}
+
+def packet(event, data):
+    """The Socket.IO frame: a text packet, or a text header plus one binary attachment."""
+    if isinstance(data, bytes):
+        header = '451-' + json.dumps([event, {'_placeholder': True, 'num': 0}], separators=(',', ':'))
+        return header.encode('utf-8'), data
+    return ('42' + json.dumps([event, data], separators=(',', ':'))).encode('utf-8'), b''
+
+def encode(event, data, compact, deflate):
+    if compact:
+        data = payloads.compact(data)
+    if deflate:
+        data = payloads.deflate(data, 0)
+    return packet(event, data)
+
+def decode(text, attachment):
+    event, data = json.loads(text[4:] if attachment else text[2:])
+    if attachment:
+        data = payloads.inflate(attachment)
+    return payloads.expand(data)
+
+def timed(function, rounds):
+    start = time.process_time()
+    for _ in range(rounds):
+        function()
+    return (time.process_time() - start) / rounds
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the web chat's compact and deflated payloads")
+    parser.add_argument('--batch', type=int, default=BATCH, help="messages per new_messages batch (default: %(default)s)")
+    parser.add_argument('--page', type=int, default=PAGE, help="messages per DM history page (default: %(default)s)")
+    parser.add_argument('--rounds', type=int, default=ROUNDS, help="encodes/decodes timed per row (default: %(default)s)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    cases = [
+        ('new_message', 1, public_message(0), False),
+        ('new_messages', args.batch,
+         {'room': 'general', 'messages': [public_message(i) for i in range(args.batch)]}, False),
+        ('private_messages', args.page,
+         {'with_user': 'bob', 'messages': [direct_message(i) for i in range(args.page)],
+          'before': None, 'has_more': True}, True),
+    ]
+    modes = [('json', False, False), ('compact', True, False), ('deflate', False, True), ('both', True, True)]
+    print(f"{'payload':<17} {'mode':<8} {'bytes':>7} {'B/msg':>7} {'saved':>6} {'enc us/msg':>11} {'dec us/msg':>11}")
+    for event, count, data, is_reply in cases:
+        baseline = None
+        for mode, compact, deflate in modes:
+            if deflate and not is_reply:
+                continue
+            text, attachment = encode(event, data, compact, deflate)
+            size = len(text) + len(attachment)
+            if baseline is None:
+                baseline = size
+            rounds = max(1, args.rounds // count)
+            encode_time = timed(lambda: encode(event, data, compact, deflate), rounds)
+            decode_time = timed(lambda: decode(text, attachment), rounds)
+            print(f"{event:<17} {mode:<8} {size:>7} {size / count:>7.1f} {1 - size / baseline:>6.0%} "
+                  f"{encode_time / count * 1e6:>11.2f} {decode_time / count * 1e6:>11.2f}")
+
+if __name__ == "__main__":
+    main()
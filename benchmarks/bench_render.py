@@ -0,0 +1,85 @@
+# benchmarks/bench_render.py
+"""What a flood of chat lines costs client.py's reader thread.
+
+A stand-in terminal charges a fixed delay per write() (a slow terminal
+or SSH session) plus a little per byte. Lines are pushed as fast as
+the reader can take them, either:
+
+    per line   format_message() and two writes per line, with the prompt
+               redrawn each time (the old handle_server_messages loop)
+    frames     client.Renderer: the reader only queues, and a drawing
+               thread writes one frame every FRAME_INTERVAL, collapsing
+               all but MAX_BACKLOG waiting lines into "N messages skipped"
+
+Reported: reader time per line (how fast the socket is drained), and
+the writes and lines the terminal ended up with.
+
+Run from the project root:
+    python3 benchmarks/bench_render.py
+    python3 benchmarks/bench_render.py --lines 50000 --write-ms 1
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import client
+
+LINES = 20_000
+WRITE_MS = 0.5  # Terminal cost per write()
+BYTE_NS = 5  # Terminal cost per byte
+MESSAGE = "[12:00:00 PM] bob: hello @everyone, this is a typical chat line with a bit of text in it"
+
+class SlowTerminal:
+    def __init__(self, write_ms, byte_ns):
+        self.write_s = write_ms / 1000
+        self.byte_s = byte_ns / 1e9
+        self.writes = 0
+        self.lines = 0
+
+    def write(self, text):
+        self.writes += 1
+        self.lines += text.count('\n')
+        time.sleep(self.write_s + len(text) * self.byte_s)
+
+    def flush(self):
+        pass
+
+def per_line(lines, out, name):
+    start = time.perf_counter()
+    for line in lines:
+        out.write(f"\r{client.format_message(line, name)}\n")
+        out.write(f"{name}: ")
+    return time.perf_counter() - start
+
+def frames(lines, out, name):
+    renderer = client.Renderer(name, out)
+    start = time.perf_counter()
+    for line in lines:
+        renderer.show(line)
+    elapsed = time.perf_counter() - start
+    time.sleep(renderer.interval * 3)  # Let the last frame out
+    return elapsed
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark per-line vs frame-batched terminal output")
+    parser.add_argument('--lines', type=int, default=LINES, help="lines in the flood (default: %(default)s)")
+    parser.add_argument('--write-ms', type=float, default=WRITE_MS, help="terminal cost per write in ms (default: %(default)s)")
+    parser.add_argument('--byte-ns', type=float, default=BYTE_NS, help="terminal cost per byte in ns (default: %(default)s)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    lines = [MESSAGE] * args.lines
+    print(f"{args.lines} lines, {args.write_ms} ms per write + {args.byte_ns} ns per byte")
+    print(f"{'mode':<10} {'reader us/line':>15} {'lines/s':>10} {'writes':>8} {'lines drawn':>12}")
+    for mode, run in (('per line', per_line), ('frames', frames)):
+        out = SlowTerminal(args.write_ms, args.byte_ns)
+        elapsed = run(lines, out, 'alice')
+        print(f"{mode:<10} {elapsed / args.lines * 1e6:>15.2f} {args.lines / elapsed:>10.0f} "
+              f"{out.writes:>8} {out.lines:>12}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# benchmarks/bench_search.py
+"""Cost of /search (searchindex.py) over a large chat history.
+
+Indexes synthetic messages (words drawn from a skewed vocabulary, so a
+few are in most messages and most are rare; one in ten is a DM) and
+reports the cost of add() per message, the process's memory, and the
+latency of typical queries: rare and common words, several words,
+sender, room and time filters, a next page, and a search that matches
+nothing. Merging runs in the background as it would in the server; the
+queries start once it has caught up.
+
+Run from the project root:
+    python3 benchmarks/bench_search.py
+    python3 benchmarks/bench_search.py --messages 200000
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import searchindex
+
+MESSAGES = 1_000_000
+ROUNDS = 200
+VOCABULARY = 20_000
+USERS = 500
+ROOMS = ("general", "routing", "sockets", "offtopic")
+
+def make_messages(count):
+    random.seed(1)
+    vocabulary = [f"w{i}" for i in range(VOCABULARY)]
+    weights = [1 / (rank + 1) for rank in range(VOCABULARY)]  # Zipf: w0 is everywhere, w19999 almost nowhere
+    words = random.choices(vocabulary, weights, k=count * 10)
+    for i in range(count):
+        sender = f"user{random.randrange(USERS)}"
+        text = ' '.join(words[i * 10:(i + 1) * 10])
+        if i % 10 == 0:
+            yield sender, text, None, f"user{random.randrange(USERS)}"
+        else:
+            yield sender, text, random.choice(ROOMS), None
+
+def timed(function, rounds=ROUNDS):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2], times[int(len(times) * 0.99)], len(result[0])
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the server-side message search index")
+    parser.add_argument('--messages', type=int, default=MESSAGES, help="messages indexed (default: %(default)s)")
+    parser.add_argument('--rounds', type=int, default=ROUNDS, help="runs of each query (default: %(default)s)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    index = searchindex.SearchIndex(max_docs=args.messages)
+    messages = list(make_messages(args.messages))
+    created = time.time() - args.messages  # One message a second, ending now
+    start = time.perf_counter()
+    for i, (sender, text, room, to) in enumerate(messages):
+        index.add(sender, text, room=room, to=to, created=created + i)
+    added = time.perf_counter() - start
+    index.merge()  # Catch up with the merge thread
+    del messages  # Only the index's own objects left for the garbage collector to walk
+    rss = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024  # KiB on Linux
+    print(f"{len(index)} messages in {index.segment_count()} segments")
+    print(f"add (incl. tokenizing)  {added / args.messages * 1e6:>8.2f} us/message")
+    print(f"memory (max RSS growth) {rss:>8.0f} MiB, texts and messages generated included")
+
+    first_page, _ = index.search("user1", "w3")
+    last_hour = created + args.messages - 3600
+    queries = [
+        ('rare word', dict(text="w15000")),
+        ('common word', dict(text="w0")),
+        ('two words', dict(text="w5 w40")),
+        ('three words', dict(text="w2 w30 w300")),
+        ('rare and common', dict(text="w0 w15000")),
+        ('sender', dict(sender="user7")),
+        ('sender + word', dict(text="w3", sender="user7")),
+        ('room + word', dict(text="w3", room="sockets")),
+        ('word, last hour', dict(text="w100", since=last_hour)),
+        ('word, 1st hour', dict(text="w3", until=created + 3600)),
+        ('next page', dict(text="w3", before=first_page[-1]['id'])),
+        ('no match', dict(text="nothing")),
+        ('rarely together', dict(text="w10000 w19999")),
+    ]
+    print(f"\n{'query':<18} {'results':>7} {'p50 ms':>8} {'p99 ms':>8}")
+    for label, query in queries:
+        p50, p99, count = timed(lambda: index.search("user1", **query), args.rounds)
+        print(f"{label:<18} {count:>7} {p50 * 1e3:>8.3f} {p99 * 1e3:>8.3f}")
+    index.close()
+
+if __name__ == "__main__":
+    main()
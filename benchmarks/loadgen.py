@@ -0,0 +1,391 @@
+# benchmarks/loadgen.py
+"""Load generator for the TCP chat server.
+
+Opens many simulated clients from one process. Each client connects with
+client.connect_to_server() (so it negotiates the framed protocol exactly
+like the real client) and is then driven from an asyncio event loop.
+
+Every generated message carries its send time. Each client that receives
+a broadcast or DM records how long it took to arrive, which gives
+end-to-end fan-out latency. Results are printed and written as JSON, so
+runs against different commits can be compared.
+
+Run from the project root against a running server:
+    python3 benchmarks/loadgen.py --clients 500 --rate 200 --duration 30
+
+or let the load generator start its own server (in a scratch directory):
+    python3 benchmarks/loadgen.py --spawn --server-args "--engine selector"
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import client
+import protocol
+
+MARKER = "#lg:"  # Precedes the send time (monotonic ns) in generated messages
+RECV_CHUNK = protocol.MIN_RECV  # Always fits in a decoder after it compacts
+RSS_INTERVAL = 0.5  # Seconds between server memory samples
+
+class Stats:
+    """Counters and latency samples for one run."""
+
+    def __init__(self):
+        self.measure_from = None  # monotonic ns; earlier messages are warmup
+        self.broadcast_us = array('q')
+        self.dm_us = array('q')
+        self.broadcasts = 0  # Counted from measure_from, like the deliveries
+        self.dms = 0
+        self.expected = 0  # Broadcast deliveries expected (members at send time)
+        self.delivered = 0
+        self.dm_delivered = 0
+        self.joins = 0
+        self.leaves = 0
+        self.connect_failures = 0
+        self.disconnects = 0  # Clients the server closed on us
+
+    def record(self, text, now):
+        at = text.find(MARKER)
+        if at == -1:
+            return
+        sent = int(text[at + len(MARKER):].split(' ', 1)[0])
+        if sent < self.measure_from:
+            return
+        if '[PM to ' in text:
+            return  # The sender's own DM confirmation
+        if '[PM from ' in text:
+            self.dm_delivered += 1
+            self.dm_us.append((now - sent) // 1000)
+        else:
+            self.delivered += 1
+            self.broadcast_us.append((now - sent) // 1000)
+
+def percentiles(samples):
+    """p50/p99/p999/max of microsecond samples, in milliseconds."""
+    if not samples:
+        return {'samples': 0}
+    ordered = sorted(samples)
+    n = len(ordered)
+
+    def at(p):
+        return round(ordered[min(n - 1, max(0, int(p * n + 0.5) - 1))] / 1000, 3)
+    return {'samples': n, 'p50': at(0.50), 'p99': at(0.99), 'p999': at(0.999),
+            'max': round(ordered[-1] / 1000, 3)}
+
+def read_rss_kb(pid):
+    """Resident set size of a process in KiB, or None if it cannot be read."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def raise_fd_limit():
+    """Thousands of sockets need more than the usual 1024 descriptors."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+class SimClient:
+    """One simulated chat client."""
+    __slots__ = ('name', 'conn', 'sock', 'reader')
+
+    def __init__(self, name, conn):
+        self.name = name
+        self.conn = conn
+        self.sock = conn.sock
+        self.reader = None
+
+    async def read_loop(self, loop, stats, on_lost):
+        decoder = self.conn.decoder
+        try:
+            while True:
+                now = time.monotonic_ns()
+                for msg_type, text in decoder:
+                    if msg_type == protocol.MSG_TEXT:
+                        stats.record(text, now)
+                data = await loop.sock_recv(self.sock, RECV_CHUNK)
+                if not data:
+                    break
+                decoder.feed(data)
+        except (OSError, protocol.ProtocolError):
+            pass
+        on_lost(self)
+
+class LoadGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.stats = Stats()
+        self.clients = []  # Connected SimClients
+        self.next_id = 0
+        self.run_id = f"{os.getpid() % 10000:04d}"
+        self.executor = ThreadPoolExecutor(max_workers=args.connect_concurrency)
+        self.rss = []
+        self.stopping = False
+
+    def _connect(self, name):
+        conn = client.connect_to_server(self.args.host, self.args.port, name, retries=2, delay=0.5)
+        if conn is not None:
+            conn.sock.setblocking(False)
+        return conn
+
+    async def connect_one(self, loop):
+        name = f"lg{self.run_id}_{self.next_id}"
+        self.next_id += 1
+        conn = await loop.run_in_executor(self.executor, self._connect, name)
+        if conn is None:
+            self.stats.connect_failures += 1
+            return None
+        sim = SimClient(name, conn)
+        self.clients.append(sim)
+        sim.reader = loop.create_task(sim.read_loop(loop, self.stats, self._lost))
+        return sim
+
+    def _lost(self, sim):
+        if sim in self.clients:
+            self.clients.remove(sim)
+            if not self.stopping:
+                self.stats.disconnects += 1
+        sim.conn.close()
+
+    async def send(self, loop, sim, *lines):
+        try:
+            await loop.sock_sendall(sim.sock, b"".join(sim.conn.encode(line) for line in lines))
+        except OSError:
+            self._lost(sim)
+
+    def payload(self):
+        text = f"{MARKER}{time.monotonic_ns()}"
+        pad = self.args.message_size - len(text) - 1
+        return f"{text} {'x' * pad}" if pad > 0 else text
+
+    async def drive_messages(self, loop, until):
+        """Open-loop sender: one message every 1/rate seconds from a random client."""
+        interval = 1.0 / self.args.rate
+        next_at = time.monotonic()
+        while next_at < until:
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_at += interval
+            if len(self.clients) < 2:
+                continue
+            sim = random.choice(self.clients)
+            measured = time.monotonic_ns() >= self.stats.measure_from
+            if random.random() < self.args.dm_ratio:
+                # /list_users fixes the numbering that '/dm 1' picks from
+                self.stats.dms += measured
+                await self.send(loop, sim, "/list_users", "/dm 1", self.payload(), "/back")
+            else:
+                self.stats.broadcasts += measured
+                # The sender gets its own message back too
+                self.stats.expected += len(self.clients) if measured else 0
+                await self.send(loop, sim, self.payload())
+
+    async def drive_churn(self, loop, until):
+        """Disconnect a random client and connect a fresh one, churn times a second."""
+        interval = 1.0 / self.args.churn
+        while time.monotonic() + interval < until:
+            await asyncio.sleep(interval)
+            if self.clients:
+                sim = random.choice(self.clients)
+                self.clients.remove(sim)
+                await self.send(loop, sim, "/q")
+                sim.reader.cancel()
+                sim.conn.close()
+                self.stats.leaves += 1
+            if await self.connect_one(loop) is not None:
+                self.stats.joins += 1
+
+    async def sample_rss(self, pid):
+        while True:
+            rss = read_rss_kb(pid)
+            if rss is not None:
+                self.rss.append(rss)
+            await asyncio.sleep(RSS_INTERVAL)
+
+    async def run(self, server_pid=None):
+        args = self.args
+        loop = asyncio.get_running_loop()
+        sampler = loop.create_task(self.sample_rss(server_pid)) if server_pid else None
+        rss_idle = read_rss_kb(server_pid) if server_pid else None
+
+        print(f"Connecting {args.clients} clients to {args.host}:{args.port}...")
+        started = time.monotonic()
+        await asyncio.gather(*(self.connect_one(loop) for _ in range(args.clients)))
+        connect_seconds = time.monotonic() - started
+        print(f"  {len(self.clients)} connected in {connect_seconds:.1f}s"
+              f" ({self.stats.connect_failures} failed)")
+        rss_connected = read_rss_kb(server_pid) if server_pid else None
+
+        begin = time.monotonic()
+        until = begin + args.warmup + args.duration
+        self.stats.measure_from = time.monotonic_ns() + int(args.warmup * 1e9)
+        print(f"Sending {args.rate} msg/s for {args.duration}s (after {args.warmup}s warmup)...")
+        drivers = [self.drive_messages(loop, until)]
+        if args.churn > 0:
+            drivers.append(self.drive_churn(loop, until))
+        await asyncio.gather(*drivers)
+        sent_seconds = time.monotonic() - begin - args.warmup
+        await asyncio.sleep(args.drain)  # Let in-flight deliveries arrive
+
+        self.stopping = True
+        if sampler:
+            sampler.cancel()
+        for sim in list(self.clients):
+            sim.reader.cancel()
+            sim.conn.close()
+        self.executor.shutdown(wait=False)
+        return self.report(connect_seconds, sent_seconds, rss_idle, rss_connected)
+
+    def report(self, connect_seconds, sent_seconds, rss_idle, rss_connected):
+        stats = self.stats
+        # Throughput covers the whole send phase; latency only the measured part
+        delivered = stats.delivered + stats.dm_delivered
+        return {
+            'tool': 'loadgen',
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': vars(self.args),
+            'connect': {
+                'clients': self.args.clients,
+                'failed': stats.connect_failures,
+                'seconds': round(connect_seconds, 3),
+            },
+            'throughput': {
+                'broadcasts': stats.broadcasts,
+                'dms': stats.dms,
+                'sent_per_sec': round((stats.broadcasts + stats.dms) / sent_seconds, 1),
+                'deliveries': delivered,
+                'deliveries_per_sec': round(delivered / sent_seconds, 1),
+                'expected_broadcast_deliveries': stats.expected,
+            },
+            'latency_ms': {
+                'broadcast': percentiles(stats.broadcast_us),
+                'dm': percentiles(stats.dm_us),
+            },
+            'churn': {
+                'joins': stats.joins,
+                'leaves': stats.leaves,
+                'server_disconnects': stats.disconnects,
+            },
+            'server_rss_kb': {
+                'idle': rss_idle,
+                'connected': rss_connected,
+                'peak': max(self.rss) if self.rss else None,
+                'end': self.rss[-1] if self.rss else None,
+            },
+        }
+
+def spawn_server(args):
+    """Start server.py in a scratch directory and wait until it accepts connections."""
+    workdir = tempfile.mkdtemp(prefix="loadgen-")
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server.py'), *shlex.split(args.server_args)],
+                            cwd=workdir, stdin=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10.0
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            sys.exit(f"Server exited with status {proc.returncode}")
+        try:
+            socket.create_connection((args.host, args.port), timeout=1.0).close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    sys.exit(f"Server did not start listening on {args.host}:{args.port}")
+
+def print_summary(result):
+    t = result['throughput']
+    print(f"\nSent {t['broadcasts']} broadcasts and {t['dms']} DMs ({t['sent_per_sec']}/s)")
+    print(f"Deliveries: {t['deliveries']} ({t['deliveries_per_sec']}/s),"
+          f" {t['expected_broadcast_deliveries']} broadcast deliveries expected")
+    for kind, lat in result['latency_ms'].items():
+        if lat['samples']:
+            print(f"{kind:>9} latency ms: p50 {lat['p50']}  p99 {lat['p99']}"
+                  f"  p999 {lat['p999']}  max {lat['max']}  ({lat['samples']} samples)")
+    rss = result['server_rss_kb']
+    if rss['peak'] is not None:
+        print(f"Server RSS KiB: idle {rss['idle']}, connected {rss['connected']}, peak {rss['peak']}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load generator for the chat server")
+    parser.add_argument('--host', default=client.DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=client.DEFAULT_PORT)
+    parser.add_argument('--clients', type=int, default=200,
+                        help="simulated clients (default: %(default)s)")
+    parser.add_argument('--rate', type=float, default=100.0,
+                        help="messages per second across all clients (default: %(default)s)")
+    parser.add_argument('--dm-ratio', type=float, default=0.1,
+                        help="fraction of messages sent as DMs (default: %(default)s)")
+    parser.add_argument('--churn', type=float, default=0.0,
+                        help="clients replaced per second (default: %(default)s)")
+    parser.add_argument('--message-size', type=int, default=64,
+                        help="approximate message length in characters (default: %(default)s)")
+    parser.add_argument('--duration', type=float, default=20.0,
+                        help="measured seconds (default: %(default)s)")
+    parser.add_argument('--warmup', type=float, default=3.0,
+                        help="seconds of load before measuring (default: %(default)s)")
+    parser.add_argument('--drain', type=float, default=2.0,
+                        help="seconds to wait for in-flight messages (default: %(default)s)")
+    parser.add_argument('--connect-concurrency', type=int, default=32,
+                        help="handshakes in flight at once (default: %(default)s)")
+    parser.add_argument('--server-pid', type=int,
+                        help="sample this process's memory (default: the spawned server)")
+    parser.add_argument('--spawn', action='store_true',
+                        help="start server.py for the run and stop it afterwards")
+    parser.add_argument('--server-args', default="",
+                        help="arguments for the spawned server, e.g. \"--engine selector\"")
+    parser.add_argument('--output', default="loadgen-results.json",
+                        help="JSON results file (default: %(default)s)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    raise_fd_limit()
+    proc = spawn_server(args) if args.spawn else None
+    server_pid = args.server_pid or (proc.pid if proc else None)
+    try:
+        result = asyncio.run(LoadGenerator(args).run(server_pid))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+    print_summary(result)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,639 @@
+# bus.py
+"""Shared state for running several app.py workers side by side.
+
+app.py talks to a "bus" for everything that must be visible to every
+worker: who is online (and which Socket.IO session a username maps to,
+for DM routing) and the DM history. Two implementations share one API:
+
+    LocalBus   - plain dictionaries, for a single app.py process (default)
+    BrokerBus  - state kept by the local broker below, for many workers
+
+The broker is a small Unix-socket server (python3 bus.py) that also
+relays Socket.IO events between workers: BrokerManager plugs into
+Flask-SocketIO as its client_manager, the same hook Redis or Kafka use
+through message_queue, so emits to a room or sid reach clients connected
+to any worker. Every payload is JSON in a protocol.py frame; bytes in a
+relayed event (a deflated payload, see payloads.py) travel as base64.
+"""
+import argparse
+import base64
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+import dmstore
+import outbound
+import protocol
+import store
+
+try:
+    import socketio
+except ImportError:  # Only needed by workers; the broker runs without it
+    socketio = None
+
+DEFAULT_SOCKET = "/tmp/dccn-chat-bus.sock"
+STORE_PATH = "chat_history/webchat.db"  # Web chat message store (store.MessageStore)
+SUBSCRIBER_QUEUE_SIZE = 10000  # Relayed events buffered per worker before it is dropped
+RECONNECT_DELAY = 1.0  # Seconds between attempts to reach the broker
+GENERAL = 'general'  # The room every session joins; it always exists
+REPLAY_WINDOW = 500  # Sequenced events kept per room for clients catching up after a reconnect
+
+# Frame types on the broker socket (protocol.MSG_* stay below 16)
+BUS_REQUEST = 16    # Worker -> broker: JSON {"op": ..., ...}
+BUS_REPLY = 17      # Broker -> worker: JSON result or {"error": ...}
+BUS_PUBLISH = 18    # Worker -> broker: Socket.IO event to relay to every worker
+BUS_SUBSCRIBE = 19  # Worker -> broker: turn this connection into an event feed
+BUS_MESSAGE = 20    # Broker -> worker: a relayed event
+BYTES_KEY = "$bytes"  # {"$bytes": base64} stands for a bytes value in a relayed event
+
+class BusError(Exception):
+    """The broker could not be reached or refused a request."""
+
+def socket_path(url):
+    """'unix:///tmp/x.sock' -> '/tmp/x.sock'."""
+    if not url.startswith("unix://"):
+        raise BusError(f"Unsupported message bus URL '{url}' (expected unix:///path/to/socket)")
+    return url[len("unix://"):] or DEFAULT_SOCKET
+
+def _encode_bytes(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {BYTES_KEY: base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _decode_bytes(obj):
+    if len(obj) == 1 and BYTES_KEY in obj:
+        return base64.b64decode(obj[BYTES_KEY])
+    return obj
+
+def encode_event(data):
+    """JSON text for a relayed Socket.IO event, bytes included."""
+    return json.dumps(data, default=_encode_bytes)
+
+def decode_event(text):
+    """Undo encode_event()."""
+    return json.loads(text, object_hook=_decode_bytes)
+
+def dm_key(user1, user2):
+    """Conversation key shared by both participants."""
+    return "\n".join(sorted((user1, user2)))
+
+class Presence:
+    """Who is online, plus a version number bumped by every change.
+
+    A user may have several sessions (browser tabs): they are added when
+    the first one joins and removed when the last one leaves, and DMs go
+    to the newest. Versions start from the clock, so a restarted broker
+    never reuses numbers clients have already seen. Not thread-safe;
+    callers hold their own lock.
+    """
+
+    def __init__(self):
+        self.version = int(time.time() * 1000)
+        self._users = {}  # {sid: username}
+        self._sids = {}   # {username: [sids, newest last]}
+
+    def join(self, sid, username):
+        """Returns (added, version); added is False for a user's extra sessions."""
+        if sid in self._users:
+            return False, self.version
+        self._users[sid] = username
+        sids = self._sids.setdefault(username, [])
+        sids.append(sid)
+        if len(sids) > 1:
+            return False, self.version
+        self.version += 1
+        return True, self.version
+
+    def leave(self, sid):
+        """Returns (username, removed, version); username is None for unknown sessions."""
+        username = self._users.pop(sid, None)
+        if username is None:
+            return None, False, self.version
+        sids = self._sids[username]
+        sids.remove(sid)
+        if sids:
+            return username, False, self.version
+        del self._sids[username]
+        self.version += 1
+        return username, True, self.version
+
+    def sid_for(self, username):
+        sids = self._sids.get(username)
+        return sids[-1] if sids else None
+
+    def usernames(self):
+        return list(self._sids)
+
+    def __len__(self):
+        return len(self._sids)
+
+class Channels:
+    """Chat rooms: a Presence per room plus the rooms of each session.
+
+    Socket.IO delivers a room's messages to its members only; this index
+    answers who is in a room, which rooms exist, and which rooms a
+    session has to be taken out of when it disconnects, each without
+    looking at other rooms' members. Rooms other than GENERAL go away
+    with their last member. Not thread-safe.
+    """
+
+    def __init__(self):
+        self.rooms = {GENERAL: Presence()}
+        self._by_sid = {}  # {sid: set of rooms}
+
+    def join(self, room, sid, username, create=True):
+        """Returns (added, version), or None if the room does not exist and create is False."""
+        presence = self.rooms.get(room)
+        if presence is None:
+            if not create:
+                return None
+            presence = self.rooms[room] = Presence()
+        self._by_sid.setdefault(sid, set()).add(room)
+        return presence.join(sid, username)
+
+    def leave(self, room, sid):
+        """Returns (username, removed, version, closed); closed if the room went with it."""
+        presence = self.rooms.get(room)
+        if presence is None:
+            return None, False, None, False
+        rooms = self._by_sid.get(sid)
+        if rooms is not None:
+            rooms.discard(room)
+            if not rooms:
+                del self._by_sid[sid]
+        username, removed, version = presence.leave(sid)
+        closed = room != GENERAL and not presence
+        if closed:
+            del self.rooms[room]
+        return username, removed, version, closed
+
+    def rooms_of(self, sid):
+        return list(self._by_sid.get(sid, ()))
+
+    def listing(self):
+        """[[room, member count], ...] sorted by name."""
+        return [[room, len(presence)] for room, presence in sorted(self.rooms.items())]
+
+class RoomLog:
+    """Per-room sequence numbers, plus the newest events for replay.
+
+    Every event sent to a room gets the room's next sequence number and
+    is kept in a bounded window; a reconnecting client asks for what
+    came after the last number it saw. Numbers start from the clock like
+    presence versions, so a client that last saw an earlier run's
+    numbers finds them outside the window and resyncs. Not thread-safe.
+    """
+
+    def __init__(self, window=REPLAY_WINDOW):
+        self.window = window
+        self._rooms = {}  # {room: [last seq, deque of [seq, event, data]]}
+
+    def record(self, room, event, data):
+        """Returns a copy of data with its 'seq' set."""
+        log = self._rooms.get(room)
+        if log is None:
+            log = self._rooms[room] = [int(time.time() * 1000), deque(maxlen=self.window)]
+        log[0] += 1
+        data = dict(data, seq=log[0])
+        log[1].append([log[0], event, data])
+        return data
+
+    def since(self, room, seq):
+        """Returns (events after seq as [[event, data], ...], complete, last seq).
+
+        seq=None (a client seeing the room for the first time) only asks
+        for the last seq; seq=0 asks for the whole window, e.g. as recent
+        history on joining a room. When the client is too far behind, or
+        has numbers from another run, the whole window is returned with
+        complete=False.
+        """
+        log = self._rooms.get(room)
+        if log is None:
+            return [], True, None
+        last, events = log
+        if seq is None:
+            return [], True, last
+        if seq <= last and seq >= events[0][0] - 1:
+            return [[event, data] for s, event, data in events if s > seq], True, last
+        return [[event, data] for _, event, data in events], False, last
+
+    def drop(self, room):
+        self._rooms.pop(room, None)
+
+class LocalBus:
+    """Presence, DM history and room sequencing for a single app.py process."""
+
+    def __init__(self, message_store=None):
+        self._lock = threading.Lock()
+        self._channels = Channels()
+        self._rooms = RoomLog()
+        self._store = message_store
+        self._dms = dmstore.DMStore(message_store)
+
+    def join(self, sid, username, room=GENERAL, create=True):
+        """Returns (added, presence version), or None for a missing room when create is False."""
+        with self._lock:
+            return self._channels.join(room, sid, username, create)
+
+    def leave_room(self, room, sid):
+        """Returns (username or None, removed, presence version)."""
+        with self._lock:
+            return self._leave(room, sid)
+
+    def leave(self, sid):
+        """Forget a session: [(room, username, removed, presence version), ...] for its rooms."""
+        with self._lock:
+            return [(room,) + self._leave(room, sid) for room in self._channels.rooms_of(sid)]
+
+    def _leave(self, room, sid):
+        username, removed, version, closed = self._channels.leave(room, sid)
+        if closed:
+            self._rooms.drop(room)  # Nobody is left to replay it to
+        return username, removed, version
+
+    def sid_for(self, username):
+        with self._lock:
+            return self._channels.rooms[GENERAL].sid_for(username)
+
+    def usernames(self):
+        with self._lock:
+            return self._channels.rooms[GENERAL].usernames()
+
+    def snapshot(self, room=GENERAL):
+        """Returns (presence version, usernames), or (None, []) for a missing room."""
+        with self._lock:
+            presence = self._channels.rooms.get(room)
+            if presence is None:
+                return None, []
+            return presence.version, presence.usernames()
+
+    def rooms(self):
+        """[[room, member count], ...]"""
+        with self._lock:
+            return self._channels.listing()
+
+    def append_dm(self, user1, user2, message):
+        """Returns the stored message, with its 'id'."""
+        return self._dms.append(dm_key(user1, user2), message)
+
+    def dm_history(self, user1, user2, before=None, limit=dmstore.DEFAULT_PAGE):
+        """One page of a conversation, oldest first: (messages, has_more)."""
+        return self._dms.page(dm_key(user1, user2), before, limit)
+
+    def append_message(self, room, message):
+        """Keep a public message; returns its id, or None without a store."""
+        if self._store is None:
+            return None
+        return self._store.append('room:' + room, message)
+
+    def sequence(self, room, event, data):
+        """Number an event for a room; returns data with its 'seq' to emit."""
+        with self._lock:
+            return self._rooms.record(room, event, data)
+
+    def replay(self, room, seq):
+        """Returns (events, complete, last seq); see RoomLog.since."""
+        with self._lock:
+            return self._rooms.since(room, seq)
+
+class BrokerClient:
+    """Request/reply connection to the broker, reconnecting when it drops."""
+
+    def __init__(self, path, on_connect=None, timeout=5.0):
+        self.path = path
+        self.on_connect = on_connect  # Called with the client after every (re)connect
+        self.timeout = timeout
+        self._sock = None
+        self._decoder = None
+        self._lock = threading.RLock()  # on_connect may issue requests itself
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self._sock, self._decoder = sock, protocol.FrameDecoder()
+        if self.on_connect is not None:
+            self.on_connect(self)
+
+    def close(self):
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+
+    def request(self, op, **fields):
+        fields['op'] = op
+        frame = protocol.encode_text(json.dumps(fields), BUS_REQUEST)
+        with self._lock:
+            for attempt in (1, 2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._sock.sendall(frame)
+                    reply = self._read_reply()
+                    break
+                except (OSError, protocol.ProtocolError) as e:
+                    self.close()
+                    if attempt == 2:
+                        raise BusError(f"Message bus at {self.path} unavailable: {e}")
+        if 'error' in reply:
+            raise BusError(reply['error'])
+        return reply
+
+    def _read_reply(self):
+        while True:
+            for msg_type, text in self._decoder:
+                if msg_type == BUS_REPLY:
+                    return json.loads(text)
+            if not self._decoder.fill(self._sock):
+                raise ConnectionError("Broker closed the connection")
+
+class BrokerBus:
+    """LocalBus API backed by the broker, shared by every worker."""
+
+    def __init__(self, path):
+        self._local = {}  # {(sid, room): username} for this worker, replayed after a reconnect
+        self.client = BrokerClient(path, on_connect=self._rejoin)
+
+    def _rejoin(self, client):
+        # The broker forgets a worker's sessions when its connection drops
+        for (sid, room), username in list(self._local.items()):
+            client.request('join', sid=sid, username=username, room=room, create=True)
+
+    def join(self, sid, username, room=GENERAL, create=True):
+        reply = self.client.request('join', sid=sid, username=username, room=room, create=create)
+        if reply.get('missing'):
+            return None
+        self._local[sid, room] = username  # After the request, or a first connect would replay it
+        return reply['added'], reply['version']
+
+    def leave_room(self, room, sid):
+        self._local.pop((sid, room), None)
+        reply = self.client.request('leave_room', room=room, sid=sid)
+        return reply['username'], reply['removed'], reply['version']
+
+    def leave(self, sid):
+        for key in [key for key in self._local if key[0] == sid]:
+            del self._local[key]
+        return [tuple(left) for left in self.client.request('leave', sid=sid)['rooms']]
+
+    def sid_for(self, username):
+        return self.client.request('lookup', username=username).get('sid')
+
+    def usernames(self):
+        return self.client.request('users')['users']
+
+    def snapshot(self, room=GENERAL):
+        reply = self.client.request('snapshot', room=room)
+        return reply['version'], reply['users']
+
+    def rooms(self):
+        return self.client.request('rooms')['rooms']
+
+    def append_dm(self, user1, user2, message):
+        return self.client.request('dm_append', key=dm_key(user1, user2), message=message)['message']
+
+    def dm_history(self, user1, user2, before=None, limit=dmstore.DEFAULT_PAGE):
+        reply = self.client.request('dm_history', key=dm_key(user1, user2), before=before, limit=limit)
+        return reply['messages'], reply['has_more']
+
+    def append_message(self, room, message):
+        return self.client.request('append', room=room, message=message)['id']
+
+    def sequence(self, room, event, data):
+        return self.client.request('sequence', room=room, event=event, data=data)['data']
+
+    def replay(self, room, seq):
+        reply = self.client.request('replay', room=room, seq=seq)
+        return reply['events'], reply['complete'], reply['last']
+
+if socketio is not None:
+    class BrokerManager(socketio.PubSubManager):
+        """Socket.IO client manager that relays events through the local broker.
+
+        Pass it to Flask-SocketIO as client_manager. Event payloads must be
+        JSON-serialisable or bytes (see encode_event).
+        """
+        name = 'dccn-bus'
+
+        def __init__(self, url="unix://" + DEFAULT_SOCKET, channel='socketio', write_only=False, logger=None):
+            super().__init__(channel=channel, write_only=write_only, logger=logger)
+            self.path = socket_path(url)
+            self._pub = None
+            self._pub_lock = threading.Lock()
+
+        def _publish(self, data):
+            frame = protocol.encode_text(encode_event(data), BUS_PUBLISH)
+            with self._pub_lock:
+                for attempt in (1, 2):
+                    try:
+                        if self._pub is None:
+                            self._pub = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                            self._pub.connect(self.path)
+                        self._pub.sendall(frame)
+                        return
+                    except OSError as e:
+                        if self._pub is not None:
+                            self._pub.close()
+                            self._pub = None
+                        if attempt == 2:
+                            self._get_logger().error(f"Cannot publish to message bus: {e}")
+
+        def _listen(self):
+            while True:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(self.path)
+                    sock.sendall(protocol.encode_frame(BUS_SUBSCRIBE, b""))
+                    decoder = protocol.FrameDecoder()
+                    while decoder.fill(sock):
+                        for msg_type, text in decoder:
+                            if msg_type == BUS_MESSAGE:
+                                yield decode_event(text)
+                except (OSError, protocol.ProtocolError, ValueError):
+                    pass
+                finally:
+                    sock.close()
+                time.sleep(RECONNECT_DELAY)
+
+def connect(url=None, message_store=None):
+    """Bus for app.py: returns (bus, client_manager); client_manager is None for LocalBus.
+
+    message_store only applies to LocalBus; the broker keeps its own.
+    """
+    if not url:
+        return LocalBus(message_store), None
+    if socketio is None:
+        raise BusError("The message bus needs the python-socketio package")
+    return BrokerBus(socket_path(url)), BrokerManager(url)
+
+class Broker:
+    """The local broker: relays events and holds presence and DM history.
+
+    One thread per connection, like the threaded chat server; workers
+    only open two connections each (requests and the event feed).
+    Relayed events are encoded once and queued for every subscriber.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, message_store=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self.subscribers = ()  # OutboundQueues; replaced, never mutated
+        self.channels = Channels()
+        self.rooms = RoomLog()
+        self.store = message_store
+        self.dms = dmstore.DMStore(message_store)  # Locks itself
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # Left behind by a previous broker
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(64)
+        print(f"[BUS] Listening on {self.path}")
+        try:
+            while True:
+                conn, _ = server.accept()
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            server.close()
+            os.unlink(self.path)
+
+    def _handle(self, conn):
+        decoder = protocol.FrameDecoder()
+        owned = set()  # Sessions joined through this connection
+        try:
+            while decoder.fill(conn):
+                for msg_type, text in decoder:
+                    if msg_type == BUS_PUBLISH:
+                        self._relay(protocol.encode_text(text, BUS_MESSAGE))
+                    elif msg_type == BUS_REQUEST:
+                        conn.sendall(protocol.encode_text(json.dumps(self._request(text, owned)), BUS_REPLY))
+                    elif msg_type == BUS_SUBSCRIBE:
+                        self._subscribe(conn)
+                        return  # The writer thread owns the connection from here on
+        except (OSError, protocol.ProtocolError):
+            pass
+        for sid in owned:
+            self.op_leave(sid, set())
+        conn.close()
+
+    def _subscribe(self, conn):
+        queue = outbound.OutboundQueue(conn, SUBSCRIBER_QUEUE_SIZE, outbound.DISCONNECT)
+        with self._lock:
+            self.subscribers = self.subscribers + (queue,)
+        try:
+            queue.run_writer()
+        finally:
+            with self._lock:
+                self.subscribers = tuple(q for q in self.subscribers if q is not queue)
+            conn.close()
+
+    def _relay(self, frame):
+        for queue in self.subscribers:
+            queue.put(frame)  # A worker that falls this far behind is dropped and reconnects
+
+    def _request(self, text, owned):
+        try:
+            req = json.loads(text)
+            handler = getattr(self, 'op_' + req.pop('op'), None)
+            if handler is None:
+                return {'error': "Unknown operation"}
+            if handler in (self.op_join, self.op_leave):
+                req['owned'] = owned
+            return handler(**req)
+        except (ValueError, KeyError, TypeError) as e:
+            return {'error': f"Bad request: {e}"}
+
+    def _leave(self, room, sid):
+        """Caller holds _lock."""
+        username, removed, version, closed = self.channels.leave(room, sid)
+        if closed:
+            self.rooms.drop(room)
+        return username, removed, version
+
+    def op_join(self, sid, username, owned, room=GENERAL, create=True):
+        with self._lock:
+            joined = self.channels.join(room, sid, username, create)
+        if joined is None:
+            return {'missing': True}
+        owned.add(sid)
+        return {'added': joined[0], 'version': joined[1]}
+
+    def op_leave_room(self, room, sid):
+        with self._lock:
+            username, removed, version = self._leave(room, sid)
+        return {'username': username, 'removed': removed, 'version': version}
+
+    def op_leave(self, sid, owned):
+        owned.discard(sid)
+        with self._lock:
+            return {'rooms': [[room, *self._leave(room, sid)] for room in self.channels.rooms_of(sid)]}
+
+    def op_lookup(self, username):
+        with self._lock:
+            return {'sid': self.channels.rooms[GENERAL].sid_for(username)}
+
+    def op_users(self):
+        with self._lock:
+            return {'users': self.channels.rooms[GENERAL].usernames()}
+
+    def op_snapshot(self, room=GENERAL):
+        with self._lock:
+            presence = self.channels.rooms.get(room)
+            if presence is None:
+                return {'version': None, 'users': []}
+            return {'version': presence.version, 'users': presence.usernames()}
+
+    def op_rooms(self):
+        with self._lock:
+            return {'rooms': self.channels.listing()}
+
+    def op_dm_append(self, key, message):
+        return {'message': self.dms.append(key, message)}
+
+    def op_dm_history(self, key, before=None, limit=dmstore.DEFAULT_PAGE):
+        messages, has_more = self.dms.page(key, before, limit)
+        return {'messages': messages, 'has_more': has_more}
+
+    def op_sequence(self, room, event, data):
+        with self._lock:
+            return {'data': self.rooms.record(room, event, data)}
+
+    def op_replay(self, room, seq):
+        with self._lock:
+            events, complete, last = self.rooms.since(room, seq)
+        return {'events': events, 'complete': complete, 'last': last}
+
+    def op_append(self, room, message):
+        if self.store is None:
+            return {'id': None}
+        return {'id': self.store.append('room:' + room, message)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Local message bus for running several app.py workers")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                        help="Unix socket to listen on (default: %(default)s)")
+    parser.add_argument('--store', default=STORE_PATH,
+                        help="message store file, '' to keep messages in memory only (default: %(default)s)")
+    parser.add_argument('--durability', choices=list(store.DURABILITY_LEVELS), default=store.DEFAULT_DURABILITY,
+                        help="how far each commit to the store goes (default: %(default)s)")
+    args = parser.parse_args()
+    try:
+        message_store = store.MessageStore(args.store, args.durability) if args.store else None
+    except store.StoreError as e:
+        print(f"[BUS] {e}")
+        return
+    try:
+        Broker(args.socket, message_store).serve_forever()
+    except KeyboardInterrupt:
+        print("\n[BUS] Stopped.")
+    finally:
+        if message_store is not None:
+            message_store.close()
+
+if __name__ == "__main__":
+    main()
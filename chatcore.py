@@ -0,0 +1,254 @@
+# chatcore.py
+"""The chat itself, independent of how clients are connected.
+
+server.py (TCP) and app.py (Socket.IO) are transports over one ChatCore:
+they turn bytes and socket events into calls here and render the Events
+it hands back. Running both on one core (python3 app.py with
+CHAT_TCP_PORT set) bridges them: CLI and browser users see each other's
+messages, presence and DMs, and a kick or suspension applies everywhere.
+
+    core = ChatCore()
+    core.connect(session)            # name check and kick list
+    core.enter(session, GENERAL)     # room presence, announces the join
+    core.post(session, GENERAL, "hi", "12:00:00")
+    core.send_dm(session, "bob", "psst", "12:00:01")
+    core.leave(session); core.disconnect(session)
+
+A session is any object with .sock (a hashable key), .name and
+.transport; the core sets .member_id on it. Transports subclass
+Transport.
+"""
+import itertools
+import threading
+
+import bus
+from registry import ClientRegistry
+
+GENERAL = bus.GENERAL
+
+# Event kinds
+MESSAGE = 'message'  # A chat message in a room
+JOINED = 'joined'    # A user's first connection entered a room
+LEFT = 'left'        # A user's last connection left a room
+DM = 'dm'            # A direct message
+
+class Event:
+    """Something to show to a room's members (or to the two ends of a DM).
+
+    data is the message as it is stored and replayed (with its 'seq' or
+    DM 'id'); transports that want another rendering can keep it in
+    encoded(), so each one is built once however many members get it.
+    """
+    __slots__ = ('kind', 'room', 'sender', 'text', 'timestamp', 'data', 'to', 'version', 'quiet', '_encoded')
+
+    def __init__(self, kind, room, sender, text=None, timestamp=None, data=None, to=None,
+                 version=None, quiet=False):
+        self.kind = kind
+        self.room = room
+        self.sender = sender  # Username; the user joining or leaving for JOINED/LEFT
+        self.text = text
+        self.timestamp = timestamp
+        self.data = data
+        self.to = to  # DM recipient
+        self.version = version  # Room presence version of a JOINED/LEFT
+        self.quiet = quiet  # Update presence, but don't announce it
+        self._encoded = {}
+
+    def encoded(self, key, build):
+        """build(self), computed once per key and shared by every recipient."""
+        value = self._encoded.get(key)
+        if value is None:
+            value = self._encoded[key] = build(self)
+        return value
+
+class Remote:
+    """A user connected to another process on the same message bus.
+
+    Only frontends that can reach other processes themselves use a bus
+    (app.py's workers relay emits through it), so they are reached through
+    the sender's transport.
+    """
+    __slots__ = ('sock', 'name', 'transport', 'member_id')
+
+    def __init__(self, name, transport):
+        self.sock = None
+        self.name = name
+        self.transport = transport
+        self.member_id = None
+
+class Transport:
+    """A frontend. The core calls these, possibly from another frontend's threads."""
+    name = 'transport'
+
+    def deliver(self, event, sessions, exclude=None):
+        """Show a room event to this transport's sessions in the room (except `exclude`)."""
+        raise NotImplementedError
+
+    def deliver_dm(self, event, session, echo):
+        """Show a DM to its recipient, or with echo=True to its sender."""
+        raise NotImplementedError
+
+    def notify(self, session, text, error=False):
+        """A notice from the server to one user."""
+
+    def disconnect(self, session, kicked=False):
+        """Close a user's connections (the transport calls back leave()/disconnect())."""
+
+class ChatCore:
+    """Users, rooms, presence, history and DMs for every transport.
+
+    The registry (names unique across transports, kicked and suspended
+    lists) is shared by all frontends. Presence, room sequencing and DM
+    history go through a bus (bus.LocalBus unless one is given), general
+    chat history into chat_history (a history.ChatHistory) when there is
+    one, and public messages and DMs into search_index (a
+    searchindex.SearchIndex) when there is one. Fan-out uses a room -> transport -> sessions index, replaced
+    copy-on-write like the registry's members, so publish() takes no
+    lock and costs one deliver() per transport plus what that transport
+    does per member.
+    """
+
+    def __init__(self, chat_bus=None, chat_history=None, lock=None, search_index=None):
+        self.bus = chat_bus if chat_bus is not None else bus.LocalBus()
+        self.history = chat_history
+        self.search = search_index
+        self.registry = ClientRegistry(lock)
+        self._rooms = {}  # {room: {transport: tuple of sessions}}; inner dicts are replaced, never mutated
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    # Connections
+
+    def connect(self, session):
+        """Register a user. Returns False if the name is taken or kicked."""
+        if self.registry.is_kicked(session.name):
+            return False
+        session.member_id = f"{session.transport.name}:{next(self._ids)}"
+        return self.registry.add(session)
+
+    def disconnect(self, session):
+        """Unregister a user and take them out of every room's fan-out.
+
+        Returns False if they were already gone, so cleanup runs once.
+        """
+        if self.registry.remove(session.sock) is None:
+            return False
+        with self._lock:
+            for room in [room for room, members in self._rooms.items() if session in members.get(session.transport, ())]:
+                self._index(room, session, False)
+        return True
+
+    def members(self, room, transport):
+        """The transport's sessions in a room."""
+        return self._rooms.get(room, {}).get(transport, ())
+
+    def _index(self, room, session, present):
+        """Add or remove a session in a room's fan-out. Caller holds _lock."""
+        members = dict(self._rooms.get(room, {}))
+        sessions = members.get(session.transport, ())
+        if present and session not in sessions:
+            members[session.transport] = sessions + (session,)
+        elif not present and session in sessions:
+            sessions = tuple(s for s in sessions if s is not session)
+            if sessions:
+                members[session.transport] = sessions
+            else:
+                del members[session.transport]
+        if members:
+            self._rooms[room] = members
+        else:
+            self._rooms.pop(room, None)
+
+    # Rooms and presence
+
+    def enter(self, session, room=GENERAL, presence_id=None, create=True, quiet=False):
+        """Put a connection in a room; presence_id tells apart connections of one user.
+
+        Returns whether the user is new to the room (and was announced),
+        or None if the room does not exist and create is False.
+        """
+        joined = self.bus.join(presence_id or session.member_id, session.name, room, create)
+        if joined is None:
+            return None
+        added, version = joined
+        if added:
+            with self._lock:
+                self._index(room, session, True)
+            self.publish(Event(JOINED, room, session.name, version=version, quiet=quiet), exclude=session)
+        return added
+
+    def exit(self, session, room, presence_id=None, quiet=False):
+        """Take a connection out of a room. Returns whether the user left it."""
+        username, removed, version = self.bus.leave_room(room, presence_id or session.member_id)
+        if removed:
+            self._left(session, room, version, quiet)
+        return removed
+
+    def leave(self, session, presence_id=None, quiet=False):
+        """Take a connection out of every room it is in."""
+        for room, _, removed, version in self.bus.leave(presence_id or session.member_id):
+            if removed:
+                self._left(session, room, version, quiet)
+
+    def _left(self, session, room, version, quiet):
+        with self._lock:
+            self._index(room, session, False)
+        self.publish(Event(LEFT, room, session.name, version=version, quiet=quiet))
+
+    def publish(self, event, exclude=None):
+        for transport, sessions in self._rooms.get(event.room, {}).items():
+            transport.deliver(event, sessions, exclude)
+
+    # Messages
+
+    def post(self, session, room, text, timestamp):
+        """Send a chat message to a room; returns the Event."""
+        data = {
+            'room': room,
+            'username': session.name,
+            'message': text,
+            'timestamp': timestamp,
+            'is_private': False
+        }
+        if room == GENERAL and self.history is not None:
+            self.history.append(timestamp, 'message', f"{session.name}: {text}")
+        else:
+            self.bus.append_message(room, data)
+        data = self.bus.sequence(room, 'new_message', data)
+        if self.search is not None:
+            self.search.add(session.name, text, room=room)
+        event = Event(MESSAGE, room, session.name, text, timestamp, data)
+        self.publish(event)
+        return event
+
+    def send_dm(self, session, recipient_name, text, timestamp):
+        """Send a DM to a connected user; returns the Event, or None if they are not here."""
+        recipient = self.registry.find(recipient_name, exact=True)
+        if recipient is None and self.bus.sid_for(recipient_name) is not None:
+            recipient = Remote(recipient_name, session.transport)
+        if recipient is None or recipient is session:
+            return None
+        data = self.bus.append_dm(session.name, recipient.name, {
+            'sender': session.name,
+            'message': text,
+            'timestamp': timestamp,
+            'is_private': True
+        })
+        if self.search is not None:
+            self.search.add(session.name, text, to=recipient.name)
+        event = Event(DM, None, session.name, text, timestamp, data, to=recipient.name)
+        recipient.transport.deliver_dm(event, recipient, echo=False)
+        session.transport.deliver_dm(event, session, echo=True)
+        return event
+
+    # Moderation
+
+    def kick(self, session, addr=None):
+        """Disconnect a user and keep them out until revived."""
+        self.registry.kick(session.name, addr)
+        self.registry.unsuspend(session.name)
+        session.transport.notify(session, "You have been kicked by the server admin.", error=True)
+        session.transport.disconnect(session, kicked=True)
+
+    def is_suspended(self, name):
+        return self.registry.is_suspended(name)
@@ -0,0 +1,117 @@
+# chatlog.py
+"""Leveled, structured logging for app.py.
+
+Log calls only put the record on a queue; a listener thread formats it
+and writes it out, so no request waits on stdout. Events carry their
+fields separately from the message and are rendered as key=value text
+or as JSON lines.
+
+Hot paths (one event per chat message) should check the level first
+and go through a Sampler:
+
+    if msg_log.isEnabledFor(logging.DEBUG) and sample():
+        chatlog.event(msg_log, logging.DEBUG, "message", sender=name)
+
+At the default INFO level that is one cached level check per message
+and nothing is formatted.
+
+Configured from the environment:
+    CHAT_LOG_LEVEL   DEBUG, INFO (default), WARNING, ERROR
+    CHAT_LOG_FORMAT  text (default) or json
+    CHAT_LOG_SAMPLE  log 1 in N hot-path events (default 100; 1 logs all)
+"""
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+DEFAULT_LEVEL = 'INFO'
+DEFAULT_FORMAT = 'text'
+DEFAULT_SAMPLE = 100
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queues the record as is; the listener thread does all formatting.
+
+    The stock QueueHandler formats in the caller so records can cross
+    process boundaries; ours never leave the process.
+    """
+
+    def prepare(self, record):
+        return record
+
+class TextFormatter(logging.Formatter):
+    """2024-01-01 12:00:00 INFO chat.app login user=alice ip=1.2.3.4"""
+
+    def format(self, record):
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.created))
+        line = f"{stamp} {record.levelname} {record.name} {record.getMessage()}"
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += " " + " ".join(f"{key}={_text_value(value)}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+def _text_value(value):
+    text = str(value)
+    return json.dumps(text) if not text or any(c in text for c in ' "=') else text
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record):
+        entry = {'ts': round(record.created, 3), 'level': record.levelname,
+                 'logger': record.name, 'event': record.getMessage()}
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+FORMATTERS = {'text': TextFormatter, 'json': JsonFormatter}
+
+class Sampler:
+    """Callable that returns True once every `every` calls."""
+
+    def __init__(self, every=DEFAULT_SAMPLE):
+        self.every = max(1, int(every))
+        self._count = itertools.count()
+
+    def __call__(self):
+        return next(self._count) % self.every == 0
+
+def get_logger(name):
+    return logging.getLogger('chat.' + name)
+
+def event(logger, level, name, **fields):
+    """Log an event with structured fields (no-op below the logger's level)."""
+    if logger.isEnabledFor(level):
+        logger.log(level, name, extra={'fields': fields})
+
+def setup(level=None, fmt=None, stream=None):
+    """Route the 'chat' loggers through a queue to a background writer.
+
+    Returns the QueueListener; call .stop() to flush it at exit.
+    """
+    level = (level or os.environ.get('CHAT_LOG_LEVEL') or DEFAULT_LEVEL).upper()
+    fmt = (fmt or os.environ.get('CHAT_LOG_FORMAT') or DEFAULT_FORMAT).lower()
+    if fmt not in FORMATTERS:
+        raise ValueError(f"Unknown log format '{fmt}' (use text or json)")
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(FORMATTERS[fmt]())
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=False)
+    listener.start()
+
+    root = logging.getLogger('chat')
+    root.handlers[:] = [_QueueHandler(records)]
+    root.setLevel(level)
+    root.propagate = False
+    return listener
+
+def sample_every():
+    return int(os.environ.get('CHAT_LOG_SAMPLE') or DEFAULT_SAMPLE)
@@ -1,13 +1,27 @@
 # client.py
+import collections
+import functools
+import itertools
+import re
 import socket
 import threading
 import sys
 import os
 import time
 import select
+import clienthistory
+import protocol
+import store
 
 DEFAULT_HOST = "127.0.0.1"
 DEFAULT_PORT = 5000
+NEGOTIATE_TIMEOUT = 3.0  # Seconds to wait for the server to accept the framed protocol
+REPLY_TIMEOUT = 5.0  # Seconds to wait for the reply to a command
+DM_FAILED = "[SERVER] Failed to send private message"
+FRAME_INTERVAL = 1 / 30  # Seconds between terminal writes
+MAX_BACKLOG = 500  # Lines waiting for the next frame; older ones collapse into "N messages skipped"
+# Received lines are kept here for /history and /find, one file per user name ('' keeps none)
+HISTORY_DIR = os.environ.get('CHAT_CLIENT_HISTORY', clienthistory.HISTORY_DIR)
 
 # ANSI color codes
 COLORS = {
@@ -23,81 +37,242 @@ def color_text(text, color):
     """Wrap text in ANSI color codes."""
     return f"{COLORS[color]}{text}{COLORS['RESET']}"
 
+# Patterns for format_message(), compiled once
+PM_TAG = re.compile(r'\[PM (?:from|to)')
+COMMAND = re.compile(r'/q|/save', re.IGNORECASE)  # '/quit' starts with '/q'
+CHAT_LINE = re.compile(r'(.*?)\] (.*?): (.*)', re.DOTALL)  # "[timestamp] sender: content"
+
+@functools.lru_cache(maxsize=8)
+def mention_pattern(client_name):
+    return re.compile(f"@{re.escape(client_name)}|@everyone")
+
 def format_message(message, client_name):
     """Format message with appropriate colors."""
     # Server messages in green
     if '[SERVER]' in message:
         return f"\033[92m{message}\033[0m"
+    
+    line = CHAT_LINE.match(message)
         
     # Private messages - format sender/receiver info
-    if '[PM from' in message or '[PM to' in message:
-        # Split the message into parts
-        parts = message.split('] ', 1)
-        if len(parts) == 2:
-            timestamp, rest = parts
-            if ': ' in rest:
-                # Color the timestamp and sender info
-                colored_timestamp = f"\033[90m{timestamp}]\033[0m"
-                info, content = rest.split(': ', 1)
-                colored_info = f"\033[95m{info}\033[0m"
-                return f"{colored_timestamp} {colored_info}: {content}"
+    if PM_TAG.search(message):
+        if line is not None:
+            # Color the timestamp and sender info
+            timestamp, info, content = line.groups()
+            return f"\033[90m{timestamp}]\033[0m \033[95m{info}\033[0m: {content}"
         return message
         
     # Commands in blue
-    if any(cmd in message.lower() for cmd in ['/q', '/quit', '/save']):
+    if COMMAND.search(message):
         return f"\033[94m{message}\033[0m"
     
-    # Check for mentions (only check if the message is from someone else)
-    is_mentioned = False
-    if ': ' in message:
-        sender = message.split('] ')[1].split(':')[0] if '] ' in message else ''
-        if sender != client_name:  # Only check mentions in messages from others
-            is_mentioned = (f"@{client_name}" in message or "@everyone" in message) and client_name != "SERVER"
+    if line is None:
+        return message
+    timestamp, sender, content = line.groups()
+    colored_timestamp = f"\033[90m{timestamp}]\033[0m"  # Dark gray timestamp
     
-    # Extract the sender's name (part after timestamp and before ':')
-    parts = message.split('] ', 1)
-    if len(parts) == 2:
-        timestamp, rest = parts
-        if ': ' in rest:
-            sender, content = rest.split(': ', 1)
-            # Color the timestamp
-            colored_timestamp = f"\033[90m{timestamp}]\033[0m"  # Dark gray timestamp
-            
-            # If this message is from the current user (sender's view)
-            if sender == client_name:
-                # Show own name in red
-                colored_sender = f"\033[91m{sender}\033[0m"
-                return f"{colored_timestamp} {colored_sender}: {content}"
-            
-            # For messages from others
-            colored_sender = f"\033[93m{sender}\033[0m"  # Other senders in yellow
-            
-            # If this message mentions the current user, highlight the mention
-            if is_mentioned:
-                # Highlight the mention in the content
-                content = content.replace(f"@{client_name}", f"\033[1;93m@{client_name}\033[0m")
-                return f"{colored_timestamp} {colored_sender}: \033[93m{content}\033[0m"
-            
-            # Regular received message (white text)
-            return f"{colored_timestamp} {colored_sender}: {content}"
+    # If this message is from the current user (sender's view)
+    if sender == client_name:
+        # Show own name in red
+        return f"{colored_timestamp} \033[91m{sender}\033[0m: {content}"
+    
+    # For messages from others
+    colored_sender = f"\033[93m{sender}\033[0m"  # Other senders in yellow
     
-    return message
+    # If this message mentions the current user, highlight the mention
+    if client_name != "SERVER" and mention_pattern(client_name).search(message):
+        content = content.replace(f"@{client_name}", f"\033[1;93m@{client_name}\033[0m")
+        return f"{colored_timestamp} {colored_sender}: \033[93m{content}\033[0m"
+    
+    # Regular received message (white text)
+    return f"{colored_timestamp} {colored_sender}: {content}"
+
+class Renderer:
+    """Draws incoming lines on the terminal, at most once per frame.
+
+    The reader thread only queues lines with show(); a drawing thread
+    formats whatever arrived since the last frame and writes it, with the
+    prompt, in one write() every `interval` seconds. When more than
+    max_backlog lines are waiting the oldest are dropped unformatted and
+    shown as one "N messages skipped" line, so a flood costs one screenful
+    per frame and never backs up the socket. Lines from the server are
+    also appended to `history` (a clienthistory.ClientHistory), if any.
+    """
+
+    def __init__(self, name, out=None, interval=FRAME_INTERVAL, max_backlog=MAX_BACKLOG, history=None):
+        self.name = name
+        self.history = history
+        self.prompt = f"{name}: "  # Redrawn after every frame
+        self.out = out or sys.stdout
+        self.interval = interval
+        self.max_backlog = max_backlog
+        self._lines = collections.deque()  # (text, formatted)
+        self._skipped = 0
+        self._lock = threading.Lock()
+        self._draw_lock = threading.Lock()
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def show(self, text, formatted=False):
+        """Queue a line for the next frame; format_message() runs when it is drawn.
+
+        Pass formatted=True for the client's own output; it is shown as
+        is and not kept in the history.
+        """
+        if not formatted and self.history is not None:
+            self.history.append(text)
+        with self._lock:
+            self._lines.append((text, formatted))
+            if len(self._lines) > self.max_backlog:
+                self._lines.popleft()
+                self._skipped += 1
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            started = time.monotonic()
+            self.flush()
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def flush(self):
+        """Draw everything queued so far now."""
+        with self._lock:
+            lines, self._lines = self._lines, collections.deque()
+            skipped, self._skipped = self._skipped, 0
+        if not lines and not skipped:
+            return
+        parts = [f"\033[90m... {skipped} messages skipped ...\033[0m"] if skipped else []
+        parts.extend(text if formatted else format_message(text, self.name) for text, formatted in lines)
+        with self._draw_lock:
+            self.out.write("\r\033[K" + "\n".join(parts) + "\n" + self.prompt)
+            self.out.flush()
+
+class Request:
+    """A command sent with ServerConnection.request(), until its reply arrives."""
+    __slots__ = ('on_reply', 'reply', '_done')
+
+    def __init__(self, on_reply=None):
+        self.on_reply = on_reply  # Called with the reply text, on the reader thread
+        self.reply = None
+        self._done = threading.Event()
+
+    def resolve(self, text):
+        self.reply = text
+        self._done.set()
+        if self.on_reply is not None:
+            self.on_reply(text)
+
+    def wait(self, timeout=None):
+        """The reply text, or None if it did not come within timeout."""
+        return self.reply if self._done.wait(timeout) else None
+
+class ServerConnection:
+    """Socket to the chat server plus the protocol negotiated at connect time.
 
-def handle_server_messages(sock, name):
-    """Handle incoming messages from the server with DM support."""
+    Only the receiving thread reads the socket. Commands that want an
+    answer go through request(), and the reader hands each reply to its
+    Request by id (dispatch()), so callers wait on an Event instead of
+    reading the socket themselves, and chat lines that arrive meanwhile
+    are still shown.
+    """
+
+    def __init__(self, sock, decoder):
+        self.sock = sock
+        self.decoder = decoder
+        self.framed = decoder.framed
+        self._ids = itertools.count(1)
+        self._pending = {}  # {request id: Request}
+        self._waiting = collections.deque()  # Text protocol: Requests answered by the next message, oldest first
+        self._lock = threading.Lock()
+
+    def encode(self, text):
+        """Bytes for one message or command in the negotiated protocol."""
+        if self.framed:
+            return protocol.encode_text(text)
+        return (text + '\n').encode('utf-8')
+
+    def send(self, text):
+        """Send one message or command to the server."""
+        self.sock.sendall(self.encode(text))
+
+    def request(self, text, on_reply=None):
+        """Send a command whose reply goes to the caller rather than the screen.
+
+        Returns a Request to wait() on; with on_reply the caller need not
+        wait at all, so requests can be pipelined. The text protocol has
+        no ids: there the next message received answers the oldest
+        waiting request, and requests with on_reply get no reply (it is
+        shown like any other line).
+        """
+        pending = Request(on_reply)
+        with self._lock:
+            if self.framed:
+                request_id = next(self._ids)
+                self._pending[request_id] = pending
+                data = protocol.encode_tagged(request_id, text, protocol.MSG_REQUEST)
+            else:
+                if on_reply is None:
+                    self._waiting.append(pending)
+                data = self.encode(text)
+        self.sock.sendall(data)
+        return pending
+
+    def receive(self):
+        """Return the next complete (msg_type, text) messages, blocking as needed; None on EOF."""
+        messages = list(self.decoder)
+        while not messages:
+            if not self.decoder.fill(self.sock):
+                return None
+            messages = list(self.decoder)
+        return messages
+
+    def dispatch(self, messages):
+        """Hand replies in received messages to their requests; returns the lines to show."""
+        lines = []
+        for msg_type, text in messages:
+            if msg_type == protocol.MSG_REPLY:
+                request_id, text = protocol.parse_tagged(text)
+                with self._lock:
+                    pending = self._pending.pop(request_id, None)
+                if pending is not None:
+                    pending.resolve(text)
+                elif text:
+                    lines.append(text)
+            elif msg_type == protocol.MSG_TEXT:
+                lines.append(text)
+        if lines and self._waiting:
+            # Text protocol: everything that arrived together is the answer
+            with self._lock:
+                pending = self._waiting.popleft() if self._waiting else None
+            if pending is not None:
+                pending.resolve('\n'.join(lines))
+                return []
+        return lines
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def close(self):
+        self.sock.close()
+
+def handle_server_messages(conn, renderer):
+    """Handle incoming messages from the server with DM support.
+
+    Lines go to the renderer, so a slow terminal never holds up reading.
+    """
     shutdown_flag = threading.Event()
     while not shutdown_flag.is_set():
         try:
-            data = sock.recv(4096)
-            if not data:
+            messages = conn.receive()
+            if messages is None:
+                renderer.flush()
                 print("\n\033[91m[!] Disconnected from server.\033[0m")
                 shutdown_flag.set()
                 os._exit(1)  # Exit the entire program
                 
-            # Split multiple messages (in case they were buffered together)
-            messages = data.decode('utf-8').split('\n')
-            
-            for message in messages:
+            for message in conn.dispatch(messages):
                 if not message.strip():
                     continue
                     
@@ -105,13 +280,11 @@ def handle_server_messages(sock, name):
                 
                 # Check for server shutdown message
                 if "shutting down" in message.lower() or "server is shutting down" in message.lower():
+                    renderer.flush()
                     print("\n\033[91m[!] Server is shutting down. Disconnecting...\033[0m")
                     shutdown_flag.set()
                     os._exit(0)
                     
-                # Format the message with colors
-                formatted_message = format_message(message, name)
-                
                 # Handle different message types
                 if message.startswith("DM_FROM:"):
                     # Handle incoming DM
@@ -119,54 +292,47 @@ def handle_server_messages(sock, name):
                     if len(parts) == 3:
                         sender = parts[1]
                         dm_content = parts[2]
-                        print(f"\n{color_text('[DM from ', 'LIGHT_MAGENTA')}{color_text(sender, 'LIGHT_CYAN')}{color_text(']: ', 'LIGHT_MAGENTA')}{dm_content}")
+                        renderer.show(f"{color_text('[DM from ', 'LIGHT_MAGENTA')}{color_text(sender, 'LIGHT_CYAN')}{color_text(']: ', 'LIGHT_MAGENTA')}{dm_content}", formatted=True)
                     else:
-                        print(f"\n{formatted_message}")
+                        renderer.show(message)
                 elif message == "USER_LEFT":
                     continue  # Handled elsewhere
                 else:
-                    # Print the formatted message with proper prompt
-                    print(f"\r{formatted_message}")
-                    print(f"{name}: ", end='', flush=True)
+                    # Formatted and drawn with the prompt in the next frame
+                    renderer.show(message)
             
         except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
             if not shutdown_flag.is_set():
+                renderer.flush()
                 print("\n\033[91m[!] Lost connection to server. Please restart the client.\033[0m")
                 shutdown_flag.set()
                 os._exit(1)
             break
         except Exception as e:
             if not shutdown_flag.is_set():
+                renderer.flush()
                 print(f"\n\033[91m[!] Error: {e}. Disconnected from server.\033[0m")
                 shutdown_flag.set()
                 os._exit(1)
             break
 
-def handle_private_message(sock):
-    """Handle private message flow with back command support"""
+def handle_private_message(conn, renderer):
+    """Handle private message flow with back command support.
+
+    Replies come through the reader thread (conn.request()), so this never
+    reads the socket itself and no chat traffic is lost meanwhile.
+    """
     try:
         # Request the user list from the server
         try:
-            sock.sendall("/list_users\n".encode('utf-8'))
+            users_list = conn.request("/list_users").wait(REPLY_TIMEOUT)
         except Exception as e:
             print(f"\nError requesting user list: {e}")
             return
-            
-        # Get list of users from server
-        users_list = ''
-        sock.settimeout(5.0)
-        try:
-            data = sock.recv(4096).decode('utf-8')
-            if not data:
-                print("\nConnection to server lost.")
-                return
-            users_list = data.strip()
-        except socket.timeout:
+        if users_list is None:
             print("\nTimed out waiting for user list.")
             return
-        except Exception as e:
-            print(f"\nError getting user list: {e}")
-            return
+        users_list = users_list.strip()
         
         if not users_list:
             print("\nNo other users available for DM.")
@@ -195,74 +361,22 @@ def handle_private_message(sock):
                     
                 # Send DM command with selected user
                 try:
-                    sock.sendall(f"/dm {selection}\n".encode('utf-8'))
-                except:
+                    response = conn.request(f"/dm {selection}").wait(REPLY_TIMEOUT)
+                except Exception:
                     print("\nError communicating with server.")
                     return
-                
-                # Get server response
-                try:
-                    sock.settimeout(5.0)
-                    response = ''
-                    while not response:
-                        data = sock.recv(4096).decode('utf-8')
-                        if data:
-                            response = data.strip()
-                            
-                    if 'invalid' in response.lower():
-                        print(f"\n{response}")
-                        continue
-                        
-                    # If we get here, we're in DM mode
-                    print(f"\n{'-'*40}\nDM Mode (type /back to exit DM)\n{'-'*40}")
-                    
-                    while True:
-                        try:
-                            # Get message content
-                            message = input("You: ").strip()
-                            
-                            # Handle back command in DM mode
-                            if message.lower() == '/back':
-                                print("\nExited DM mode.")
-                                return
-                                
-                            # Send message to server
-                            try:
-                                sock.sendall(f"{message}\n".encode('utf-8'))
-                            except:
-                                print("\nError sending message. Connection lost.")
-                                return
-                            
-                            # Wait for message confirmation
-                            try:
-                                sock.settimeout(5.0)
-                                data = sock.recv(4096).decode('utf-8')
-                                if not data:
-                                    print("\nConnection to server lost.")
-                                    return
-                                if data.strip() == "USER_LEFT":
-                                    print("\nRecipient has left the chat. Exiting DM mode.")
-                                    return
-                            except socket.timeout:
-                                print("\nNo response from server. Message may not have been delivered.")
-                                continue
-                            except Exception as e:
-                                print(f"\nError: {e}")
-                                return
-                                
-                        except KeyboardInterrupt:
-                            print("\nUse /back to exit DM mode or /q to quit.")
-                            continue
-                        except Exception as e:
-                            print(f"\nError in DM: {e}")
-                            return
-                            
-                except socket.timeout:
+                if response is None:
                     print("\nTimed out waiting for server response.")
                     return
-                except Exception as e:
-                    print(f"\nError: {e}")
-                    return
+                response = response.strip()
+                if 'DM session started' not in response:
+                    print(f"\n{response}")
+                    continue
+                    
+                # If we get here, we're in DM mode
+                print(f"\n{'-'*40}\nDM Mode (type /back to exit DM)\n{'-'*40}")
+                send_direct_messages(conn, renderer)
+                return
                     
             except KeyboardInterrupt:
                 print("\nUse /back to cancel or /q to quit.")
@@ -273,26 +387,122 @@ def handle_private_message(sock):
                 
     except Exception as e:
         print(f"\n{color_text('Error in private message:', 'LIGHT_RED')} {e}")
+
+def send_direct_messages(conn, renderer):
+    """DM mode: every line typed goes to the chosen user until /back.
+
+    DMs are pipelined: each is sent as a request and the input loop goes
+    straight back to the prompt. Its confirmation ("[PM to ...]") or the
+    server's failure notice arrives later through on_reply.
+    """
+    recipient_left = threading.Event()
+
+    def on_reply(text):
+        if not text or recipient_left.is_set():
+            return  # Later DMs of the same burst fail the same way
+        if text.startswith(DM_FAILED):
+            recipient_left.set()
+            renderer.show("Recipient has left the chat. Press Enter to exit DM mode.", formatted=True)
+            return
+        renderer.show(text)
+
+    renderer.prompt = "You: "
+    try:
+        dm_loop(conn, on_reply, recipient_left)
     finally:
-        # Make sure to clear any pending messages
-        sock.settimeout(0.1)
+        renderer.prompt = f"{renderer.name}: "
+
+def dm_loop(conn, on_reply, recipient_left):
+    """Read DM lines until /back (or the recipient has left)."""
+    while True:
         try:
-            while True:
-                data = sock.recv(4096)
-                if not data:
-                    break
-        except:
-            pass
-        sock.settimeout(None)
+            # Get message content
+            message = input("You: ").strip()
+            if recipient_left.is_set():
+                leave_dm(conn)
+                return
+            if not message:
+                continue
+            
+            # Handle back command in DM mode
+            if message.lower() == '/back':
+                leave_dm(conn)
+                return
+                
+            # Send message to server; don't wait for its confirmation
+            try:
+                conn.request(message, on_reply=on_reply)
+            except Exception:
+                print("\nError sending message. Connection lost.")
+                return
+                
+        except KeyboardInterrupt:
+            print("\nUse /back to exit DM mode or /q to quit.")
+            continue
+        except Exception as e:
+            print(f"\nError in DM: {e}")
+            return
+
+def leave_dm(conn):
+    """Send /back and wait until the server has left DM mode too.
+
+    Until its reply arrives, anything typed would still go out as a DM.
+    """
+    try:
+        if conn.request('/back').wait(REPLY_TIMEOUT) is None:
+            print("\nThe server did not confirm leaving DM mode; type /back again if your messages stay private.")
+            return
+    except Exception:
+        print("\nError sending message. Connection lost.")
+        return
+    print("\nExited DM mode.")
+
+def show_history(renderer, message):
+    """Answer /history [n] and /find <text> from the local history."""
+    history = renderer.history
+    if history is None:
+        renderer.show("\033[91m[HISTORY] No local history (CHAT_CLIENT_HISTORY is off or in use).\033[0m",
+                      formatted=True)
+        return
+    command, _, arg = message.partition(' ')
+    arg = arg.strip()
+    started = time.perf_counter()
+    if command.lower() == '/find':
+        if not arg:
+            renderer.show("\033[91m[HISTORY] Usage: /find <text>\033[0m", formatted=True)
+            return
+        rows = history.find(arg)
+        title = f"{len(rows)} newest lines matching '{arg}'" if rows else f"No lines match '{arg}'"
+    else:
+        if arg and not arg.isdigit():
+            renderer.show("\033[91m[HISTORY] Usage: /history [n]\033[0m", formatted=True)
+            return
+        rows = history.recent(int(arg) if arg else clienthistory.DEFAULT_LINES)
+        title = f"Last {len(rows)} lines"
+    elapsed = time.perf_counter() - started
+    renderer.show(f"\033[94m[HISTORY] {title} ({elapsed * 1e3:.1f} ms)\033[0m", formatted=True)
+    for created, text in rows:
+        day = time.strftime('%Y-%m-%d', time.localtime(created))
+        renderer.show(f"\033[90m{day}\033[0m {format_message(text, renderer.name)}", formatted=True)
+
+def open_history(name, host, port):
+    """The local history of this user on this server, or None if it is off or cannot be opened."""
+    if not HISTORY_DIR:
+        return None
+    try:
+        return clienthistory.ClientHistory(clienthistory.history_path(name, HISTORY_DIR), f"{host}:{port}")
+    except store.StoreError as e:
+        print(f"Local history is off: {e}")
+        return None
 
-def handle_user_input(sock, name):
+def handle_user_input(conn, name, renderer):
     """Handle user input and send messages to the server."""
     shutdown_flag = threading.Event()
     
-    def send_safe(sock, message):
+    def send_safe(conn, message):
         """Safely send a message to the server"""
         try:
-            sock.sendall((message + '\n').encode('utf-8'))
+            conn.send(message)
             return True
         except Exception as e:
             print(f"\nError sending message: {e}")
@@ -310,18 +520,23 @@ def handle_user_input(sock, name):
                     
                 # Handle quit commands
                 if message.lower() in ('/q', '/quit'):
-                    if send_safe(sock, message):
+                    if send_safe(conn, message):
                         print("Disconnecting...")
                     shutdown_flag.set()
                     break
                     
+                # Answered locally, never sent to the server
+                if message.split(' ', 1)[0].lower() in ('/history', '/find'):
+                    show_history(renderer, message)
+                    continue
+                    
                 # Handle DM command
                 if message.lower() == '/dm':
-                    handle_private_message(sock)
+                    handle_private_message(conn, renderer)
                     continue
                     
                 # Send regular message
-                if not send_safe(sock, message):
+                if not send_safe(conn, message):
                     print("Failed to send message. Connection may be lost.")
                     shutdown_flag.set()
                     break
@@ -336,13 +551,42 @@ def handle_user_input(sock, name):
     finally:
         # Only close the socket and exit when we're completely done
         try:
-            sock.close()
+            conn.close()
         except:
             pass
 
+def negotiate_framed(sock, name):
+    """Offer the framed protocol; returns a FrameDecoder if the server accepts.
+
+    Returns None when the server only speaks the text protocol: it rejects
+    the handshake magic and then closes or ignores the connection.
+    """
+    sock.sendall(protocol.encode_handshake(name))
+    decoder = protocol.FrameDecoder()
+    previous_timeout = sock.gettimeout()
+    sock.settimeout(NEGOTIATE_TIMEOUT)
+    try:
+        while True:
+            if not decoder.fill(sock):
+                return None
+            for msg_type, _ in decoder:
+                if msg_type == protocol.MSG_HELLO:
+                    return decoder
+                raise protocol.ProtocolError("Expected a HELLO frame")
+    except socket.timeout:
+        return None
+    finally:
+        sock.settimeout(previous_timeout)
+
 def connect_to_server(host, port, name, retries=3, delay=2):
-    """Attempt to connect to the server with retries"""
-    for attempt in range(retries):
+    """Attempt to connect to the server with retries.
+
+    Prefers the framed protocol and falls back to the original text
+    protocol for older servers. Returns a ServerConnection or None.
+    """
+    framed = True
+    attempt = 0
+    while attempt < retries:
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
@@ -354,8 +598,20 @@ def connect_to_server(host, port, name, retries=3, delay=2):
             sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
             sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
             
-            # Send name first
             sock.settimeout(10.0)  # 10 second timeout for initial handshake
+            if framed:
+                try:
+                    decoder = negotiate_framed(sock, name)
+                except (ConnectionError, protocol.ProtocolError):
+                    decoder = None
+                if decoder is not None:
+                    return ServerConnection(sock, decoder)
+                # Older server: reconnect and use the text protocol
+                sock.close()
+                framed = False
+                continue
+
+            # Send name first
             sock.sendall(name.encode('utf-8'))
             
             # Verify connection is still alive
@@ -369,7 +625,7 @@ def connect_to_server(host, port, name, retries=3, delay=2):
             except (socket.timeout, BlockingIOError):
                 pass  # No data available is fine, connection is still alive
                 
-            return sock
+            return ServerConnection(sock, protocol.LineDecoder(partial=True))
             
         except socket.timeout:
             print(f"\rConnection attempt {attempt + 1}/{retries} timed out")
@@ -379,6 +635,7 @@ def connect_to_server(host, port, name, retries=3, delay=2):
             print(f"\rConnection attempt {attempt + 1}/{retries} failed: {e}")
             if attempt < retries - 1:
                 time.sleep(delay)
+        attempt += 1
     return None
 
 def main():
@@ -397,28 +654,32 @@ def main():
 
     # Connect to server with retries
     print(f"Connecting to {host}:{port}...")
-    sock = connect_to_server(host, port, name)
-    if not sock:
+    conn = connect_to_server(host, port, name)
+    if not conn:
         print("Failed to connect to server after several attempts. Please try again later.")
         sys.exit(1)
     
     print("Connected to server!")
-    sock.settimeout(None)  # Disable timeout after successful connection
+    conn.settimeout(None)  # Disable timeout after successful connection
 
+    history = open_history(name, host, port)
     try:
         # Start receiving thread
-        threading.Thread(target=handle_server_messages, args=(sock, name), daemon=True).start()
+        renderer = Renderer(name, history=history)
+        threading.Thread(target=handle_server_messages, args=(conn, renderer), daemon=True).start()
 
         # Start input handling in main thread
-        handle_user_input(sock, name)
+        handle_user_input(conn, name, renderer)
     except KeyboardInterrupt:
         print(color_text("\nDisconnecting...", 'LIGHT_BLUE'))
     finally:
         try:
-            sock.sendall("/quit".encode('utf-8'))
+            conn.send("/quit")
         except:
             pass
-        sock.close()
+        conn.close()
+        if history is not None:
+            history.close()
         print("Disconnected.")
 
 if __name__ == "__main__":
@@ -0,0 +1,124 @@
+# clienthistory.py
+"""Chat lines the CLI client has received, kept in a local SQLite file.
+
+client.py appends every line from the server and answers /history [n]
+and /find <text> from it without asking the server. Rows go through a
+store.MessageStore, so the reader thread never waits on the disk; lines
+are filed per server ('server:host:port') with ANSI colours stripped.
+
+/find uses an FTS5 index that a trigger fills as the store commits
+rows, so it costs the matches it returns rather than a scan of the log;
+SQLite builds without FTS5 fall back to a LIKE scan. Both commands read
+only the rows they show, however large the file grows.
+
+A message store belongs to one process, so each user name gets its own
+file, locked while a client has it open.
+"""
+import os
+import re
+import sqlite3
+import threading
+
+import store
+
+try:
+    import fcntl
+except ImportError:  # Windows: no lock, one client per name at a time is up to the user
+    fcntl = None
+
+HISTORY_DIR = os.path.join(os.path.expanduser('~'), '.dccn-chat')
+DEFAULT_LINES = 20  # /history without a count
+MAX_LINES = 200
+FIND_LIMIT = 50  # Newest matches shown by /find
+FLUSH_TIMEOUT = 1.0  # Seconds a query waits for lines still being written
+
+ANSI = re.compile(r'\033\[[0-9;]*m')
+
+def history_path(name, directory=HISTORY_DIR):
+    """The history file of a user name."""
+    return os.path.join(directory, re.sub(r'[^\w.-]', '_', name) + '.db')
+
+def fts_query(text):
+    """An FTS5 query matching lines with every word of text (each as a prefix)."""
+    return ' '.join('"' + word.replace('"', '""') + '"*' for word in text.split())
+
+class ClientHistory:
+    """Append-only local log of one server's chat lines, searchable by word."""
+
+    def __init__(self, path, server='', durability='off'):
+        self._lockfile = self._lock_file(path)
+        try:
+            self.store = store.MessageStore(path, durability)
+        except store.StoreError:
+            self._lockfile.close()
+            raise
+        self.channel = 'server:' + server
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.indexed = self._create_index()
+
+    @staticmethod
+    def _lock_file(path):
+        """Hold path + '.lock' for as long as the history is open (raises StoreError if taken)."""
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            lockfile = open(path + '.lock', 'w')
+        except OSError as e:
+            raise store.StoreError(f"Cannot open history {path}: {e}")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lockfile.close()
+                raise store.StoreError(f"History {path} is in use by another client")
+        return lockfile
+
+    def _create_index(self):
+        """Set up the FTS5 index (and fill it from older rows). False without FTS5."""
+        try:
+            with self._db:
+                new = self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'lines'").fetchone() is None
+                self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS lines USING fts5(text, content='')")
+                self._db.execute("CREATE TRIGGER IF NOT EXISTS lines_index AFTER INSERT ON messages BEGIN "
+                                 "INSERT INTO lines (rowid, text) VALUES (new.id, json_extract(new.body, '$')); END")
+                if new:
+                    self._db.execute("INSERT INTO lines (rowid, text) SELECT id, json_extract(body, '$') FROM messages")
+            return True
+        except sqlite3.OperationalError:
+            return False
+
+    def append(self, text):
+        """Queue a line as received from the server."""
+        self.store.append(self.channel, ANSI.sub('', text))
+
+    def _query(self, sql, args):
+        self.store.flush(FLUSH_TIMEOUT)  # Include what was just received
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        rows.reverse()
+        return rows
+
+    def recent(self, n=DEFAULT_LINES):
+        """The newest n lines as (unix time, text), oldest first."""
+        return self._query("SELECT created, json_extract(body, '$') FROM messages WHERE channel = ? "
+                           "ORDER BY id DESC LIMIT ?", (self.channel, max(1, min(n, MAX_LINES))))
+
+    def find(self, text, limit=FIND_LIMIT):
+        """The newest lines containing every word of text, as (unix time, text), oldest first."""
+        if not text.split():
+            return []
+        if self.indexed:
+            return self._query("SELECT m.created, json_extract(m.body, '$') FROM lines "
+                               "JOIN messages m ON m.id = lines.rowid "
+                               "WHERE lines MATCH ? AND m.channel = ? ORDER BY lines.rowid DESC LIMIT ?",
+                               (fts_query(text), self.channel, limit))
+        pattern = '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        return self._query("SELECT created, json_extract(body, '$') FROM messages WHERE channel = ? "
+                           "AND json_extract(body, '$') LIKE ? ESCAPE '\\' ORDER BY id DESC LIMIT ?",
+                           (self.channel, pattern, limit))
+
+    def close(self):
+        self.store.close()
+        with self._lock:
+            self._db.close()
+        self._lockfile.close()
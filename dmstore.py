@@ -0,0 +1,80 @@
+# dmstore.py
+import itertools
+import threading
+from collections import deque
+
+DEFAULT_MEMORY_LIMIT = 200  # Newest messages kept in memory per conversation
+DEFAULT_PAGE = 50
+MAX_PAGE = 200
+
+class DMStore:
+    """DM history paged by message id.
+
+    Each conversation keeps its newest memory_limit messages in memory.
+    With a store.MessageStore every message is also written there (in
+    the background), a conversation's window is reloaded from it the
+    first time it is used after a restart, and older pages are read back
+    from it; without one, messages past the limit are dropped. Every
+    message gets an increasing 'id', the cursor for paging back:
+
+        messages, has_more = dms.page(key)
+        older, has_more = dms.page(key, before=messages[0]['id'])
+    """
+
+    def __init__(self, store=None, memory_limit=DEFAULT_MEMORY_LIMIT, lock=None):
+        self.store = store
+        self.memory_limit = memory_limit
+        self._recent = {}  # {conversation key: deque of messages, oldest first}
+        self._lock = lock or threading.Lock()
+        self._ids = itertools.count(1)
+
+    def _window(self, key):
+        """The in-memory messages of a conversation. Caller holds _lock."""
+        recent = self._recent.get(key)
+        if recent is None:
+            recent = self._recent[key] = deque(maxlen=self.memory_limit)
+            if self.store is not None:
+                recent.extend(dict(message, id=message_id) for message_id, message
+                              in self.store.recent('dm:' + key, self.memory_limit))
+        return recent
+
+    def append(self, key, message):
+        """Store a message dict; returns a copy with its 'id' set."""
+        with self._lock:
+            # Load the window before writing: once the row is committed, a first
+            # load would read it back and the message would be in memory twice
+            recent = self._window(key)
+            if self.store is not None:
+                message_id = self.store.append('dm:' + key, message)
+            else:
+                message_id = next(self._ids)
+            message = dict(message, id=message_id)
+            recent.append(message)
+        return message
+
+    def page(self, key, before=None, limit=DEFAULT_PAGE):
+        """Up to limit messages older than id `before` (newest if None), oldest first.
+
+        Returns (messages, has_more).
+        """
+        limit = max(1, min(int(limit), MAX_PAGE))
+        with self._lock:
+            recent = self._window(key)
+            picked = []
+            older_in_memory = False
+            for message in reversed(recent):
+                if before is not None and message['id'] >= before:
+                    continue
+                if len(picked) == limit:
+                    older_in_memory = True
+                    break
+                picked.append(message)
+            # A window that never filled up holds the whole conversation
+            complete = len(recent) < self.memory_limit
+        picked.reverse()
+        if older_in_memory or complete or self.store is None:
+            return picked, older_in_memory
+        self.store.flush()  # Older rows may still be queued after a burst
+        below = picked[0]['id'] if picked else before
+        rows, has_more = self.store.page('dm:' + key, below, limit - len(picked))
+        return [dict(message, id=message_id) for message_id, message in rows] + picked, has_more
@@ -0,0 +1,169 @@
+# export.py
+import gzip
+import os
+import queue
+import re
+import threading
+import time
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:  # Optional: only needed for compress=zstd
+    zstandard = None
+
+DEFAULT_EXPORT_DIR = "chat_exports"
+CHUNK_BYTES = 64 * 1024  # Buffered output written per write() call
+PROGRESS_INTERVAL = 1.0  # Seconds between progress reports to the client
+COMPRESSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+SAVE_USAGE = "Usage: /save [sender=<name>] [from=HH:MM] [to=HH:MM] [compress=none|gzip|zstd]"
+
+class ExportError(Exception):
+    """An export request that cannot be carried out."""
+
+class ExportJob:
+    """One /save request: what to export, how, and who to tell."""
+
+    def __init__(self, requested_by, reply_to=None, sender=None, start=None, end=None, compression='none'):
+        self.requested_by = requested_by
+        self.reply_to = reply_to  # Opaque handle for notify(), e.g. the client's socket
+        self.sender = sender  # Only messages from this user (case-insensitive)
+        self.start = start    # Unix time bounds, inclusive
+        self.end = end
+        self.compression = compression
+
+    def matches(self, record):
+        if self.sender is not None:
+            sender = record.sender
+            if sender is None or sender.lower() != self.sender:
+                return False
+        if self.start is not None or self.end is not None:
+            if record.created is None:
+                return False
+            if self.start is not None and record.created < self.start:
+                return False
+            if self.end is not None and record.created > self.end:
+                return False
+        return True
+
+def _parse_clock(value, end_of_minute=False):
+    """HH:MM (24h) today, as Unix time."""
+    try:
+        clock = datetime.strptime(value, "%H:%M")
+    except ValueError:
+        raise ExportError(f"Invalid time '{value}', expected HH:MM")
+    moment = datetime.now().replace(hour=clock.hour, minute=clock.minute,
+                                    second=59 if end_of_minute else 0, microsecond=0)
+    return moment.timestamp()
+
+def parse_save_command(text, requested_by, reply_to=None, default_compression='none'):
+    """Build an ExportJob from a '/save key=value ...' command."""
+    job = ExportJob(requested_by, reply_to, compression=default_compression)
+    for arg in text.split()[1:]:
+        key, sep, value = arg.partition('=')
+        if not sep or not value:
+            raise ExportError(SAVE_USAGE)
+        key = key.lower()
+        if key == 'sender':
+            job.sender = value.lower()
+        elif key == 'from':
+            job.start = _parse_clock(value)
+        elif key == 'to':
+            job.end = _parse_clock(value, end_of_minute=True)
+        elif key == 'compress':
+            job.compression = value.lower()
+        else:
+            raise ExportError(SAVE_USAGE)
+    check_compression(job.compression)
+    return job
+
+def check_compression(compression):
+    if compression not in COMPRESSIONS:
+        raise ExportError(f"Unknown compression '{compression}' (use none, gzip or zstd)")
+    if compression == 'zstd' and zstandard is None:
+        raise ExportError("zstd compression needs the 'zstandard' package on the server")
+
+def _open_output(path, compression):
+    if compression == 'gzip':
+        return gzip.open(path, 'wb')
+    raw = open(path, 'wb')
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+    return raw
+
+class ExportWorker:
+    """Runs chat log exports one at a time on a background thread.
+
+    records() must return a fresh iterator over the history each time (for
+    example ChatHistory.iter_all). notify(job, text) reports progress back
+    to whoever asked for the export.
+    """
+
+    def __init__(self, records, notify, export_dir=DEFAULT_EXPORT_DIR):
+        self.records = records
+        self.notify = notify
+        self.export_dir = export_dir
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        """Queue a job; returns how many jobs are ahead of it."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        ahead = self._jobs.qsize()
+        self._jobs.put(job)
+        return ahead
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                path, written = self.export(job)
+                self.notify(job, f"Chat log saved to: {path} ({written} messages)")
+            except Exception as e:
+                self.notify(job, f"Failed to save chat log: {str(e)[:50]}...")
+
+    def _path_for(self, job):
+        safe_name = re.sub(r'[^A-Za-z0-9_.-]', '_', job.requested_by) or 'client'
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        base = os.path.join(self.export_dir, f"chat_log_{stamp}_{safe_name}")
+        suffix = ".txt" + COMPRESSIONS[job.compression]
+        path, n = base + suffix, 1
+        while os.path.exists(path):
+            path, n = f"{base}_{n}{suffix}", n + 1
+        return path
+
+    def export(self, job):
+        """Stream matching records to a new file. Returns (path, records written)."""
+        os.makedirs(self.export_dir, exist_ok=True)
+        path = self._path_for(job)
+        written = 0
+        chunk = ["=== Chat Log ===\n\n"]
+        chunk_size = 0
+        last_report = time.monotonic()
+        with _open_output(path, job.compression) as f:
+            for msg in self.records():
+                if not job.matches(msg):
+                    continue
+                if msg.type == 'system':
+                    line = f"{msg.content}\n"
+                else:
+                    line = f"[{msg.timestamp}] {msg.content}\n"
+                chunk.append(line)
+                chunk_size += len(line)
+                written += 1
+                if chunk_size >= CHUNK_BYTES:
+                    f.write("".join(chunk).encode('utf-8'))
+                    chunk.clear()
+                    chunk_size = 0
+                    now = time.monotonic()
+                    if now - last_report >= PROGRESS_INTERVAL:
+                        self.notify(job, f"Exporting chat log... {written} messages written")
+                        last_report = now
+            if chunk:
+                f.write("".join(chunk).encode('utf-8'))
+        return path, written
@@ -0,0 +1,162 @@
+# history.py
+import json
+import os
+import threading
+import time
+
+DEFAULT_CAPACITY = 1000  # Messages kept in memory
+SEGMENT_MAX_BYTES = 4 * 1024 * 1024  # Start a new segment file past this size
+
+class ChatRecord:
+    """One line of chat history."""
+    __slots__ = ('timestamp', 'type', 'content', 'created')
+
+    def __init__(self, timestamp, type, content, created=None):
+        self.timestamp = timestamp  # Display time, e.g. "03:04:05 PM"
+        self.type = type  # 'message' or 'system'
+        self.content = content
+        self.created = created  # Unix time, used for time-range filters
+
+    @property
+    def sender(self):
+        """Sender of a chat message, or None for system messages."""
+        if self.type != 'message' or ': ' not in self.content:
+            return None
+        return self.content.split(': ', 1)[0]
+
+    def to_list(self):
+        return [self.timestamp, self.type, self.content, self.created]
+
+    def to_line(self):
+        return (json.dumps(self.to_list(), ensure_ascii=False) + "\n").encode('utf-8')
+
+    @classmethod
+    def from_line(cls, line):
+        return cls(*json.loads(line))
+
+class ChatHistory:
+    """Fixed-capacity ring buffer of ChatRecords.
+
+    When the buffer is full, the oldest record is appended to an on-disk
+    segment file (one JSON array per line) before its slot is reused, so
+    memory stays bounded while the full history remains readable through
+    iter_all(). With log_dir=None evicted records are simply dropped.
+    capacity=0 keeps nothing in memory: every record goes straight to the
+    segment files (or the store).
+    lock replaces the internal threading.Lock (e.g. a metrics.TimedLock).
+
+    With a store.MessageStore every record is also written there as it is
+    appended (on the store's writer thread), the ring is refilled from it
+    on startup, and iter_all() reads the full history back from it; no
+    segment files are written then.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, log_dir=None, lock=None, store=None, channel='chat'):
+        if capacity < 0:
+            raise ValueError(f"History capacity must be 0 or more, not {capacity}")
+        self.capacity = capacity
+        self.log_dir = None if store is not None else log_dir
+        self.store = store
+        self.channel = channel
+        self._last_id = 0  # Store id of the newest record
+        self._ring = [None] * capacity
+        self._next = 0    # Slot the next record goes into
+        self._count = 0   # Records currently in the ring
+        self._lock = lock or threading.Lock()
+        self._segments = []  # Segment paths written by this history, oldest first
+        self._spill = None   # Open file for the newest segment
+        self._first_segment = 1
+        if self.log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+            # Never reuse segment numbers from an earlier run
+            numbers = [int(f[8:14]) for f in os.listdir(log_dir)
+                       if f.startswith("segment-") and f.endswith(".log") and f[8:14].isdigit()]
+            self._first_segment = max(numbers, default=0) + 1
+        if store is not None and not capacity:
+            self._last_id = store.last_id()  # Nothing to recover, but iter_all() must still see it
+        elif store is not None:
+            # Recover the newest records from the last run
+            for self._last_id, fields in store.recent(channel, capacity):
+                self._ring[self._next] = ChatRecord(*fields)
+                self._next = (self._next + 1) % capacity
+                self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, type, content):
+        record = ChatRecord(timestamp, type, content, time.time())
+        with self._lock:
+            if not self.capacity:
+                self._evict(record)
+            elif self._count == self.capacity:
+                self._evict(self._ring[self._next])
+            else:
+                self._count += 1
+            if self.capacity:
+                self._ring[self._next] = record
+                self._next = (self._next + 1) % self.capacity
+            if self.store is not None:
+                self._last_id = self.store.append(self.channel, record.to_list())
+
+    def _evict(self, record):
+        """Write a record leaving the ring to the current segment. Caller holds _lock."""
+        if not self.log_dir:
+            return
+        if self._spill is None or self._spill.tell() >= SEGMENT_MAX_BYTES:
+            if self._spill is not None:
+                self._spill.close()
+            number = self._first_segment + len(self._segments)
+            path = os.path.join(self.log_dir, f"segment-{number:06d}.log")
+            self._segments.append(path)
+            self._spill = open(path, 'ab')
+        self._spill.write(record.to_line())
+
+    def _ring_snapshot(self, n):
+        """References to the newest n records, oldest first. Caller holds _lock."""
+        n = min(n, self._count)
+        if not n:
+            return []
+        start = (self._next - n) % self.capacity
+        if start + n <= self.capacity:
+            return self._ring[start:start + n]
+        return self._ring[start:] + self._ring[:self._next]
+
+    def recent(self, n=10):
+        """The newest n records, oldest first."""
+        with self._lock:
+            return self._ring_snapshot(n)
+
+    def iter_all(self):
+        """Yield every record oldest first, streaming spilled ones from disk."""
+        if self.store is not None:
+            with self._lock:
+                upto = self._last_id
+            self.store.flush()
+            for _, fields in self.store.iter_channel(self.channel, upto=upto):
+                yield ChatRecord(*fields)
+            return
+        with self._lock:
+            if self._spill is not None:
+                self._spill.flush()
+            segments = list(self._segments)
+            end_offset = self._spill.tell() if self._spill is not None else 0
+            in_memory = self._ring_snapshot(self._count)
+
+        for i, path in enumerate(segments):
+            last = i == len(segments) - 1
+            with open(path, 'rb') as f:
+                # Stop where the newest segment ended when we took the snapshot;
+                # anything spilled since then is still in in_memory.
+                while not last or f.tell() < end_offset:
+                    line = f.readline()
+                    if not line:
+                        break
+                    yield ChatRecord.from_line(line)
+        yield from in_memory
+
+    def close(self):
+        with self._lock:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
@@ -0,0 +1,223 @@
+# metrics.py
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+def split_name(name):
+    """'family{labels}' -> ('family', 'labels'); labels may be ''."""
+    family, brace, labels = name.partition('{')
+    return family, labels[:-1] if brace else ''
+
+class _Shard:
+    """Counters and histograms written by one thread only."""
+    __slots__ = ('thread', 'counters', 'histograms')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = {}  # {name: value}
+        self.histograms = {}  # {name: [bucket counts..., +Inf count, sum]}
+
+    def merge_into(self, counters, histograms):
+        for name, value in list(self.counters.items()):
+            counters[name] = counters.get(name, 0) + value
+        for name, hist in list(self.histograms.items()):
+            total = histograms.get(name)
+            if total is None:
+                histograms[name] = list(hist)
+            else:
+                for i, value in enumerate(hist):
+                    total[i] += value
+
+class Metrics:
+    """Counters, gauges and latency histograms cheap enough to leave on.
+
+    Every thread writes to its own shard, so inc() and observe() take no
+    lock; shards are only summed when someone asks for a snapshot (the
+    /stats command or a scrape). Shards of threads that have exited are
+    folded into one retired shard then, and whenever a new thread gets
+    its shard, so they stay as many as the live threads even if nobody
+    asks. Gauges are functions evaluated at snapshot time.
+
+    Names may carry Prometheus labels, e.g. 'x_total{reason="kicked"}'.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.started = time.time()
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard(None)
+        self._lock = threading.Lock()  # Guards _shards, _retired and the declarations
+        self._help = {}  # {family: (type, help text)}
+        self._gauges = {}  # {name: function returning the current value}
+        self._collectors = []  # Functions returning {counter name: value} to add at snapshot
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard(threading.current_thread())
+            with self._lock:
+                self._retire_dead()
+                self._shards.append(shard)
+            return shard
+
+    def _retire_dead(self):
+        """Fold the shards of exited threads into the retired one. Caller holds _lock."""
+        alive = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                alive.append(shard)
+            else:
+                # Its thread is gone, so nothing writes to it any more
+                shard.merge_into(self._retired.counters, self._retired.histograms)
+        self._shards = alive
+
+    def counter(self, family, help):
+        self._help[family] = (COUNTER, help)
+
+    def histogram(self, family, help):
+        self._help[family] = (HISTOGRAM, help)
+
+    def gauge(self, name, help, value):
+        """Declare a gauge; value() is called at snapshot time."""
+        self._help[split_name(name)[0]] = (GAUGE, help)
+        self._gauges[name] = value
+
+    def add_collector(self, collect):
+        """collect() returns {counter name: value} added to every snapshot."""
+        self._collectors.append(collect)
+
+    def inc(self, name, n=1):
+        counters = self._shard().counters
+        counters[name] = counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        histograms = self._shard().histograms
+        hist = histograms.get(name)
+        if hist is None:
+            hist = histograms[name] = [0] * (len(self.buckets) + 2)
+        hist[bisect.bisect_left(self.buckets, seconds)] += 1
+        hist[-1] += seconds
+
+    def snapshot(self):
+        """Returns (counters, gauges, histograms) summed over every thread."""
+        counters, histograms = {}, {}
+        with self._lock:
+            self._retire_dead()
+            alive = self._shards
+            self._retired.merge_into(counters, histograms)
+        for shard in alive:
+            shard.merge_into(counters, histograms)
+        for collect in self._collectors:
+            for name, value in collect().items():
+                counters[name] = counters.get(name, 0) + value
+        gauges = {}
+        for name, value in self._gauges.items():
+            try:
+                gauges[name] = value()
+            except Exception:
+                pass
+        return counters, gauges, histograms
+
+    def quantile(self, hist, q):
+        """Upper bound of the bucket holding quantile q, or None if empty."""
+        count = sum(hist[:-1])
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, n in zip(self.buckets, hist):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render_prometheus(self):
+        """The snapshot in the Prometheus text exposition format."""
+        counters, gauges, histograms = self.snapshot()
+        lines = []
+        described = set()
+
+        def describe(name):
+            family = split_name(name)[0]
+            if family not in described and family in self._help:
+                kind, help = self._help[family]
+                lines.append(f"# HELP {family} {help}")
+                lines.append(f"# TYPE {family} {kind}")
+            described.add(family)
+
+        for name in sorted(counters):
+            describe(name)
+            lines.append(f"{name} {counters[name]}")
+        for name in sorted(gauges):
+            describe(name)
+            lines.append(f"{name} {gauges[name]}")
+        for name in sorted(histograms):
+            describe(name)
+            family, labels = split_name(name)
+            prefix = labels + ',' if labels else ''
+            hist = histograms[name]
+            cumulative = 0
+            for bound, n in zip(self.buckets, hist):
+                cumulative += n
+                lines.append(f'{family}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            cumulative += hist[-2]
+            lines.append(f'{family}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ''
+            lines.append(f"{family}_sum{suffix} {hist[-1]}")
+            lines.append(f"{family}_count{suffix} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host, port):
+        """Serve GET /metrics on a background thread. Returns the HTTP server."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Keep scrapes out of the server console
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
+
+class TimedLock:
+    """threading.Lock that records how long every acquire waited."""
+
+    def __init__(self, metrics, name):
+        self._lock = threading.Lock()
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        if self._lock.acquire(False):
+            self._metrics.observe(self._name, 0.0)  # Uncontended
+        else:
+            start = time.perf_counter()
+            self._lock.acquire()
+            self._metrics.observe(self._name, time.perf_counter() - start)
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
@@ -0,0 +1,168 @@
+# outbound.py
+import select
+import socket
+import threading
+import time
+from collections import deque
+
+# Slow consumer policies
+DROP_OLDEST = "drop_oldest"  # Discard the oldest queued message to make room
+DISCONNECT = "disconnect"    # Drop the client once its queue is full
+COALESCE = "coalesce"        # Merge everything queued into one write
+POLICIES = (DROP_OLDEST, DISCONNECT, COALESCE)
+
+DEFAULT_QUEUE_SIZE = 256       # Messages queued per client before the policy applies
+COALESCE_MAX_BYTES = 1 << 20   # A coalesced backlog larger than this disconnects the client
+FLUSH_CHUNK = 4096
+SENDMSG_BATCH = 64  # Buffers handed to one sendmsg() call (well below IOV_MAX)
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')  # Not available on Windows
+
+class OutboundQueue:
+    """Bounded queue of encoded payloads waiting to be written to one client.
+
+    Producers (broadcast, DMs, server notices) only call put(), which never
+    touches the socket. The bytes are written either by a dedicated writer
+    thread (run_writer) or, for non-blocking sockets, by an event loop that
+    calls send_pending() whenever the socket is writable.
+
+    Payloads are never copied: the same bytes object can sit in many
+    queues, and a backlog is written with one vectored sendmsg() call.
+    """
+
+    def __init__(self, sock, maxlen=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        if maxlen < 1:
+            raise ValueError(f"Queue size must be 1 or more, not {maxlen}")
+        self.sock = sock
+        self.maxlen = maxlen
+        self.policy = policy
+        self.closed = False
+        self.overflowed = False  # Set when the queue gave up on this client
+        self.dropped = 0
+        self.coalesced = 0
+        self.on_ready = None  # Called after put() so an event loop can watch for writability
+        self.on_error = None  # Called by the writer thread when the socket fails
+        self._items = deque()
+        self._batch = deque()  # memoryviews taken off _items and being written
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items) + len(self._batch)
+
+    def put(self, data):
+        """Queue a payload. Returns False if the client should be dropped."""
+        with self._cond:
+            if self.closed:
+                return False
+            if len(self._items) >= self.maxlen:
+                if self.policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                elif self.policy == COALESCE and sum(map(len, self._items)) <= COALESCE_MAX_BYTES:
+                    merged = b"".join(self._items)
+                    self.coalesced += len(self._items) - 1
+                    self._items.clear()
+                    self._items.append(merged)
+                else:
+                    self.overflowed = True
+                    self.closed = True
+                    self._cond.notify_all()
+                    return False
+            self._items.append(data)
+            self._cond.notify()
+        if self.on_ready is not None:
+            self.on_ready(self)
+        return True
+
+    def close(self):
+        """Stop accepting payloads and wake the writer thread."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def _fill(self):
+        """Move queued payloads into the write batch. Caller holds _send_lock."""
+        if not self._batch:
+            with self._cond:
+                for _ in range(min(len(self._items), SENDMSG_BATCH)):
+                    self._batch.append(memoryview(self._items.popleft()))
+        return self._batch
+
+    def _advance(self, sent):
+        """Drop sent bytes from the front of the write batch."""
+        batch = self._batch
+        while sent:
+            head = batch[0]
+            if sent >= len(head):
+                sent -= len(head)
+                batch.popleft()
+            else:
+                batch[0] = head[sent:]
+                sent = 0
+
+    def _send_batch(self):
+        """One write of as much of the batch as the socket takes."""
+        if HAS_SENDMSG and len(self._batch) > 1:
+            sent = self.sock.sendmsg(self._batch)
+        else:
+            sent = self.sock.send(self._batch[0])
+        self._advance(sent)
+
+    def run_writer(self):
+        """Writer thread body for blocking sockets."""
+        try:
+            while True:
+                with self._cond:
+                    while not self._items and not self.closed:
+                        self._cond.wait()
+                    if not self._items:
+                        return
+                with self._send_lock:
+                    while self._fill():
+                        self._send_batch()
+        except OSError:
+            self.close()
+            if self.on_error is not None:
+                self.on_error(self)
+
+    def send_pending(self):
+        """Write as much as the socket accepts without blocking.
+
+        Returns True once everything queued has been written.
+        """
+        with self._send_lock:
+            while self._fill():
+                try:
+                    self._send_batch()
+                except (BlockingIOError, InterruptedError):
+                    return False
+                if self._batch:
+                    return False  # Partial write; the socket buffer is full
+            return True
+
+    def flush(self, timeout=0.5):
+        """Best-effort write of whatever is still queued, e.g. before closing."""
+        deadline = time.monotonic() + timeout
+        if not self._send_lock.acquire(timeout=timeout):
+            return False
+        try:
+            while self._fill():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                _, writable, _ = select.select([], [self.sock], [], remaining)
+                if not writable:
+                    return False
+                try:
+                    # Small slices so a writable socket never blocks us
+                    sent = self.sock.send(self._batch[0][:FLUSH_CHUNK])
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    return False
+                self._advance(sent)
+            return True
+        finally:
+            self._send_lock.release()
@@ -0,0 +1,56 @@
+# payloads.py
+"""Compact encodings for the web chat's Socket.IO payloads.
+
+A browser opts in when it connects (see app.py's handle_connect):
+
+    compact  Keys are shortened with COMPACT_KEYS, so a chat message is
+             {"u": ..., "m": ..., "t": ..., "p": false, "s": 17, "r": "general"}
+             instead of spelling out username/message/timestamp/... every
+             time. Values are untouched; chat.html expands the keys again.
+    deflate  Replies of DEFLATE_MIN bytes or more (DM history pages, replays)
+             are sent as a zlib-compressed binary attachment, inflated in
+             the browser with DecompressionStream('deflate').
+
+Dict keys are always field names, never data (room names and usernames
+only appear as values), so compact() can map every key it meets.
+benchmarks/bench_payloads.py compares bytes and CPU per message.
+"""
+import json
+import zlib
+
+COMPACT_KEYS = {
+    'username': 'u', 'message': 'm', 'timestamp': 't', 'is_private': 'p', 'seq': 's',
+    'room': 'r', 'id': 'i', 'from': 'f', 'to': 'o', 'sender': 'n', 'messages': 'ms',
+    'changes': 'c', 'version': 'v', 'users': 'us', 'events': 'e', 'complete': 'k',
+    'last': 'l', 'has_more': 'h', 'before': 'b', 'with_user': 'w', 'time': 'tm', 'query': 'q',
+}
+EXPANDED_KEYS = {short: key for key, short in COMPACT_KEYS.items()}
+assert len(EXPANDED_KEYS) == len(COMPACT_KEYS), "short keys must be unique"
+
+DEFLATE_MIN = 1024  # Bytes of JSON before a reply is worth compressing
+DEFLATE_LEVEL = 6
+
+def compact(value, keys=COMPACT_KEYS):
+    """Copy of a JSON value with every dict key shortened."""
+    if isinstance(value, dict):
+        return {keys.get(key, key): compact(item, keys) for key, item in value.items()}
+    if isinstance(value, list):
+        return [compact(item, keys) for item in value]
+    return value
+
+def expand(value):
+    """Undo compact()."""
+    return compact(value, EXPANDED_KEYS)
+
+def deflate(value, minimum=DEFLATE_MIN):
+    """zlib-compressed JSON bytes for a big value, or the value itself if it is small."""
+    raw = json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    if len(raw) < minimum:
+        return value
+    return zlib.compress(raw, DEFLATE_LEVEL)
+
+def inflate(value):
+    """Undo deflate()."""
+    if isinstance(value, (bytes, bytearray)):
+        return json.loads(zlib.decompress(value))
+    return value
@@ -0,0 +1,200 @@
+# protocol.py
+"""Wire protocol shared by server.py and client.py.
+
+Framed protocol (version 1): every message is a 6 byte header followed by
+the payload.
+
+    +---------+------+----------------+-------------------+
+    | version | type | length (4, BE) | payload (UTF-8)   |
+    +---------+------+----------------+-------------------+
+
+A client asks for it by opening the connection with HANDSHAKE_MAGIC and a
+HELLO frame carrying its name; the server answers with its own HELLO frame.
+The magic is not valid UTF-8, so a server that only speaks the original
+newline-delimited text protocol drops the connection and the client
+reconnects in text mode. Old clients that just send their name keep
+getting the text protocol.
+
+A framed client can tag a command with a request id (REQUEST frames,
+payload "<id> <text>"). The server answers each one with exactly one
+REPLY frame carrying the same id ("<id> <reply text>", possibly empty)
+however much other traffic is in between, so one reader thread can hand
+replies to whoever is waiting for them.
+"""
+import struct
+
+PROTOCOL_VERSION = 1
+HANDSHAKE_MAGIC = b"\xffCHT"  # Never valid UTF-8, so old servers reject it
+
+# Message types
+MSG_HELLO = 1  # Handshake: client name, or the server's acknowledgement
+MSG_TEXT = 2   # A chat line or command (client) / a display line (server)
+MSG_REQUEST = 3  # A command whose reply is wanted: "<id> <text>" (client)
+MSG_REPLY = 4    # The reply to one REQUEST: "<id> <text>" (server)
+
+HEADER = struct.Struct("!BBI")  # version, type, payload length
+MAX_PAYLOAD = 64 * 1024
+MAX_TEXT = MAX_PAYLOAD - 1024  # Longest line a client may send: room for the timestamp, name and tags added to it
+RECV_BUFFER_SIZE = 2 * (HEADER.size + MAX_PAYLOAD)  # Always room for one whole frame
+MIN_RECV = 4096  # Compact the buffer when less free space than this is left
+
+class ProtocolError(Exception):
+    """The peer sent something that does not follow the protocol."""
+
+def encode_frame(msg_type, payload):
+    """Encode one frame from a bytes payload."""
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError(f"Payload of {len(payload)} bytes exceeds {MAX_PAYLOAD}")
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, len(payload)) + payload
+
+def encode_text(text, msg_type=MSG_TEXT):
+    """Encode one frame from a string, cut to MAX_PAYLOAD bytes if longer."""
+    payload = text.encode('utf-8')
+    if len(payload) > MAX_PAYLOAD:
+        payload = payload[:_utf8_boundary(payload, 0, MAX_PAYLOAD)]
+    return encode_frame(msg_type, payload)
+
+def clip(text, limit=MAX_TEXT):
+    """text cut to at most limit UTF-8 bytes, on a character boundary."""
+    if len(text) * 4 <= limit:
+        return text  # Short enough whatever it contains
+    data = text.encode('utf-8')
+    if len(data) <= limit:
+        return text
+    return str(data[:_utf8_boundary(data, 0, limit)], 'utf-8')
+
+def encode_tagged(request_id, text, msg_type):
+    """Encode a REQUEST or REPLY frame."""
+    return encode_text(f"{request_id} {text}", msg_type)
+
+def parse_tagged(text):
+    """(request id, text) from a REQUEST or REPLY payload."""
+    request_id, _, text = text.partition(' ')
+    try:
+        return int(request_id), text
+    except ValueError:
+        raise ProtocolError(f"Bad request id {request_id!r}")
+
+def encode_handshake(name):
+    """First bytes a framed client sends: the magic and a HELLO frame."""
+    return HANDSHAKE_MAGIC + encode_text(name, MSG_HELLO)
+
+class _Decoder:
+    """Incremental decoder over one preallocated receive buffer.
+
+    fill() reads straight into the free tail of the buffer with
+    recv_into(), and messages are decoded from memoryview slices, so no
+    intermediate bytes object is created per read.
+    """
+
+    def __init__(self, size=RECV_BUFFER_SIZE):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0  # First unconsumed byte
+        self._end = 0    # One past the last received byte
+
+    def __len__(self):
+        return self._end - self._start
+
+    def _compact(self):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif len(self._buf) - self._end < MIN_RECV:
+            remaining = self._end - self._start
+            self._view[:remaining] = self._view[self._start:self._end]
+            self._start, self._end = 0, remaining
+
+    def fill(self, sock):
+        """Receive whatever is available. Returns 0 at end of stream."""
+        self._compact()
+        received = sock.recv_into(self._view[self._end:])
+        self._end += received
+        return received
+
+    def feed(self, data):
+        """Append bytes that were already received (e.g. during the handshake)."""
+        self._compact()
+        if len(data) > len(self._buf) - self._end:
+            raise ProtocolError("Receive buffer overflow")
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+class FrameDecoder(_Decoder):
+    """Yields (msg_type, text) for every complete frame in the buffer."""
+
+    framed = True
+
+    def __iter__(self):
+        buf = self._buf
+        while self._end - self._start >= HEADER.size:
+            version, msg_type, length = HEADER.unpack_from(buf, self._start)
+            if version != PROTOCOL_VERSION:
+                raise ProtocolError(f"Unsupported protocol version {version}")
+            if length > MAX_PAYLOAD:
+                raise ProtocolError(f"Frame of {length} bytes exceeds {MAX_PAYLOAD}")
+            begin = self._start + HEADER.size
+            if self._end - begin < length:
+                return
+            self._start = begin + length
+            yield msg_type, str(self._view[begin:self._start], 'utf-8')
+
+    def finish(self):
+        """Called at end of stream; a partial frame is simply discarded."""
+        return []
+
+def _utf8_boundary(buf, start, end):
+    """Largest index <= end that does not split a UTF-8 sequence."""
+    i = end
+    while i > start and i > end - 4:
+        i -= 1
+        byte = buf[i]
+        if byte < 0x80:
+            return end
+        if byte >= 0xC0:
+            # Lead byte: is its sequence complete?
+            needed = 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+            return end if end - i >= needed else i
+    return end
+
+class LineDecoder(_Decoder):
+    """Newline-delimited text, as spoken by the original client and server.
+
+    Yields (MSG_TEXT, line) per complete line. With partial=True a trailing
+    unterminated chunk is yielded too (up to the last whole UTF-8
+    character), for peers that do not end every message with a newline.
+    """
+
+    framed = False
+
+    def __init__(self, size=RECV_BUFFER_SIZE, partial=False):
+        super().__init__(size)
+        self.partial = partial
+
+    def __iter__(self):
+        buf = self._buf
+        while self._start < self._end:
+            newline = buf.find(b"\n", self._start, self._end)
+            if newline == -1:
+                if self.partial:
+                    cut = _utf8_boundary(buf, self._start, self._end)
+                elif self._end == len(buf) and self._start == 0:
+                    cut = self._end  # A line longer than the buffer; hand it over as is
+                else:
+                    return
+                if cut == self._start:
+                    return
+                line = str(self._view[self._start:cut], 'utf-8', 'replace')
+                self._start = cut
+                yield MSG_TEXT, line
+                return
+            line = str(self._view[self._start:newline], 'utf-8', 'replace')
+            self._start = newline + 1
+            yield MSG_TEXT, line
+
+    def finish(self):
+        """At end of stream, return the unterminated last line if any."""
+        if self._start == self._end:
+            return []
+        line = str(self._view[self._start:self._end], 'utf-8', 'replace')
+        self._start = self._end
+        return [(MSG_TEXT, line)]
@@ -0,0 +1,104 @@
+# ratelimit.py
+import threading
+import time
+
+USER = 'user'
+IP = 'ip'
+GLOBAL = 'global'
+PRUNE_AT = 10000  # Per-key buckets kept before idle ones are dropped
+
+class LimitError(ValueError):
+    """A rate limit spec that is not 'RATE/BURST' or 'off'."""
+
+def parse_limit(text):
+    """'10/20' -> (10.0, 20.0): refill per second and burst size. 'off' or '' -> None."""
+    if text is None or text.strip().lower() in ('', 'off', 'none', '0'):
+        return None
+    rate, _, burst = text.partition('/')
+    try:
+        rate = float(rate)
+        burst = float(burst) if burst else rate
+    except ValueError:
+        raise LimitError(f"Bad rate limit '{text}' (expected RATE/BURST, e.g. 10/20, or off)")
+    if rate <= 0 or burst < 1:
+        raise LimitError(f"Bad rate limit '{text}' (rate must be > 0 and burst >= 1)")
+    return rate, burst
+
+class TokenBucket:
+    """Holds up to `burst` tokens, refilled at `rate` per second; one per message."""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self):
+        """Seconds until a token is available (after refill())."""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+class RateLimiter:
+    """Per-user, per-IP and global token buckets.
+
+    check() costs a few dictionary lookups and float operations, and
+    only takes a token when every bucket involved has one, so a message
+    refused by the global limit is not charged to its sender. Limits
+    are (rate, burst) pairs from parse_limit(); None switches a scope
+    off. Idle per-key buckets are dropped once there are PRUNE_AT.
+    """
+
+    def __init__(self, user=None, ip=None, global_=None, clock=time.monotonic, lock=None):
+        self.limits = {USER: user, IP: ip, GLOBAL: global_}
+        self.clock = clock
+        self._buckets = {USER: {}, IP: {}}
+        self._global = TokenBucket(*global_, clock()) if global_ else None
+        self._lock = lock or threading.Lock()
+
+    @property
+    def enabled(self):
+        return any(self.limits.values())
+
+    def _bucket(self, scope, key, now):
+        buckets = self._buckets[scope]
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= PRUNE_AT:
+                self._prune(buckets, now)
+            bucket = buckets[key] = TokenBucket(*self.limits[scope], now)
+        return bucket
+
+    @staticmethod
+    def _prune(buckets, now):
+        """Drop buckets that have refilled completely; they are as good as new."""
+        for key, bucket in list(buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del buckets[key]
+
+    def check(self, user=None, ip=None):
+        """Take a token for one message.
+
+        Returns None if it may go through, else (scope, seconds to wait)
+        for the first scope that is out of tokens.
+        """
+        with self._lock:
+            now = self.clock()
+            buckets = []
+            if user is not None and self.limits[USER]:
+                buckets.append((USER, self._bucket(USER, user, now)))
+            if ip is not None and self.limits[IP]:
+                buckets.append((IP, self._bucket(IP, ip, now)))
+            if self._global is not None:
+                buckets.append((GLOBAL, self._global))
+            for scope, bucket in buckets:
+                bucket.refill(now)
+                if bucket.tokens < 1:
+                    return scope, bucket.wait()
+            for _, bucket in buckets:
+                bucket.tokens -= 1
+        return None
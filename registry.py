@@ -0,0 +1,114 @@
+# registry.py
+import threading
+
+class ClientRegistry:
+    """Connected client sessions plus the kicked and suspended lists.
+
+    Writers (join, leave, kick, suspend) serialise on one lock and publish
+    new immutable objects: the member tuple, the suspended frozenset and
+    the kicked dict are replaced rather than mutated. Readers never lock;
+    broadcast fan-out iterates whatever member snapshot it picked up, so
+    no lock is held while messages are queued or sent, and a client
+    joining or leaving never blocks (or deadlocks against) a sender.
+
+    Sessions are any objects with .sock and .name attributes. lock may be
+    any context manager standing in for the writer lock (for example a
+    metrics.TimedLock).
+    """
+
+    def __init__(self, lock=None):
+        self._lock = lock or threading.Lock()
+        self.members = ()  # Sessions in join order; replaced on every join/leave
+        self.suspended = frozenset()  # Names that may not send messages
+        self.kicked = {}  # {name: (host, port)} of kicked users; replaced, never mutated
+        # Indexes: mutated only under _lock, read with single dict lookups
+        self._by_sock = {}
+        self._by_name = {}
+        self._by_lower = {}  # Lowercase name, for case-insensitive lookups
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def add(self, session):
+        """Register a session. Returns False if its name is already taken."""
+        lower = session.name.lower()
+        with self._lock:
+            if lower in self._by_lower:
+                return False
+            self._by_sock[session.sock] = session
+            self._by_name[session.name] = session
+            self._by_lower[lower] = session
+            self.members = self.members + (session,)
+        return True
+
+    def remove(self, sock):
+        """Unregister the session for a socket; returns it, or None if unknown."""
+        with self._lock:
+            session = self._by_sock.pop(sock, None)
+            if session is None:
+                return None
+            del self._by_name[session.name]
+            del self._by_lower[session.name.lower()]
+            self.members = tuple(s for s in self.members if s is not session)
+        return session
+
+    def clear(self):
+        with self._lock:
+            self._by_sock.clear()
+            self._by_name.clear()
+            self._by_lower.clear()
+            self.members = ()
+
+    def get(self, sock):
+        return self._by_sock.get(sock)
+
+    def find(self, name, exact=False):
+        """Look up a session by name (case-insensitive unless exact)."""
+        if exact:
+            return self._by_name.get(name)
+        return self._by_lower.get(name.lower())
+
+    def names(self, exclude_sock=None):
+        """Names of connected clients in join order."""
+        return [s.name for s in self.members if s.sock is not exclude_sock]
+
+    def is_suspended(self, name):
+        return name in self.suspended
+
+    def suspend(self, name):
+        """Returns False if the user was already suspended."""
+        with self._lock:
+            if name in self.suspended:
+                return False
+            self.suspended = self.suspended | {name}
+        return True
+
+    def unsuspend(self, name):
+        """Returns False if the user was not suspended."""
+        with self._lock:
+            if name not in self.suspended:
+                return False
+            self.suspended = self.suspended - {name}
+        return True
+
+    def is_kicked(self, name):
+        return name in self.kicked
+
+    def kick(self, name, addr):
+        with self._lock:
+            kicked = dict(self.kicked)
+            kicked[name] = addr
+            self.kicked = kicked
+
+    def revive(self, name):
+        """Returns False if the user was not kicked."""
+        with self._lock:
+            if name not in self.kicked:
+                return False
+            kicked = dict(self.kicked)
+            del kicked[name]
+            self.kicked = kicked
+        return True
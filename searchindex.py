@@ -0,0 +1,485 @@
+# searchindex.py
+"""Full-text search over chat messages, public and private.
+
+The chat core adds every message it posts or delivers as a DM; server.py
+answers /search and app.py the 'search' event from it:
+
+    index = SearchIndex()
+    index.add("alice", "notes from the routing lecture", room="general")
+    index.add("bob", "thanks!", to="alice")          # a DM
+    results, has_more = index.search("alice", "routing", sender="alice")
+    older, has_more = index.search("alice", "routing", sender="alice", before=results[-1]['id'])
+
+A message matches when it has every word of the query (words are runs
+of letters and digits, compared in lower case). Filters narrow it down
+to one sender, one room, or a time range, and DMs only ever match for
+their sender and recipient. Results come newest first, a page at a time,
+with the last result's id as the cursor for the next page.
+
+The index is a list of segments, each covering a contiguous range of
+message ids. New messages go into an open segment; once it holds
+segment_size messages it is frozen into compact arrays (sorted posting
+lists of ids per word, per-message times and names, and the texts as one
+UTF-8 blob). A merge thread combines runs of merge_factor frozen
+segments of the same size tier into one, so a search only visits a
+handful of segments, and drops the oldest segments once more than
+max_docs messages are held, which bounds memory. Segments are replaced
+copy-on-write: searches take no lock except to read the open segment.
+
+Messages from before a restart are read back from the message store by
+load_in_background(); they get ids below those of add()ed messages.
+"""
+import array
+import bisect
+import re
+import threading
+import time
+from datetime import datetime
+
+MAX_DOCS = 1_000_000  # Messages kept searchable; the oldest segments go first
+SEGMENT_SIZE = 4096  # Messages in the open segment before it is frozen
+MERGE_FACTOR = 8  # Frozen segments of one size tier merged together
+MAX_WORD = 64  # Longer words are not indexed
+INTERSECT_CHUNK = 64  # Ids of the rarest word checked at a time, doubling as a search goes back
+DEFAULT_PAGE = 20
+MAX_PAGE = 100
+GENERAL = 'general'  # Room of the messages in a chat history ('chat' channel)
+
+WORD = re.compile(r'\w+')
+SEARCH_USAGE = ("Usage: /search [sender=<name>] [room=<room>] [from=HH:MM|YYYY-MM-DD] "
+                "[to=HH:MM|YYYY-MM-DD] <words>, or /search more")
+
+# Filters are indexed as terms that cannot collide with words
+SENDER_TERM = '\0from:'
+ROOM_TERM = '\0in:'
+DM_TERM = '\0dm:'  # Both ends of a DM
+NO_ROOM = 0  # Name id standing for "a DM" in a segment's rooms array
+
+class SearchError(Exception):
+    """A search that cannot be run as asked."""
+
+def words(text):
+    """The distinct indexed words of a text, lower case."""
+    return {word for word in WORD.findall(text.lower()) if len(word) <= MAX_WORD}
+
+class Segment:
+    """Messages first..first+count-1. Open (appendable) until frozen."""
+    __slots__ = ('first', 'postings', 'times', 'senders', 'rooms', 'recipients', 'texts', 'blob', 'offsets')
+
+    def __init__(self, first):
+        self.first = first
+        self.postings = {}  # {term: array('I') of message ids, ascending}
+        self.times = array.array('d')  # Unix times, nondecreasing
+        self.senders = array.array('I')  # Name ids (SearchIndex._names)
+        self.rooms = array.array('I')  # Room name ids, NO_ROOM for DMs
+        self.recipients = array.array('I')  # DM recipient name ids, 0 for public messages
+        self.texts = []  # Open segments only
+        self.blob = b''  # Frozen: every text, UTF-8, back to back
+        self.offsets = None  # Frozen: array('Q') of count + 1 offsets into blob
+
+    def __len__(self):
+        return len(self.times)
+
+    def text(self, i):
+        if self.offsets is None:
+            return self.texts[i]
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def freeze(self):
+        """Pack the texts into one blob; the segment is read-only afterwards."""
+        encoded = [text.encode('utf-8') for text in self.texts]
+        offsets = array.array('Q', [0])
+        total = 0
+        for data in encoded:
+            total += len(data)
+            offsets.append(total)
+        self.blob = b''.join(encoded)
+        self.offsets = offsets
+        self.texts = None
+        return self
+
+    @classmethod
+    def merge(cls, segments):
+        """One frozen segment holding the consecutive frozen segments given."""
+        merged = cls(segments[0].first)
+        merged.offsets = array.array('Q', [0])
+        blobs = []
+        base = 0
+        for segment in segments:
+            # Ids are consecutive across the run, so posting lists just concatenate
+            for term, ids in segment.postings.items():
+                postings = merged.postings.get(term)
+                if postings is None:
+                    merged.postings[term] = array.array('I', ids)
+                else:
+                    postings.extend(ids)
+            merged.times.extend(segment.times)
+            merged.senders.extend(segment.senders)
+            merged.rooms.extend(segment.rooms)
+            merged.recipients.extend(segment.recipients)
+            merged.offsets.extend(offset + base for offset in segment.offsets[1:])
+            blobs.append(segment.blob)
+            base += len(segment.blob)
+        merged.blob = b''.join(blobs)
+        merged.texts = None
+        return merged
+
+def intersect(lists, low, high):
+    """Ids in every one of the sorted lists, in [low, high), newest first.
+
+    The first (shortest) list is walked back from high in chunks that
+    double in size, and each chunk is filtered by bisecting the other
+    lists, so a page that fills early never looks further back.
+    """
+    driver, others = lists[0], lists[1:]
+    start = bisect.bisect_left(driver, low)
+    end = bisect.bisect_left(driver, high)
+    chunk = INTERSECT_CHUNK
+    while end > start:
+        part = driver[max(start, end - chunk):end]
+        end -= chunk
+        chunk *= 2
+        for ids in others:
+            # Only the stretch of ids between the chunk's first and last can match
+            lo = bisect.bisect_left(ids, part[0])
+            hi = bisect.bisect_right(ids, part[-1], lo)
+            kept = []
+            for message_id in part:
+                j = bisect.bisect_left(ids, message_id, lo, hi)
+                if j < hi and ids[j] == message_id:
+                    kept.append(message_id)
+                    lo = j + 1
+            part = kept
+            if not part:
+                break
+        yield from reversed(part)
+
+class SearchIndex:
+    """Inverted index over the newest max_docs messages (see the module docstring)."""
+
+    def __init__(self, max_docs=MAX_DOCS, segment_size=SEGMENT_SIZE, merge_factor=MERGE_FACTOR):
+        self.max_docs = max_docs
+        self.segment_size = segment_size
+        self.merge_factor = merge_factor
+        self.max_segment = max(segment_size, max_docs // 4)  # Merges stop here, so dropping one loses at most a quarter
+        self._names = {'': 0}  # {name: id}; room and user names, interned
+        self._name_list = ['']
+        self._segments = ()  # Frozen, oldest first; replaced, never mutated
+        self._open = Segment(max_docs + 1)  # Ids up to max_docs are left for load()
+        self._last_time = 0.0
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()  # One merge at a time
+        self._merge_wanted = threading.Event()
+        self._stopped = False
+        self._merger = threading.Thread(target=self._merge_loop, name="search-merger", daemon=True)
+        self._merger.start()
+
+    def __len__(self):
+        return sum(len(segment) for segment in self._segments) + len(self._open)
+
+    def segment_count(self):
+        return len(self._segments) + 1
+
+    def _name_id(self, name):
+        """Id of a name, interning it. Caller holds _lock."""
+        name_id = self._names.get(name)
+        if name_id is None:
+            name_id = self._names[name] = len(self._name_list)
+            self._name_list.append(name)
+        return name_id
+
+    @staticmethod
+    def _terms(sender, text, room, to):
+        terms = words(text)
+        terms.add(SENDER_TERM + sender.lower())
+        if to is None:
+            terms.add(ROOM_TERM + room)
+        else:
+            terms.add(DM_TERM + sender.lower())
+            terms.add(DM_TERM + to.lower())
+        return terms
+
+    def _index(self, segment, terms, sender, text, room, to, created):
+        """Append a message to an open segment. Caller holds _lock. Returns its id."""
+        message_id = segment.first + len(segment)
+        segment.times.append(created)
+        segment.senders.append(self._name_id(sender))
+        segment.rooms.append(NO_ROOM if to is not None else self._name_id(room))
+        segment.recipients.append(self._name_id(to) if to is not None else 0)
+        segment.texts.append(text)
+        postings = segment.postings
+        for term in terms:
+            ids = postings.get(term)
+            if ids is None:
+                postings[term] = array.array('I', (message_id,))
+            else:
+                ids.append(message_id)
+        return message_id
+
+    def add(self, sender, text, room=None, to=None, created=None):
+        """Index a public message in `room`, or a DM `to` a user. Returns its id."""
+        terms = self._terms(sender, text, room, to)
+        with self._lock:
+            # Times stay in id order, so a time range is an id range
+            self._last_time = max(self._last_time, created if created is not None else time.time())
+            segment = self._open
+            message_id = self._index(segment, terms, sender, text, room, to, self._last_time)
+            if len(segment) >= self.segment_size:
+                self._segments = self._segments + (segment.freeze(),)
+                self._open = Segment(message_id + 1)
+                self._merge_wanted.set()
+        return message_id
+
+    def load(self, messages):
+        """Index messages sent before this index started, oldest first.
+
+        messages yields (sender, text, room, to, created) like add()'s
+        arguments, all older than anything add()ed; only the first
+        max_docs are taken. They are searchable once all are loaded.
+        Returns how many were loaded.
+        """
+        loaded = []
+        segment = Segment(1)
+        last_time = 0.0
+        for sender, text, room, to, created in messages:
+            if segment.first + len(segment) > self.max_docs:
+                break
+            terms = self._terms(sender, text, room, to)
+            last_time = max(last_time, created)
+            with self._lock:
+                self._index(segment, terms, sender, text, room, to, last_time)
+            if len(segment) >= self.segment_size:
+                loaded.append(segment.freeze())
+                segment = Segment(segment.first + len(segment))
+        if len(segment):
+            loaded.append(segment.freeze())
+        with self._merge_lock, self._lock:
+            self._segments = tuple(loaded) + self._segments
+        self._merge_wanted.set()
+        return sum(len(segment) for segment in loaded)
+
+    # Merging
+
+    def _tier(self, segment):
+        size, tier = len(segment), 0
+        while size >= self.segment_size * self.merge_factor:
+            size //= self.merge_factor
+            tier += 1
+        return tier
+
+    def merge(self):
+        """Do the merge thread's work now: merge every run that is due, then drop the oldest."""
+        with self._merge_lock:
+            while self._merge_once():
+                pass
+            self._drop_oldest()
+
+    def _merge_loop(self):
+        while True:
+            self._merge_wanted.wait()
+            self._merge_wanted.clear()
+            if self._stopped:
+                return
+            self.merge()
+
+    def _merge_once(self):
+        """Merge one run of same-tier segments: merge_factor of them, or as many as fit in
+        max_segment. Returns False if there is none."""
+        segments = self._segments
+        run, size = [], 0
+        for i, segment in enumerate(segments):
+            previous = segments[i - 1]
+            if run and (self._tier(segment) != self._tier(segments[run[0]])
+                        or segment.first != previous.first + len(previous)):  # load()ed and add()ed ids have a gap
+                run, size = [], 0
+            if size + len(segment) > self.max_segment:
+                if len(run) > 1:
+                    break
+                run, size = [], 0
+            run.append(i)
+            size += len(segment)
+            if len(run) == self.merge_factor:
+                break
+        else:
+            return False
+        start, end = run[0], run[-1] + 1
+        merged = Segment.merge(segments[start:end])
+        with self._lock:
+            # Only merges remove segments; new ones are only appended meanwhile
+            current = self._segments
+            self._segments = current[:start] + (merged,) + current[end:]
+        return True
+
+    def _drop_oldest(self):
+        with self._lock:
+            total = len(self)
+            segments = self._segments
+            while segments and total - len(segments[0]) >= self.max_docs:
+                total -= len(segments[0])
+                segments = segments[1:]
+            self._segments = segments
+
+    def close(self):
+        self._stopped = True
+        self._merge_wanted.set()
+
+    # Searching
+
+    def search(self, viewer, text='', sender=None, room=None, since=None, until=None, before=None,
+               limit=DEFAULT_PAGE):
+        """Messages `viewer` may see that match, newest first.
+
+        text must contain words, unless sender or room is given. since and
+        until are Unix times (inclusive); before is the id of the last
+        result of the previous page. Returns (results, has_more), each
+        result a dict with id, time, username, room (None for DMs), to
+        (DMs only), message and is_private.
+        """
+        terms = words(text)
+        if sender:
+            terms.add(SENDER_TERM + sender.lower())
+        if room:
+            terms.add(ROOM_TERM + room)
+        if not terms:
+            raise SearchError("Nothing to search for")
+        limit = max(1, min(int(limit), MAX_PAGE))
+        viewer_id = self._names.get(viewer, -1)
+        found = []  # (segment, index)
+        with self._lock:
+            segments = self._segments  # Frozen before this point, so not the open one
+            open_segment = self._open
+            found = self._search_segment(open_segment, terms, viewer_id, since, until, before, limit + 1, found,
+                                         len(open_segment))
+            results = [self._result(segment, i) for segment, i in found]
+        for segment in reversed(segments):
+            if len(found) > limit:
+                break
+            found = self._search_segment(segment, terms, viewer_id, since, until, before, limit + 1, found,
+                                         len(segment))
+        results.extend(self._result(segment, i) for segment, i in found[len(results):])
+        return results[:limit], len(results) > limit
+
+    @staticmethod
+    def _search_segment(segment, terms, viewer_id, since, until, before, wanted, found, count):
+        """Append (segment, index) of matches, newest first, until `wanted` are found."""
+        if not count:
+            return found
+        first = segment.first
+        # Id range to look at: below the cursor and inside the time range
+        low, high = first, first + count
+        if before is not None:
+            high = min(high, before)
+        if since is not None:
+            low = max(low, first + bisect.bisect_left(segment.times, since, 0, count))
+        if until is not None:
+            high = min(high, first + bisect.bisect_right(segment.times, until, 0, count))
+        if low >= high:
+            return found
+        lists = []
+        for term in terms:
+            ids = segment.postings.get(term)
+            if ids is None:
+                return found
+            lists.append(ids)
+        lists.sort(key=len)
+        if len(lists) == 1:
+            ids = lists[0]
+            matches = reversed(ids[bisect.bisect_left(ids, low):bisect.bisect_left(ids, high)])
+        else:
+            matches = intersect(lists, low, high)
+        rooms, senders, recipients = segment.rooms, segment.senders, segment.recipients
+        for message_id in matches:
+            i = message_id - first
+            if rooms[i] == NO_ROOM and viewer_id not in (senders[i], recipients[i]):
+                continue  # Someone else's DM
+            found.append((segment, i))
+            if len(found) >= wanted:
+                break
+        return found
+
+    def _result(self, segment, i):
+        names = self._name_list
+        private = segment.rooms[i] == NO_ROOM
+        result = {
+            'id': segment.first + i,
+            'time': segment.times[i],
+            'username': names[segment.senders[i]],
+            'room': None if private else names[segment.rooms[i]],
+            'message': segment.text(i),
+            'is_private': private
+        }
+        if private:
+            result['to'] = names[segment.recipients[i]]
+        return result
+
+def stored_messages(message_store, limit, upto):
+    """The newest chat messages of a store.MessageStore, oldest first, as load() takes them.
+
+    Reads the channels that history.ChatHistory ('chat': general chat),
+    bus.LocalBus ('room:<room>') and dmstore.DMStore ('dm:<a>\\n<b>')
+    write; limit and upto (a row id) bound the rows read.
+    """
+    for _, channel, created, message in message_store.iter_newest(limit, upto):
+        if channel == 'chat':
+            _, kind, content, _ = message
+            if kind == 'message' and ': ' in content:
+                sender, text = content.split(': ', 1)
+                yield sender, text, GENERAL, None, created
+        elif channel.startswith('room:'):
+            yield message['username'], message['message'], channel[len('room:'):], None, created
+        elif channel.startswith('dm:'):
+            first, _, second = channel[len('dm:'):].partition('\n')
+            sender = message['sender']
+            yield sender, message['message'], None, second if sender == first else first, created
+
+def load_in_background(index, message_store, on_done=None):
+    """Fill index from a store in a daemon thread; on_done(count) when finished.
+
+    Call before the first add(): rows written after this call are left
+    to add(), so nothing is indexed twice.
+    """
+    upto = message_store.last_id()
+
+    def run():
+        count = index.load(stored_messages(message_store, index.max_docs, upto))
+        if on_done is not None:
+            on_done(count)
+    thread = threading.Thread(target=run, name="search-loader", daemon=True)
+    thread.start()
+    return thread
+
+def _parse_moment(value, end=False):
+    """HH:MM today, or YYYY-MM-DD (its start, or its end with end=True), as Unix time."""
+    for fmt in ("%H:%M", "%Y-%m-%d"):
+        try:
+            moment = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if fmt == "%H:%M":
+            moment = datetime.now().replace(hour=moment.hour, minute=moment.minute, second=0, microsecond=0)
+            return moment.timestamp() + (59.999 if end else 0)
+        return moment.timestamp() + (86399.999 if end else 0)
+    raise SearchError(f"Invalid time '{value}', expected HH:MM or YYYY-MM-DD")
+
+def parse_search_command(text):
+    """Keyword arguments for SearchIndex.search() from '/search key=value ... words'."""
+    query = {'text': []}
+    for arg in text.split()[1:]:
+        key, sep, value = arg.partition('=')
+        key = key.lower()
+        if not sep or key not in ('sender', 'room', 'from', 'to'):
+            query['text'].append(arg)
+        elif not value:
+            raise SearchError(SEARCH_USAGE)
+        elif key == 'sender':
+            query['sender'] = value
+        elif key == 'room':
+            query['room'] = value.lower().lstrip('#')
+        elif key == 'from':
+            query['since'] = _parse_moment(value)
+        else:
+            query['until'] = _parse_moment(value, end=True)
+    query['text'] = ' '.join(query['text'])
+    if not words(query['text']) and not query.get('sender') and not query.get('room'):
+        raise SearchError(SEARCH_USAGE)
+    return query
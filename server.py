@@ -4,137 +4,275 @@ import threading
 import time
 import sys
 import select
+import selectors
+import argparse
+import bus
+import chatcore
+import outbound
+import protocol
+import history
+import export
+import metrics
+import ratelimit
+import searchindex
+import store
 from datetime import datetime
 import os
-import tkinter as tk
-from tkinter import filedialog
 
 HOST = "0.0.0.0"   # listen on all interfaces
 PORT = 5000
+ENGINE = "threaded"  # "threaded" (one thread per client) or "selector"
+OUTBOUND_QUEUE_SIZE = outbound.DEFAULT_QUEUE_SIZE  # Messages buffered per client
+SLOW_CONSUMER_POLICY = outbound.DROP_OLDEST  # What to do when a client's queue is full
+HISTORY_SIZE = history.DEFAULT_CAPACITY  # Chat messages kept in memory
+HISTORY_DIR = "chat_history"  # Older messages spill to append-only segment files here
+STORE_PATH = "chat_history/messages.db"  # Chat history survives restarts here; None uses HISTORY_DIR segments
+STORE_DURABILITY = store.DEFAULT_DURABILITY  # off, normal or full (see store.py)
+EXPORT_DIR = export.DEFAULT_EXPORT_DIR  # Where /save writes chat logs
+EXPORT_COMPRESSION = 'none'  # Default compression for /save: none, gzip or zstd
+RATE_LIMIT_USER = "10/20"  # Messages per second / burst for each user ('off' to disable)
+RATE_LIMIT_IP = "off"  # Same, shared by every connection from one IP address
+RATE_LIMIT_GLOBAL = "off"  # Same, for the whole server
+METRICS_HOST = "127.0.0.1"  # The Prometheus endpoint is only served locally by default
+METRICS_PORT = None  # Port for the Prometheus endpoint; None leaves it off
+SEARCH_MAX_DOCS = searchindex.MAX_DOCS  # Messages /search can find, newest first; 0 turns search off
 
 # Global shutdown flag
 shutdown_flag = threading.Event()
 
 # Global variables
-clients = {}  # Dictionary to store connected clients: {socket: name}
-clients_lock = threading.Lock()  # Thread lock for clients dictionary
+stats = metrics.Metrics()  # Server instrumentation, shown by /stats and the metrics endpoint
+stats.counter('chat_connections_accepted_total', "TCP connections accepted")
+stats.counter('chat_connections_rejected_total', "Connections turned away before joining, by reason")
+stats.counter('chat_disconnects_total', "Registered clients that left or were removed")
+stats.counter('chat_messages_in_total', "Messages and commands received from clients")
+stats.counter('chat_bytes_in_total', "Bytes received from registered clients")
+stats.counter('chat_messages_out_total', "Messages queued for delivery to clients")
+stats.counter('chat_bytes_out_total', "Bytes queued for delivery to clients")
+stats.counter('chat_messages_dropped_total', "Queued messages discarded by the drop_oldest policy")
+stats.counter('chat_messages_coalesced_total', "Queued messages merged by the coalesce policy")
+stats.histogram('chat_broadcast_seconds', "Time to queue one broadcast for every client")
+stats.histogram('chat_dm_seconds', "Time to queue a DM for its recipient")
+stats.histogram('chat_lock_wait_seconds', "Time spent waiting to acquire a lock")
+stats.counter('chat_messages_throttled_total', "Messages refused by the rate limiter, by the limit that was hit")
+stats.counter('chat_store_commits_total', "Group commits written to the message store")
+stats.counter('chat_store_writes_total', "Messages written to the message store")
+stats.counter('chat_store_failed_writes_total', "Messages the message store could not write")
+
+limiter = ratelimit.RateLimiter(ratelimit.parse_limit(RATE_LIMIT_USER))  # Replaced in main()
 shutdown_flag = threading.Event()  # Event to signal server shutdown
-chat_messages = []  # Store chat messages for history
-suspended_users = set()  # Set to track suspended users
-kicked_users = {}  # Dictionary to store kicked users: {name: (ip, port)}
+# Replaced in main() once options are parsed
+chat_messages = history.ChatHistory(HISTORY_SIZE, lock=metrics.TimedLock(stats, 'chat_lock_wait_seconds{lock="history"}'))
+# Users, rooms and DMs; this server is its TCP transport (see chatcore.py, and serve() for app.py's bridge)
+core = chatcore.ChatCore(chat_history=chat_messages,
+                         lock=metrics.TimedLock(stats, 'chat_lock_wait_seconds{lock="registry"}'))
+registry = core.registry
+
+stats.gauge('chat_clients', "Connected clients", lambda: len(tcp_sessions()))
+stats.gauge('chat_outbound_queued', "Messages waiting in client queues",
+            lambda: sum(len(session.queue) for session in tcp_sessions()))
+stats.gauge('chat_history_messages', "Chat messages held in memory", lambda: len(chat_messages))
+stats.gauge('chat_kicked_users', "Users barred from reconnecting", lambda: len(registry.kicked))
+stats.gauge('chat_suspended_users', "Users who may not send messages", lambda: len(registry.suspended))
+stats.gauge('chat_uptime_seconds', "Seconds since the server started", lambda: round(time.time() - stats.started))
+# Queues of connected clients; remove_client() adds the counts of departed ones
+stats.add_collector(lambda: {
+    'chat_messages_dropped_total': sum(session.queue.dropped for session in tcp_sessions()),
+    'chat_messages_coalesced_total': sum(session.queue.coalesced for session in tcp_sessions()),
+})
+stats.gauge('chat_store_pending_writes', "Messages waiting for the store's writer thread",
+            lambda: chat_messages.store.pending() if chat_messages.store is not None else 0)
+stats.add_collector(lambda: {
+    'chat_store_commits_total': chat_messages.store.commits,
+    'chat_store_writes_total': chat_messages.store.written,
+    'chat_store_failed_writes_total': chat_messages.store.failed,
+} if chat_messages.store is not None else {})
 
 def get_timestamp():
     """Return current time in hh:mm:ss AM/PM format."""
     return datetime.now().strftime("%I:%M:%S %p")
 
-def save_chat_log(client_sock):
-    """Save chat messages to a user-selected text file."""
+def encode_for(framed, text):
+    """Encode a server line in the client's protocol."""
+    if framed:
+        return protocol.encode_text(text.rstrip('\n'))
+    return text.encode('utf-8')
+
+def tcp_sessions():
+    """This server's own clients; the registry also holds users of other transports."""
+    return [session for session in registry.members if session.transport is tcp]
+
+def send_to_client(client_sock, text):
+    """Queue text for a client. Returns False if the client is gone or overflowed."""
+    session = registry.get(client_sock)
+    if session is None or session.transport is not tcp:
+        return False
+    payload = encode_for(session.framed, text)
+    if not session.queue.put(payload):
+        return False
+    stats.inc('chat_messages_out_total')
+    stats.inc('chat_bytes_out_total', len(payload))
+    return True
+
+def reply(state, text):
+    """Answer the request being handled, or just send text if there is none.
+
+    A REQUEST gets one REPLY with its id (the first thing said back to
+    it); anything after that, and everything for text protocol clients,
+    goes out as ordinary lines.
+    """
+    request_id = state.request_id
+    if request_id is None:
+        return send_to_client(state.sock, text)
+    state.request_id = None
+    payload = protocol.encode_tagged(request_id, text.rstrip('\n'), protocol.MSG_REPLY)
+    if not state.queue.put(payload):
+        return False
+    stats.inc('chat_messages_out_total')
+    stats.inc('chat_bytes_out_total', len(payload))
+    return True
+
+def notify_export(job, text):
+    """Report export progress to the client that asked for it."""
+    send_to_client(job.reply_to, f"[{get_timestamp()}] [SERVER] {text}\n")
+
+exporter = export.ExportWorker(lambda: chat_messages.iter_all(), notify_export, EXPORT_DIR)
+
+def save_chat_log(client_sock, text='/save'):
+    """Queue a chat log export for a client's /save command.
+
+    The file is written by the export worker thread into EXPORT_DIR, so
+    the client's session carries on while it runs.
+    """
+    session = registry.get(client_sock)
+    name = session.name if session is not None else "client"
     try:
-        # Create a hidden root window for the file dialog
-        root = tk.Tk()
-        root.withdraw()  # Hide the main window
-        
-        # Open file dialog to choose save location
-        file_path = filedialog.asksaveasfilename(
-            defaultextension=".txt",
-            filetypes=[("Text files", "*.txt"), ("All files", "*.*")],
-            title="Save Chat Log As",
-            initialfile=f"chat_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        )
-        
-        if not file_path:  # User cancelled the dialog
-            return False
-            
-        # Save the chat log
-        with open(file_path, 'w') as f:
-            f.write("=== Chat Log ===\n\n")
-            for msg in chat_messages:
-                if msg['type'] == 'system':
-                    f.write(f"{msg['content']}\n")
-                else:
-                    f.write(f"[{msg['timestamp']}] {msg['content']}\n")
-        
-        # Notify the client
-        client_sock.sendall(f"[{get_timestamp()}] [SERVER] Chat log saved to: {file_path}\n".encode('utf-8'))
-        return True
-        
-    except Exception as e:
-        error_msg = f"[{get_timestamp()}] [SERVER] Failed to save chat log: {str(e)[:50]}...\n"
-        client_sock.sendall(error_msg.encode('utf-8'))
+        job = export.parse_save_command(text, name, client_sock, EXPORT_COMPRESSION)
+    except export.ExportError as e:
+        send_to_client(client_sock, f"[{get_timestamp()}] [SERVER] {e}\n")
         return False
-    finally:
-        if 'root' in locals():
-            root.destroy()  # Clean up the Tkinter window
+    ahead = exporter.submit(job)
+    waiting = f" ({ahead} ahead of you)" if ahead else ""
+    send_to_client(client_sock, f"[{get_timestamp()}] [SERVER] Exporting chat log{waiting}...\n")
+    return True
 
-def list_online_users(exclude_sock=None):
-    """Return a formatted string of online users"""
-    with clients_lock:
-        user_list = [name for sock, name in clients.items() if sock is not exclude_sock]
-        return "\n".join([f"{i+1}. {name}" for i, name in enumerate(user_list)])
-
-def send_private_message(sender_sock, recipient_name, message):
-    """Send a private message to a specific user"""
-    with clients_lock:
-        for sock, name in clients.items():
-            if name == recipient_name and sock != sender_sock:
-                try:
-                    sender_name = clients.get(sender_sock, "Unknown")
-                    timestamp = get_timestamp()
-                    sock.sendall(f"[{timestamp}] [PM from {sender_name}]: {message}\n".encode('utf-8'))
-                    return True
-                except:
-                    return False
-    return False
+def search_messages(state, text):
+    """Answer /search with a page of matching messages, newest first.
 
-def broadcast(message, exclude_sock=None, is_system_message=False, sender_name=None):
-    """Send message to all connected clients (optionally exclude one)."""
-    timestamp = get_timestamp()
-    content = message.strip()
-    
-    # Don't process empty messages
-    if not content:
+    The query is remembered on the session, so '/search more' carries on
+    with older matches.
+    """
+    if core.search is None:
+        reply(state, f"[{get_timestamp()}] [SERVER] Search is turned off on this server.\n")
         return
+    try:
+        if text.split()[1:] == ['more']:
+            if state.search is None:
+                raise searchindex.SearchError("No more results. " + searchindex.SEARCH_USAGE)
+            query = state.search
+        else:
+            query = searchindex.parse_search_command(text)
+        started = time.perf_counter()
+        results, has_more = core.search.search(state.name, **query)
+    except searchindex.SearchError as e:
+        reply(state, f"[{get_timestamp()}] [SERVER] {e}\n")
+        return
+    elapsed = (time.perf_counter() - started) * 1000
+    state.search = dict(query, before=results[-1]['id']) if has_more else None
+    if not results:
+        reply(state, f"[{get_timestamp()}] [SERVER] No messages found ({elapsed:.1f} ms).\n")
+        return
+    found = f"{len(results)} message{'s' if len(results) != 1 else ''}"
+    reply(state, f"[{get_timestamp()}] [SERVER] {found} found, newest first ({elapsed:.1f} ms):\n")
+    for result in results:
+        when = datetime.fromtimestamp(result['time']).strftime("%Y-%m-%d %I:%M:%S %p")
+        if result['is_private']:
+            sender = f"{result['username']} -> {result['to']}"
+        else:
+            sender = f"{result['username']} in #{result['room']}"
+        send_to_client(state.sock, f"[{when}] {sender}: {result['message']}\n")
+    if has_more:
+        send_to_client(state.sock, f"[{get_timestamp()}] [SERVER] Type /search more for older messages.\n")
+
+def find_session(name, exact=False):
+    """Look up a connected client by name (case-insensitive unless exact)."""
+    return registry.find(name, exact)
+
+def list_online_users(exclude_sock=None):
+    """Return a formatted string of online users.
+
+    The numbered list is remembered on the requesting session, so a
+    following '/dm <n>' picks exactly the user that was shown as n.
+    """
+    user_list = registry.names(exclude_sock)
+    session = registry.get(exclude_sock)
+    if session is not None:
+        session.user_list = user_list
+    return "\n".join([f"{i+1}. {name}" for i, name in enumerate(user_list)])
+
+def fan_out(formatted_message, sessions, exclude=None):
+    """Queue one line for every session given (except `exclude`)."""
+    started = time.perf_counter()
     
-    # Format the message with timestamp and sender
-    if is_system_message:
-        formatted_message = f"\033[92m[{timestamp}] {content}\033[0m"
-    elif sender_name:
-        formatted_message = f"[{timestamp}] {sender_name}: {content}"
-    else:
-        formatted_message = f"[{timestamp}] {content}"
-    
-    # Add to chat log if it's a regular message or a system message that's not from the server console
-    if not is_system_message or (is_system_message and 'SERVER' not in content):
-        # Don't log join/leave messages in the chat history
-        if "has joined the chat" not in content and "has left the chat" not in content:
-            chat_messages.append({
-                'timestamp': timestamp,
-                'type': 'system' if is_system_message else 'message',
-                'content': f"{sender_name}: {content}" if sender_name else content
-            })
-    
-    # Send to all connected clients
-    with clients_lock:
-        clients_to_remove = []
-        
-        for client_sock in list(clients.keys()):
-            if client_sock is exclude_sock or shutdown_flag.is_set():
+    # Encode once per protocol; every recipient's queue shares the same immutable bytes
+    text_payload = f"{formatted_message}\n".encode('utf-8')
+    framed_payload = None
+
+    # sessions is the core's snapshot of the room; no lock is held, so
+    # joins and leaves on other threads never wait on this fan-out.
+    clients_to_remove = []
+    queued_text = queued_framed = 0
+    for session in sessions:
+        if session is exclude or shutdown_flag.is_set():
+            continue
+        if session.framed:
+            if framed_payload is None:
+                framed_payload = protocol.encode_text(formatted_message)
+            if session.queue.put(framed_payload):
+                queued_framed += 1
                 continue
-                
-            try:
-                # Send the formatted message with timestamp and sender
-                client_sock.sendall(f"{formatted_message}\n".encode('utf-8'))
-            except (ConnectionError, OSError) as e:
-                # Queue for removal
-                clients_to_remove.append(client_sock)
-            except Exception as e:
-                if not shutdown_flag.is_set():
-                    print(f"[SERVER] Error sending to client: {e}")
-                clients_to_remove.append(client_sock)
-        
-        # Remove dead clients
-        for client_sock in clients_to_remove:
-            remove_client(client_sock, silent=True)
+        elif session.queue.put(text_payload):
+            queued_text += 1
+            continue
+        # Closed, or over its limit under the disconnect policy
+        clients_to_remove.append(session.sock)
+
+    stats.inc('chat_messages_out_total', queued_text + queued_framed)
+    stats.inc('chat_bytes_out_total', queued_text * len(text_payload)
+              + (queued_framed * len(framed_payload) if queued_framed else 0))
+    stats.observe('chat_broadcast_seconds', time.perf_counter() - started)
+
+    for client_sock in clients_to_remove:
+        remove_client(client_sock, silent=True)
+
+class TcpTransport(chatcore.Transport):
+    """Shows core events to TCP clients as chat lines in their outbound queues."""
+    name = 'tcp'
+
+    def deliver(self, event, sessions, exclude=None):
+        if event.kind == chatcore.MESSAGE:
+            fan_out(f"[{event.timestamp}] {event.sender}: {event.text}", sessions, exclude)
+        elif event.quiet:
+            return
+        elif event.kind == chatcore.JOINED:
+            fan_out(f"\033[92m[{get_timestamp()}] A new user has joined the chat.\033[0m", sessions, exclude)
+        elif event.kind == chatcore.LEFT:
+            fan_out(f"\033[92m[{get_timestamp()}] {event.sender} has left the chat.\033[0m", sessions, exclude)
+
+    def deliver_dm(self, event, session, echo):
+        if echo:
+            # The sender's confirmation, so it answers their request
+            reply(session, f"[{event.timestamp}] [PM to {event.to}]: {event.text}\n")
+        else:
+            send_to_client(session.sock, f"[{event.timestamp}] [PM from {event.sender}]: {event.text}\n")
+
+    def notify(self, session, text, error=False):
+        send_to_client(session.sock, f"\033[{91 if error else 92}m{text}\033[0m\n")
+
+    def disconnect(self, session, kicked=False):
+        remove_client(session.sock, was_kicked=kicked)
+
+tcp = TcpTransport()
 
 def remove_client(client_sock, silent=False, was_kicked=False, server_shutdown=False):
     """Remove client from the clients dictionary.
@@ -145,172 +283,342 @@ def remove_client(client_sock, silent=False, was_kicked=False, server_shutdown=F
         was_kicked: If True, this is a forced removal due to kick
         server_shutdown: If True, this is part of a server shutdown
     """
-    global clients
-    with clients_lock:
-        if client_sock in clients:
-            name = clients[client_sock]
-            del clients[client_sock]
-            
-            # Only broadcast leave message if not silent and not kicked
-            if not silent and not was_kicked and not server_shutdown:
-                leave_msg = f"{name} has left the chat."
-                broadcast(leave_msg, is_system_message=True)
-                
-            # Add to chat history if not a server shutdown
-            if not server_shutdown:
-                chat_messages.append({
-                    'type': 'system',
-                    'content': f"{name} has left the chat.",
-                    'timestamp': get_timestamp()
-                })
-            
-            # Remove from suspended users if they were suspended
-            if name in suspended_users:
-                suspended_users.remove(name)
-                
-            print(f"Client disconnected: {name} ({client_sock.getpeername()[0]})")
-            
-            # Close the socket
-            try:
-                if not server_shutdown:
-                    client_sock.shutdown(socket.SHUT_RDWR)
-                client_sock.close()
-            except:
-                pass
+    # Only the first caller gets through, so cleanup runs once
+    session = registry.get(client_sock)
+    if session is None or not core.disconnect(session):
+        return
+    name = session.name
+    queue = session.queue
+    stats.inc('chat_disconnects_total')
+    stats.inc('chat_messages_dropped_total', queue.dropped)
+    stats.inc('chat_messages_coalesced_total', queue.coalesced)
+
+    # Add to chat history if not a server shutdown
+    if not server_shutdown:
+        chat_messages.append(get_timestamp(), 'system', f"{name} has left the chat.")
+
+    # Remove from suspended users if they were suspended
+    registry.unsuspend(name)
+
+    # Every transport updates its presence; only announce it if not silent and not kicked
+    core.leave(session, quiet=silent or was_kicked or server_shutdown)
+
+    try:
+        print(f"Client disconnected: {name} ({client_sock.getpeername()[0]})")
+    except OSError:
+        print(f"Client disconnected: {name}")
+
+    # Give the writer a moment to deliver the kick notice before closing
+    if queue is not None:
+        queue.close()
+        if was_kicked:
+            queue.flush()
+
+    # Close the socket
+    try:
+        if not server_shutdown:
+            client_sock.shutdown(socket.SHUT_RDWR)
+        client_sock.close()
+    except:
+        pass
+
+class ClientState:
+    """Per-connection state shared by both server engines."""
+    __slots__ = ('sock', 'addr', 'name', 'decoder', 'framed', 'queue', 'dm_recipient', 'user_list', 'throttled',
+                 'transport', 'member_id', 'request_id', 'search')
+
+    def __init__(self, sock, addr, name, decoder, queue=None):
+        self.sock = sock
+        self.addr = addr
+        self.name = name
+        self.decoder = decoder  # protocol.FrameDecoder or protocol.LineDecoder
+        self.framed = decoder.framed
+        self.queue = queue  # outbound.OutboundQueue
+        self.dm_recipient = None  # Set while the client is in DM mode
+        self.user_list = None  # Names last shown to this client by /list_users or /dm
+        self.throttled = False  # Told they are over the rate limit, and still are
+        self.transport = tcp
+        self.member_id = None  # Set by core.connect()
+        self.request_id = None  # Id of the REQUEST being handled, until it is replied to
+        self.search = None  # Last /search query and where its next page starts
+
+def read_hello(decoder):
+    """Name from a framed client's HELLO, or None if it has not fully arrived."""
+    for msg_type, text in decoder:
+        if msg_type != protocol.MSG_HELLO:
+            raise protocol.ProtocolError("Expected a HELLO frame")
+        return text.strip()
+    return None
+
+def start_handshake(data):
+    """Work out the client's protocol from the first bytes it sent.
+
+    Returns (decoder, name). name is None while a framed HELLO is incomplete.
+    """
+    if data.startswith(protocol.HANDSHAKE_MAGIC):
+        decoder = protocol.FrameDecoder()
+        decoder.feed(data[len(protocol.HANDSHAKE_MAGIC):])
+        return decoder, read_hello(decoder)
+    # Original text protocol: the first chunk is the bare name
+    return protocol.LineDecoder(), data.decode('utf-8').strip()
+
+def start_writer_thread(queue):
+    """Threaded engine: give the client's queue its own writer thread."""
+    def on_error(q):
+        if not shutdown_flag.is_set():
+            remove_client(q.sock, silent=True)
+    queue.on_error = on_error
+    threading.Thread(target=queue.run_writer, daemon=True).start()
+
+def register_client(client_sock, addr, name, decoder, attach_writer=start_writer_thread):
+    """Admit a client after the name handshake.
+
+    attach_writer(queue) decides who drains the client's outbound queue.
+    Returns a ClientState on success, or None if the client was turned away.
+    """
+    framed = decoder.framed
+    try:
+        if framed:
+            # Acknowledge the framed protocol before anything else
+            client_sock.sendall(protocol.encode_text(str(protocol.PROTOCOL_VERSION), protocol.MSG_HELLO))
+
+        # Check if user is kicked
+        if registry.is_kicked(name):
+            stats.inc('chat_connections_rejected_total{reason="kicked"}')
+            client_sock.sendall(encode_for(framed, "\033[91mYou have been kicked from the server.\033[0m\n"))
+            client_sock.close()
+            return None
+    except OSError:
+        client_sock.close()
+        return None
+
+    queue = outbound.OutboundQueue(client_sock, OUTBOUND_QUEUE_SIZE, SLOW_CONSUMER_POLICY)
+    state = ClientState(client_sock, addr, name, decoder, queue)
+
+    # Name check and registration happen in one step
+    if not core.connect(state):
+        stats.inc('chat_connections_rejected_total{reason="name_taken"}')
+        try:
+            client_sock.sendall(encode_for(framed, f"\033[91m[SERVER] The name '{name}' is already taken. Please reconnect with another name.\033[0m\n"))
+        except OSError:
+            pass
+        client_sock.close()
+        return None
+    attach_writer(queue)
+
+    # Connection info for server logs; the peer may already have hung up,
+    # so use the address from accept() rather than getpeername()
+    client_host, client_port = addr
+    print(f"[SERVER] New connection from {client_host}:{client_port} as '{name}'")
+
+    # Send welcome message to client
+    welcome = f"Welcome to the chat! Type /q or /quit to exit."
+    send_to_client(client_sock, f"\033[92m[{get_timestamp()}] {welcome}\033[0m")
+    # Notify others (without connection details)
+    core.enter(state)
+    return state
+
+def handle_dm_text(state, text):
+    """Handle a line typed while the client is in DM mode."""
+    recipient = state.dm_recipient
+    if text.lower() == '/back':
+        state.dm_recipient = None
+        reply(state, "[SERVER] Exited DM mode.\n")
+        return
+
+    started = time.perf_counter()
+    # The core confirms it to the sender as well
+    if core.send_dm(state, recipient, text, get_timestamp()) is not None:
+        stats.observe('chat_dm_seconds', time.perf_counter() - started)
+    else:
+        # Stay in DM mode until /back: clients may have more DMs on the way,
+        # and those must not turn into public messages
+        reply(state, "[SERVER] Failed to send private message. User may have disconnected. "
+                     "Type /back to exit DM mode.\n")
+
+def allow_message(state):
+    """Charge a message to the client's rate limits.
+
+    Over the limit, the message is dropped and the client is told so
+    once, with how long to wait, until it gets a message through again.
+    """
+    throttle = limiter.check(state.name, state.addr[0] if state.addr else None)
+    if throttle is None:
+        state.throttled = False
+        return True
+    scope, wait = throttle
+    stats.inc(f'chat_messages_throttled_total{{scope="{scope}"}}')
+    if not state.throttled:
+        state.throttled = True
+        reply(state, f"[SERVER] You are sending too fast ({scope} limit); "
+                     f"messages are dropped. Try again in {wait:.1f}s.\n")
+    return False
+
+def handle_client_text(state, text):
+    """Process one message from a registered client.
+
+    Returns False when the client asked to disconnect.
+    """
+    client_sock = state.sock
+    name = state.name
+
+    # Leaving DM mode or the chat is never throttled: a dropped /back would
+    # turn the user's next public lines into DMs
+    if text.lower() not in ('/q', '/quit', '/back') and not allow_message(state):
+        return True
+
+    if state.dm_recipient is not None:
+        try:
+            handle_dm_text(state, text)
+        except Exception as e:
+            print(f"Error in DM session: {e}")
+            state.dm_recipient = None
+        return True
+
+    # Check if user is suspended
+    if registry.is_suspended(name) and not text.lower() in ('/q', '/quit'):
+        reply(state, "\033[91m[ERROR] You are suspended and cannot send messages.\033[0m\n")
+        return True
+
+    # Handle commands
+    if text == '/list_users':
+        # Send list of online users to the client
+        users_list = list_online_users(client_sock)
+        reply(state, users_list)
+        return True
+
+    elif text.startswith('/dm'):
+        # Check if this is a DM user selection
+        if ' ' in text:
+            parts = text.split(' ', 1)
+            if len(parts) == 2 and parts[1].isdigit():
+                try:
+                    user_num = int(parts[1]) - 1
+                    user_list = state.user_list
+                    if user_list is None:
+                        user_list = registry.names(client_sock)
+
+                    recipient = user_list[user_num] if 0 <= user_num < len(user_list) else None
+                    if recipient is not None and find_session(recipient, exact=True) is None:
+                        reply(state, f"[SERVER] {recipient} is no longer online.\n")
+                    elif recipient is not None:
+                        reply(state, f"[SERVER] DM session started with {recipient}. Type /back to exit.\n")
+                        state.dm_recipient = recipient
+                    else:
+                        reply(state, "[SERVER] Invalid user number.\n")
+                except (ValueError, IndexError):
+                    reply(state, "[SERVER] Invalid selection. Use /dm to try again.\n")
+                except Exception as e:
+                    reply(state, f"[SERVER] Error: {str(e)}\n")
+            return True
+
+        # If just /dm was sent, show user list
+        users_list = list_online_users(client_sock)
+        reply(state, users_list)
+        return True
+
+    elif text.startswith('/save'):
+        save_chat_log(client_sock, text)
+    elif text.split(' ', 1)[0].lower() == '/search':
+        search_messages(state, text)
+        return True
+    elif text.lower() in ("/q", "/quit"):
+        return False
+
+    # Only broadcast if it's not a command that was already handled
+    if text and not text.startswith(('/pm', '/save')):
+        core.post(state, chatcore.GENERAL, text, get_timestamp())
+    return True
+
+def handle_buffered(state):
+    """Handle every complete message already in the client's decoder.
+
+    Returns False when the client asked to disconnect.
+    """
+    for msg_type, text in state.decoder:
+        if msg_type == protocol.MSG_REQUEST:
+            state.request_id, text = protocol.parse_tagged(text)
+        elif msg_type != protocol.MSG_TEXT:
+            continue
+        stats.inc('chat_messages_in_total')
+        # Text protocol lines have no length limit; cut them (and framed
+        # payloads) so the relayed line still fits in one frame
+        keep = handle_client_text(state, protocol.clip(text).strip())
+        if state.request_id is not None:
+            reply(state, "")  # Nothing to say: still complete the request
+        if not keep:
+            return False
+    return True
+
+def handle_eof(state):
+    """Handle an unterminated last line left when the client hung up."""
+    for msg_type, text in state.decoder.finish():
+        if msg_type == protocol.MSG_TEXT:
+            handle_client_text(state, protocol.clip(text).strip())
 
 def handle_client(client_sock, addr):
     """Handle a single client: read name first, then incoming messages."""
-    name = None
     try:
         # Set initial socket timeout for handshake
         client_sock.settimeout(5.0)  # Give more time for initial connection
-        
+
         # Get client's name with timeout
         try:
-            name_data = client_sock.recv(1024).decode('utf-8').strip()
-            if not name_data:
-                return
-            name = name_data
-            
-            # Check if user is kicked
-            if name in kicked_users:
-                client_sock.sendall("\033[91mYou have been kicked from the server.\033[0m\n".encode('utf-8'))
-                client_sock.close()
+            decoder, name = start_handshake(client_sock.recv(1024))
+            while name is None:
+                if not decoder.fill(client_sock):
+                    break
+                name = read_hello(decoder)
+            if not name:
+                stats.inc('chat_connections_rejected_total{reason="handshake"}')
                 return
-                
         except socket.timeout:
             print(f"[SERVER] Timeout waiting for name from {addr}")
+            stats.inc('chat_connections_rejected_total{reason="handshake"}')
             return
         except Exception as e:
             print(f"[SERVER] Error getting name from {addr}: {e}")
+            stats.inc('chat_connections_rejected_total{reason="handshake"}')
             return
-            
+
         # Disable timeout after successful connection
         client_sock.settimeout(None)
-            
-        # Add client to the clients dictionary
-        with clients_lock:
-            clients[client_sock] = name
-            
-        # Get connection info for server logs
-        client_host, client_port = client_sock.getpeername()
-        print(f"[SERVER] New connection from {client_host}:{client_port} as '{name}'")
-        
-        # Send welcome message to client
-        welcome = f"Welcome to the chat! Type /q or /quit to exit."
-        try:
-            client_sock.sendall(f"\033[92m[{get_timestamp()}] {welcome}\033[0m".encode('utf-8'))
-            # Notify others (without connection details)
-            broadcast("A new user has joined the chat.\n", 
-                     exclude_sock=client_sock, 
-                     is_system_message=True)
-        except:
-            with clients_lock:
-                clients.pop(client_sock, None)
+
+        state = register_client(client_sock, addr, name, decoder)
+        if state is None:
             return
 
         # Listen for further messages
-        while True:
-            data = client_sock.recv(2048)
-            if not data:
+        while handle_buffered(state):
+            received = state.decoder.fill(client_sock)
+            if not received:
+                handle_eof(state)
                 break
-            text = data.decode('utf-8').strip()
-            
-            # Check if user is suspended
-            with clients_lock:
-                if name in suspended_users and not text.lower() in ('/q', '/quit'):
-                    client_sock.sendall("\033[91m[ERROR] You are suspended and cannot send messages.\033[0m\n".encode('utf-8'))
-                    continue
-                    
-            # Handle commands
-            if text == '/list_users':
-                # Send list of online users to the client
-                users_list = list_online_users(client_sock)
-                client_sock.sendall(users_list.encode('utf-8'))
-                continue
-                
-            elif text.startswith('/dm'):
-                # Check if this is a DM user selection
-                if ' ' in text:
-                    parts = text.split(' ', 1)
-                    if len(parts) == 2 and parts[1].isdigit():
-                        try:
-                            user_num = int(parts[1]) - 1
-                            with clients_lock:
-                                user_list = [name for sock, name in clients.items() if sock is not client_sock]
-                            
-                            if 0 <= user_num < len(user_list):
-                                recipient = user_list[user_num]
-                                client_sock.sendall(f"[SERVER] DM session started with {recipient}. Type /back to exit.\n".encode('utf-8'))
-                                
-                                while True:
-                                    try:
-                                        # Wait for message
-                                        message_data = client_sock.recv(1024).decode('utf-8').strip()
-                                        if not message_data:
-                                            break
-                                            
-                                        if message_data.lower() == '/back':
-                                            client_sock.sendall("[SERVER] Exited DM mode.\n".encode('utf-8'))
-                                            break
-                                            
-                                        if send_private_message(client_sock, recipient, message_data):
-                                            # Send confirmation to sender
-                                            timestamp = get_timestamp()
-                                            client_sock.sendall(f"[{timestamp}] [PM to {recipient}]: {message_data}\n".encode('utf-8'))
-                                        else:
-                                            client_sock.sendall("[SERVER] Failed to send private message. User may have disconnected.\n".encode('utf-8'))
-                                            break
-                                    except Exception as e:
-                                        print(f"Error in DM session: {e}")
-                                        break
-                            else:
-                                client_sock.sendall("[SERVER] Invalid user number.\n".encode('utf-8'))
-                        except (ValueError, IndexError):
-                            client_sock.sendall("[SERVER] Invalid selection. Use /dm to try again.\n".encode('utf-8'))
-                        except Exception as e:
-                            client_sock.sendall(f"[SERVER] Error: {str(e)}\n".encode('utf-8'))
-                    continue
-                
-                # If just /dm was sent, show user list
-                users_list = list_online_users(client_sock)
-                client_sock.sendall(users_list.encode('utf-8'))
-                    
-            elif text.startswith('/save'):
-                save_chat_log(client_sock)
-            elif text.lower() in ("/q", "/quit"):
-                break
-                
-            # Only broadcast if it's not a command that was already handled
-            if not text.startswith(('/pm', '/save')):
-                broadcast(f"{text}\n", sender_name=name)
+            stats.inc('chat_bytes_in_total', received)
     except Exception as e:
         # print for server-side debugging
         print(f"Error with {addr}: {e}")
     finally:
         remove_client(client_sock)
 
+def close_all_clients(server_sock):
+    """Close every client connection and the listening socket."""
+    print("\n[SERVER] Shutting down...")
+    for session in tcp_sessions():
+        try:
+            session.sock.shutdown(socket.SHUT_RDWR)
+            session.sock.close()
+        except:
+            pass
+    try:
+        server_sock.shutdown(socket.SHUT_RDWR)
+    except:
+        pass
+    server_sock.close()
+    print("[SERVER] Server socket closed.")
+
 def accept_connections(server_sock):
+    """Threaded engine: one blocking thread per client."""
     print(f"[SERVER] Listening on {HOST}:{PORT}")
     try:
         while not shutdown_flag.is_set():
@@ -318,6 +626,7 @@ def accept_connections(server_sock):
                 # Set a timeout to check the shutdown flag periodically
                 server_sock.settimeout(1.0)
                 client_sock, addr = server_sock.accept()
+                stats.inc('chat_connections_accepted_total')
                 # Don't set timeout here, let handle_client manage it
                 client_thread = threading.Thread(target=handle_client, args=(client_sock, addr))
                 client_thread.daemon = True
@@ -332,20 +641,205 @@ def accept_connections(server_sock):
         if not shutdown_flag.is_set():
             print(f"[SERVER] Error in accept_connections: {e}")
     finally:
-        print("\n[SERVER] Shutting down...")
-        with clients_lock:
-            for client_sock in list(clients.keys()):
-                try:
-                    client_sock.shutdown(socket.SHUT_RDWR)
-                    client_sock.close()
-                except:
-                    pass
+        close_all_clients(server_sock)
+
+def run_selector_loop(server_sock):
+    """Selector engine: drive every client from a single event loop.
+
+    Uses the best readiness API available (epoll on Linux). Client sockets
+    are non-blocking: reads happen when the selector reports a socket
+    readable, and each client's outbound queue is drained when it is
+    writable, so no thread ever blocks on a single client.
+    """
+    print(f"[SERVER] Listening on {HOST}:{PORT} (selector engine)")
+    sel = selectors.DefaultSelector()
+    server_sock.setblocking(False)
+    sel.register(server_sock, selectors.EVENT_READ, data=None)
+    # Producers on other threads (console, kicks) wake the loop through this pair
+    wake_r, wake_w = socket.socketpair()
+    wake_r.setblocking(False)
+    wake_w.setblocking(False)
+    sel.register(wake_r, selectors.EVENT_READ, data=None)
+    pending = {}  # {socket: (addr, handshake deadline, decoder)} before the name arrives
+    states = {}  # {socket: ClientState} for registered clients
+    want_write = set()  # Sockets whose queues received data since the last pass
+    want_write_lock = threading.Lock()
+
+    def on_ready(queue):
+        with want_write_lock:
+            first = not want_write
+            want_write.add(queue.sock)
+        if first:
+            try:
+                wake_w.send(b"\0")
+            except (BlockingIOError, OSError):
+                pass
+
+    def drop(sock):
+        """Unregister a socket and release everything tied to it."""
         try:
-            server_sock.shutdown(socket.SHUT_RDWR)
-        except:
+            sel.unregister(sock)
+        except (KeyError, ValueError):
             pass
-        server_sock.close()
-        print("[SERVER] Server socket closed.")
+        pending.pop(sock, None)
+        if states.pop(sock, None) is not None:
+            remove_client(sock)
+        else:
+            try:
+                sock.close()
+            except:
+                pass
+
+    def reap():
+        """Forget sockets closed by other threads (kick, overflow)."""
+        for sock in [s for s in states if s.fileno() == -1 or registry.get(s) is None]:
+            drop(sock)
+        now = time.monotonic()
+        for sock, (addr, deadline, _) in list(pending.items()):
+            if now > deadline:
+                print(f"[SERVER] Timeout waiting for name from {addr}")
+                stats.inc('chat_connections_rejected_total{reason="handshake"}')
+                drop(sock)
+
+    def watch_writes():
+        """Start watching for writability on sockets with queued output."""
+        with want_write_lock:
+            ready = list(want_write)
+            want_write.clear()
+        for sock in ready:
+            if sock in states and sock.fileno() != -1:
+                sel.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=states[sock].addr)
+
+    def reject(sock):
+        stats.inc('chat_connections_rejected_total{reason="handshake"}')
+        drop(sock)
+
+    def read_name(sock):
+        addr, deadline, decoder = pending[sock]
+        try:
+            if decoder is None:
+                data = sock.recv(1024)
+                if not data:
+                    reject(sock)
+                    return
+                decoder, name = start_handshake(data)
+            elif decoder.fill(sock):
+                name = read_hello(decoder)
+            else:
+                reject(sock)
+                return
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            print(f"[SERVER] Error getting name from {addr}: {e}")
+            reject(sock)
+            return
+        if name is None:
+            pending[sock] = (addr, deadline, decoder)  # Framed HELLO still incomplete
+            return
+        del pending[sock]
+        if not name:
+            reject(sock)
+            return
+        state = register_client(sock, addr, name, decoder,
+                                attach_writer=lambda queue: setattr(queue, 'on_ready', on_ready))
+        if state is None:
+            try:
+                sel.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+            return
+        states[sock] = state
+        # The first messages may have arrived together with the handshake
+        if not handle_buffered(state):
+            drop(sock)
+
+    def read_message(sock):
+        state = states[sock]
+        try:
+            received = state.decoder.fill(sock)
+            if not received:
+                handle_eof(state)
+                drop(sock)
+                return
+            stats.inc('chat_bytes_in_total', received)
+            if not handle_buffered(state):
+                drop(sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            print(f"Error with {state.addr}: {e}")
+            drop(sock)
+
+    def write_pending(sock):
+        try:
+            if states[sock].queue.send_pending():
+                sel.modify(sock, selectors.EVENT_READ, data=states[sock].addr)
+        except OSError:
+            drop(sock)
+
+    try:
+        while not shutdown_flag.is_set():
+            for key, mask in sel.select(timeout=1.0):
+                sock = key.fileobj
+                if sock is wake_r:
+                    try:
+                        while wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                elif key.data is None:
+                    try:
+                        client_sock, addr = server_sock.accept()
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    stats.inc('chat_connections_accepted_total')
+                    reap()
+                    client_sock.setblocking(False)
+                    pending[client_sock] = (addr, time.monotonic() + 5.0, None)
+                    sel.register(client_sock, selectors.EVENT_READ, data=addr)
+                elif sock in pending:
+                    read_name(sock)
+                elif sock in states:
+                    if mask & selectors.EVENT_WRITE:
+                        write_pending(sock)
+                    if mask & selectors.EVENT_READ and sock in states:
+                        read_message(sock)
+            reap()
+            watch_writes()
+    except Exception as e:
+        if not shutdown_flag.is_set():
+            print(f"[SERVER] Error in selector loop: {e}")
+    finally:
+        for sock in list(pending):
+            drop(sock)
+        sel.close()
+        wake_r.close()
+        wake_w.close()
+        close_all_clients(server_sock)
+
+ENGINES = {
+    'threaded': accept_connections,
+    'selector': run_selector_loop,
+}
+
+def serve(chat_core, host=HOST, port=PORT, engine=ENGINE):
+    """Run the TCP frontend in the background over another frontend's core.
+
+    app.py calls this to bridge CLI clients into the web chat (CHAT_TCP_PORT).
+    Returns the listening socket; set shutdown_flag to stop.
+    """
+    global core, registry, chat_messages, HOST, PORT
+    core, registry = chat_core, chat_core.registry
+    if core.history is not None:
+        chat_messages = core.history
+    HOST, PORT = host, port
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_sock.bind((host, port))
+    server_sock.listen(5)
+    threading.Thread(target=ENGINES[engine], args=(server_sock,), daemon=True).start()
+    return server_sock
 
 def server_console():
     """Handle server console input for server commands and chat mode"""
@@ -385,6 +879,8 @@ def server_console():
         print(f"{color_text('/chat', 'LIGHT_BLUE')}    - Enter chat mode")
         print(f"{color_text('/users', 'LIGHT_BLUE')}   - Show connected users")
         print(f"{color_text('/list', 'LIGHT_BLUE')}    - List all connected clients (detailed)")
+        print(f"{color_text('/queues', 'LIGHT_BLUE')}  - Show per-client outbound queue depth")
+        print(f"{color_text('/stats', 'LIGHT_BLUE')}   - Show server metrics")
         print(f"{color_text('/kick <user>', 'LIGHT_RED')}    - Disconnect a user")
         print(f"{color_text('/kick -ls', 'LIGHT_BLUE')}      - List all kicked users")
         print(f"{color_text('/revive <user>', 'LIGHT_GREEN')} - Allow a kicked user to reconnect")
@@ -425,12 +921,12 @@ def server_console():
                 if not chat_messages:
                     print(color_text("No recent messages.", 'GRAY'))
                 else:
-                    for msg in chat_messages[-10:]:
-                        if msg['type'] == 'system':
-                            print(format_chat_message(msg['timestamp'], "SYSTEM", msg['content'], is_system=True))
+                    for msg in chat_messages.recent(10):
+                        if msg.type == 'system':
+                            print(format_chat_message(msg.timestamp, "SYSTEM", msg.content, is_system=True))
                         else:
-                            sender, content = msg['content'].split(': ', 1) if ': ' in msg['content'] else ("UNKNOWN", msg['content'])
-                            print(format_chat_message(msg['timestamp'], sender, content))
+                            sender, content = msg.content.split(': ', 1) if ': ' in msg.content else ("UNKNOWN", msg.content)
+                            print(format_chat_message(msg.timestamp, sender, content))
                 
                 in_chat_mode = True
                 continue
@@ -442,11 +938,10 @@ def server_console():
                 
             # Helper function to find client by name
             def find_client_by_name(target_name):
-                with clients_lock:
-                    for sock, name in clients.items():
-                        if name.lower() == target_name.lower():
-                            return sock, name
+                session = find_session(target_name)
+                if session is None:
                     return None, None
+                return session, session.name
 
             # Handle server commands (only in server mode)
             if not in_chat_mode:
@@ -459,29 +954,73 @@ def server_console():
                 elif cmd == '/list':
                     print("\n" + color_text("Connected Clients:", 'BOLD'))
                     print("-" * 50)
-                    with clients_lock:
-                        if not clients:
-                            print(color_text("  No users connected.", 'GRAY'))
-                        else:
-                            for i, (sock, name) in enumerate(clients.items(), 1):
-                                try:
-                                    addr = sock.getpeername()
-                                    status = color_text("SUSPENDED", 'LIGHT_RED') if name in suspended_users else color_text("ACTIVE", 'LIGHT_GREEN')
-                                    print(f"  {i}. {color_text(name, 'YELLOW')} ({color_text(f'{addr[0]}:{addr[1]}', 'GRAY')}) - {status}")
-                                except:
-                                    print(f"  {i}. {color_text(name, 'YELLOW')} {color_text('(disconnected)', 'GRAY')}")
+                    members = registry.members
+                    if not members:
+                        print(color_text("  No users connected.", 'GRAY'))
+                    else:
+                        for i, session in enumerate(members, 1):
+                            name = session.name
+                            if session.transport is not tcp:
+                                # Bridged in from another frontend (app.py)
+                                status = color_text("SUSPENDED", 'LIGHT_RED') if registry.is_suspended(name) else color_text("ACTIVE", 'LIGHT_GREEN')
+                                print(f"  {i}. {color_text(name, 'YELLOW')} ({color_text(session.transport.name, 'GRAY')}) - {status}")
+                                continue
+                            try:
+                                addr = session.sock.getpeername()
+                                status = color_text("SUSPENDED", 'LIGHT_RED') if registry.is_suspended(name) else color_text("ACTIVE", 'LIGHT_GREEN')
+                                queue = session.queue
+                                depth = f"queue {len(queue)}/{queue.maxlen}"
+                                print(f"  {i}. {color_text(name, 'YELLOW')} ({color_text(f'{addr[0]}:{addr[1]}', 'GRAY')}) - {status} - {color_text(depth, 'GRAY')}")
+                            except:
+                                print(f"  {i}. {color_text(name, 'YELLOW')} {color_text('(disconnected)', 'GRAY')}")
                     print()
                 
+                # Show outbound queue depth per client
+                elif cmd == '/queues':
+                    print("\n" + color_text("Outbound Queues:", 'BOLD') + f" (policy: {SLOW_CONSUMER_POLICY}, limit: {OUTBOUND_QUEUE_SIZE})")
+                    print("-" * 50)
+                    rows = [(session.name, session.queue) for session in tcp_sessions()]
+                    if not rows:
+                        print(color_text("  No users connected.", 'GRAY'))
+                    for i, (name, queue) in enumerate(rows, 1):
+                        depth = len(queue)
+                        color = 'LIGHT_RED' if depth >= queue.maxlen else 'YELLOW' if depth > queue.maxlen // 2 else 'LIGHT_GREEN'
+                        print(f"  {i}. {color_text(name, 'YELLOW')} - depth {color_text(str(depth), color)}"
+                              f" - dropped {queue.dropped} - coalesced {queue.coalesced}")
+                    print()
+
+                # Show server metrics
+                elif cmd == '/stats':
+                    counters, gauges, histograms = stats.snapshot()
+                    print("\n" + color_text("Server Metrics:", 'BOLD'))
+                    print("-" * 50)
+                    for name in sorted(gauges):
+                        print(f"  {name:<52} {color_text(gauges[name], 'YELLOW')}")
+                    for name in sorted(counters):
+                        print(f"  {name:<52} {color_text(counters[name], 'YELLOW')}")
+                    if histograms:
+                        print("\n" + color_text("Latencies:", 'BOLD') + " (p50/p99 are bucket upper bounds)")
+                        print("-" * 50)
+                    for name in sorted(histograms):
+                        hist = histograms[name]
+                        count = sum(hist[:-1])
+                        if not count:
+                            continue
+                        p50, p99 = stats.quantile(hist, 0.5), stats.quantile(hist, 0.99)
+                        print(f"  {name:<52} count {count} - avg {hist[-1] / count * 1000:.3f} ms"
+                              f" - p50 <= {p50 * 1000:g} ms - p99 <= {p99 * 1000:g} ms")
+                    print()
+
                 # Show basic user list
                 elif cmd == '/users':
                     print("\n" + color_text("Connected users:", 'BOLD'))
-                    with clients_lock:
-                        if not clients:
-                            print(color_text("  No users connected.", 'GRAY'))
-                        else:
-                            for i, (sock, name) in enumerate(clients.items(), 1):
-                                status = "(suspended)" if name in suspended_users else ""
-                                print(f"  {i}. {color_text(name, 'YELLOW')} {color_text(status, 'LIGHT_RED')}")
+                    names = registry.names()
+                    if not names:
+                        print(color_text("  No users connected.", 'GRAY'))
+                    else:
+                        for i, name in enumerate(names, 1):
+                            status = "(suspended)" if registry.is_suspended(name) else ""
+                            print(f"  {i}. {color_text(name, 'YELLOW')} {color_text(status, 'LIGHT_RED')}")
                     print()
                 
                 # Kick a user or list kicked users
@@ -490,13 +1029,15 @@ def server_console():
                     
                     # Handle list command
                     if args and args[0] == '-ls':
-                        if not kicked_users:
+                        kicked = registry.kicked
+                        if not kicked:
                             print(color_text("\nNo users have been kicked.", 'LIGHT_YELLOW'))
                         else:
                             print("\n" + color_text("Kicked Users:", 'BOLD') + " (use /revive <user> to allow reconnection)")
                             print("-" * 60)
-                            for i, (name, (host, port)) in enumerate(kicked_users.items(), 1):
-                                print(f"  {i}. {color_text(name, 'YELLOW')} - {color_text(f'{host}:{port}', 'GRAY')}")
+                            for i, (name, addr) in enumerate(kicked.items(), 1):
+                                where = f'{addr[0]}:{addr[1]}' if addr else 'unknown address'
+                                print(f"  {i}. {color_text(name, 'YELLOW')} - {color_text(where, 'GRAY')}")
                         continue
                         
                     target_name = ' '.join(args).strip()
@@ -506,21 +1047,12 @@ def server_console():
                         print(color_text("  /kick -ls       - List all kicked users", 'GRAY'))
                         continue
                         
-                    target_sock, target_name = find_client_by_name(target_name)
-                    if target_sock:
+                    target, target_name = find_client_by_name(target_name)
+                    if target:
                         try:
-                            # Get client info before removing
-                            client_host, client_port = target_sock.getpeername()
-                            # Store kicked user info for potential revival
-                            kicked_users[target_name] = (client_host, client_port)
-                            
-                            target_sock.sendall("\033[91mYou have been kicked by the server admin.\033[0m\n".encode('utf-8'))
+                            # Remembers where they came from, tells them, and closes the connection
+                            core.kick(target, target.addr)
                             print(color_text(f"\nKicked user: {target_name}", 'LIGHT_RED'))
-                            # Remove from suspended users if they were suspended
-                            if target_name in suspended_users:
-                                suspended_users.remove(name)
-                            # Close the connection with was_kicked flag
-                            remove_client(target_sock, was_kicked=True)
                         except Exception as e:
                             print(color_text(f"\nError kicking user {target_name}: {e}", 'LIGHT_RED'))
                     else:
@@ -533,15 +1065,14 @@ def server_console():
                         print(color_text("\nError: Please specify a username to revive", 'LIGHT_RED'))
                         continue
                         
-                    if target_name in kicked_users:
-                        del kicked_users[target_name]
+                    if registry.revive(target_name):
                         print(color_text(f"\nUser '{target_name}' can now reconnect", 'LIGHT_GREEN'))
                         
                         # Notify the user if they're currently connected
-                        target_sock, _ = find_client_by_name(target_name)
-                        if target_sock:
+                        target, _ = find_client_by_name(target_name)
+                        if target:
                             try:
-                                target_sock.sendall("\033[92mYou have been revived by the server admin. You can now send messages.\033[0m\n".encode('utf-8'))
+                                target.transport.notify(target, "You have been revived by the server admin. You can now send messages.")
                             except:
                                 pass
                     else:
@@ -553,12 +1084,13 @@ def server_console():
                     
                     # Handle list command
                     if args and args[0] == '-ls':
-                        if not suspended_users:
+                        suspended = registry.suspended
+                        if not suspended:
                             print(color_text("\nNo users are currently suspended.", 'LIGHT_YELLOW'))
                         else:
                             print("\n" + color_text("Suspended Users:", 'BOLD') + " (use /!suspend <user> to unsuspend)")
                             print("-" * 60)
-                            for i, name in enumerate(sorted(suspended_users), 1):
+                            for i, name in enumerate(sorted(suspended), 1):
                                 print(f"  {i}. {color_text(name, 'YELLOW')}")
                         continue
                         
@@ -571,16 +1103,15 @@ def server_console():
                         
                     _, target_name = find_client_by_name(target_name)
                     if target_name:
-                        if target_name in suspended_users:
+                        if not registry.suspend(target_name):
                             print(color_text(f"\nUser '{target_name}' is already suspended. Use /!suspend to unsuspend.", 'LIGHT_YELLOW'))
                         else:
-                            suspended_users.add(target_name)
                             print(color_text(f"\nSuspended user: {target_name}", 'LIGHT_RED'))
                             try:
-                                # Find the socket to send the suspend message
-                                target_sock, _ = find_client_by_name(target_name)
-                                if target_sock:
-                                    target_sock.sendall("\033[91mYou have been suspended by the server admin and cannot send messages.\033[0m\n".encode('utf-8'))
+                                # Find the session to send the suspend message
+                                target, _ = find_client_by_name(target_name)
+                                if target:
+                                    target.transport.notify(target, "You have been suspended by the server admin and cannot send messages.", error=True)
                             except:
                                 pass
                     else:
@@ -595,14 +1126,13 @@ def server_console():
                         
                     _, target_name = find_client_by_name(target_name)
                     if target_name:
-                        if target_name in suspended_users:
-                            suspended_users.remove(target_name)
+                        if registry.unsuspend(target_name):
                             print(color_text(f"\nRemoved suspension for user: {target_name}", 'LIGHT_GREEN'))
                             try:
-                                # Find the socket to send the unsuspend message
-                                target_sock, _ = find_client_by_name(target_name)
-                                if target_sock:
-                                    target_sock.sendall("\033[92mYou have been unsuspended by the server admin.\033[0m\n".encode('utf-8'))
+                                # Find the session to send the unsuspend message
+                                target, _ = find_client_by_name(target_name)
+                                if target:
+                                    target.transport.notify(target, "You have been unsuspended by the server admin.")
                             except:
                                 pass
                         else:
@@ -626,8 +1156,96 @@ def server_console():
                 print(f"Error: {e}")
             continue
 
+def history_size(text):
+    """argparse type for --history-size: 0 (spill everything) or more."""
+    size = int(text)
+    if size < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or more, not {size}")
+    return size
+
+def queue_size(text):
+    """argparse type for --queue-size: 1 or more."""
+    size = int(text)
+    if size < 1:
+        raise argparse.ArgumentTypeError(f"must be 1 or more, not {size}")
+    return size
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Real-time CLI chat server")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default=ENGINE,
+                        help="connection engine (default: %(default)s)")
+    parser.add_argument('--queue-size', type=queue_size, default=OUTBOUND_QUEUE_SIZE,
+                        help="messages buffered per client (default: %(default)s)")
+    parser.add_argument('--slow-consumer', choices=outbound.POLICIES, default=SLOW_CONSUMER_POLICY,
+                        help="policy when a client's queue is full (default: %(default)s)")
+    parser.add_argument('--history-size', type=history_size, default=HISTORY_SIZE,
+                        help="chat messages kept in memory, 0 for none (default: %(default)s)")
+    parser.add_argument('--history-dir', default=HISTORY_DIR,
+                        help="directory for older chat history segments without a store (default: %(default)s)")
+    parser.add_argument('--store', default=STORE_PATH,
+                        help="message store file, '' for segment files only (default: %(default)s)")
+    parser.add_argument('--durability', choices=list(store.DURABILITY_LEVELS), default=STORE_DURABILITY,
+                        help="how far each commit to the store goes (default: %(default)s)")
+    parser.add_argument('--export-dir', default=EXPORT_DIR,
+                        help="directory /save writes chat logs to (default: %(default)s)")
+    parser.add_argument('--export-compression', choices=sorted(export.COMPRESSIONS), default=EXPORT_COMPRESSION,
+                        help="default compression for /save (default: %(default)s)")
+    parser.add_argument('--rate-limit-user', default=RATE_LIMIT_USER,
+                        help="messages per second/burst per user, or off (default: %(default)s)")
+    parser.add_argument('--rate-limit-ip', default=RATE_LIMIT_IP,
+                        help="messages per second/burst per IP address, or off (default: %(default)s)")
+    parser.add_argument('--rate-limit-global', default=RATE_LIMIT_GLOBAL,
+                        help="messages per second/burst for the whole server, or off (default: %(default)s)")
+    parser.add_argument('--search-max-docs', type=int, default=SEARCH_MAX_DOCS,
+                        help="messages /search can find, newest first; 0 turns search off (default: %(default)s)")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="serve Prometheus metrics on this port (default: off)")
+    parser.add_argument('--metrics-host', default=METRICS_HOST,
+                        help="address for the metrics endpoint (default: %(default)s)")
+    return parser.parse_args()
+
 def main():
-    global shutdown_flag
+    global shutdown_flag, OUTBOUND_QUEUE_SIZE, SLOW_CONSUMER_POLICY, EXPORT_COMPRESSION, chat_messages, limiter
+    args = parse_args()
+    OUTBOUND_QUEUE_SIZE = args.queue_size
+    SLOW_CONSUMER_POLICY = args.slow_consumer
+    try:
+        message_store = store.MessageStore(args.store, args.durability) if args.store else None
+    except store.StoreError as e:
+        print(f"[SERVER] {e}")
+        sys.exit(1)
+    chat_messages = history.ChatHistory(args.history_size, args.history_dir,
+                                        lock=metrics.TimedLock(stats, 'chat_lock_wait_seconds{lock="history"}'),
+                                        store=message_store)
+    core.history = chat_messages
+    core.bus = bus.LocalBus(message_store)  # DM history goes to the store too
+    try:
+        export.check_compression(args.export_compression)
+    except export.ExportError as e:
+        print(f"[SERVER] {e}")
+        sys.exit(1)
+    EXPORT_COMPRESSION = args.export_compression
+    try:
+        limiter = ratelimit.RateLimiter(ratelimit.parse_limit(args.rate_limit_user),
+                                        ratelimit.parse_limit(args.rate_limit_ip),
+                                        ratelimit.parse_limit(args.rate_limit_global),
+                                        lock=metrics.TimedLock(stats, 'chat_lock_wait_seconds{lock="ratelimit"}'))
+    except ratelimit.LimitError as e:
+        print(f"[SERVER] {e}")
+        sys.exit(1)
+    exporter.export_dir = args.export_dir
+    if args.search_max_docs > 0:
+        core.search = searchindex.SearchIndex(args.search_max_docs)
+        if message_store is not None:
+            # Before any client connects, so every message is loaded or added, never both
+            searchindex.load_in_background(core.search, message_store, on_done=lambda count: print(
+                f"[SERVER] Search: {count} stored messages loaded"))
+    if args.metrics_port is not None:
+        try:
+            stats.serve(args.metrics_host, args.metrics_port)
+        except OSError as e:
+            print(f"[SERVER] Cannot serve metrics on {args.metrics_host}:{args.metrics_port}: {e}")
+            sys.exit(1)
     
     server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -640,11 +1258,18 @@ def main():
         print("\n" + "="*50)
         print("Server started successfully!")
         print(f"Listening on {HOST}:{PORT}")
+        print(f"Engine: {args.engine}")
+        print(f"Slow consumers: {SLOW_CONSUMER_POLICY} (queue limit {OUTBOUND_QUEUE_SIZE})")
+        print(f"Rate limits: user {args.rate_limit_user}, ip {args.rate_limit_ip}, global {args.rate_limit_global}")
+        if args.metrics_port is not None:
+            print(f"Metrics: http://{args.metrics_host}:{args.metrics_port}/metrics")
+        if message_store is not None:
+            print(f"History: {args.store} ({args.durability}), {len(chat_messages)} messages recovered")
         print("Type /help for available commands")
         print("="*50 + "\n")
 
         # Start accepting connections in a separate thread
-        accept_thread = threading.Thread(target=accept_connections, args=(server_sock,))
+        accept_thread = threading.Thread(target=ENGINES[args.engine], args=(server_sock,))
         accept_thread.daemon = True
         accept_thread.start()
         
@@ -662,20 +1287,18 @@ def main():
             time.sleep(0.1)
         
         # Close all client connections without sending leave messages
-        with clients_lock:
-            for client_sock in list(clients.keys()):
-                try:
-                    client_sock.shutdown(socket.SHUT_RDWR)
-                except:
-                    pass
-                try:
-                    client_sock.close()
-                except:
-                    pass
-        
+        for session in tcp_sessions():
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+            try:
+                session.sock.close()
+            except:
+                pass
+
         # Clear clients list
-        with clients_lock:
-            clients.clear()
+        registry.clear()
         
         # Close server socket
         try:
@@ -686,6 +1309,9 @@ def main():
         
         print("Server has been shut down.")
         sys.exit(0)
+    finally:
+        if message_store is not None:
+            message_store.close()  # Commits whatever is still queued
 
 if __name__ == "__main__":
     main()
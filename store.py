@@ -0,0 +1,188 @@
+# store.py
+import itertools
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# How far a commit goes before it counts as written (SQLite's synchronous setting):
+#   off     handed to the OS; survives the process crashing, not the machine
+#   normal  WAL without an fsync per commit; a power cut may lose the last commits
+#   full    every group commit is fsynced before the next one starts
+DURABILITY_LEVELS = {'off': 'OFF', 'normal': 'NORMAL', 'full': 'FULL'}
+DEFAULT_DURABILITY = 'normal'
+BATCH_SIZE = 1000  # Most rows written in one transaction
+PAGE_SIZE = 500  # Rows per query when iterating a whole channel
+
+class StoreError(Exception):
+    """The store file could not be opened."""
+
+class MessageStore:
+    """Append-only message log in an SQLite file (WAL mode).
+
+    append() only assigns an id and queues the row: a writer thread
+    commits whatever has queued up in one transaction (group commit), so
+    senders never wait on the disk and a busy server writes in large
+    batches. Reads use their own connection and see committed rows;
+    flush() waits until everything appended so far is committed.
+
+    Messages are JSON values filed under a channel name ('chat',
+    'room:general', 'dm:...'); ids increase across the whole store and
+    are the cursors for paging. Startup only reads the newest id, and
+    recent(channel, n) walks the (channel, id) index backwards, so
+    recovering the in-memory window costs n rows, not a replay of the
+    log. One process per file: ids are handed out in memory.
+    """
+
+    def __init__(self, path, durability=DEFAULT_DURABILITY, batch_size=BATCH_SIZE):
+        if durability not in DURABILITY_LEVELS:
+            raise StoreError(f"Unknown durability '{durability}' (use {', '.join(DURABILITY_LEVELS)})")
+        self.path = path
+        self.durability = durability
+        self.batch_size = batch_size
+        self.commits = 0  # Transactions written; only the writer thread updates these
+        self.written = 0  # Rows written
+        self.failed = 0   # Rows lost to write errors
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._reader = self._open()
+            self._reader.execute("CREATE TABLE IF NOT EXISTS messages ("
+                                 "id INTEGER PRIMARY KEY, channel TEXT NOT NULL, "
+                                 "created REAL NOT NULL, body TEXT NOT NULL)")
+            self._reader.execute("CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel, id)")
+            self._reader.commit()
+            last = self._reader.execute("SELECT MAX(id) FROM messages").fetchone()[0]
+        except sqlite3.Error as e:
+            raise StoreError(f"Cannot open message store {path}: {e}")
+        self._read_lock = threading.Lock()
+        self._ids = itertools.count((last or 0) + 1)
+        self._pending = queue.SimpleQueue()  # (id, channel, created, body), threading.Event or None
+        self._writer = threading.Thread(target=self._write_loop, name="store-writer", daemon=True)
+        self._writer.start()
+
+    def _open(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(f"PRAGMA synchronous={DURABILITY_LEVELS[self.durability]}")
+        return db
+
+    def pending(self):
+        """Rows (and flush markers) waiting for the writer."""
+        return self._pending.qsize()
+
+    def append(self, channel, message):
+        """Queue a message for writing; returns its id."""
+        message_id = next(self._ids)
+        self._pending.put((message_id, channel, time.time(), json.dumps(message, ensure_ascii=False)))
+        return message_id
+
+    def _write_loop(self):
+        db = self._open()
+        running = True
+        while running:
+            batch = [self._pending.get()]
+            # Take whatever else is already waiting: one transaction for all of it
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            rows = [item for item in batch if isinstance(item, tuple)]
+            if rows:
+                try:
+                    with db:
+                        db.executemany("INSERT OR REPLACE INTO messages (id, channel, created, body) "
+                                       "VALUES (?, ?, ?, ?)", rows)
+                    self.commits += 1
+                    self.written += len(rows)
+                except sqlite3.Error as e:
+                    self.failed += len(rows)
+                    print(f"[STORE] Could not write {len(rows)} messages to {self.path}: {e}")
+            for item in batch:
+                if item is None:
+                    running = False
+                elif not isinstance(item, tuple):
+                    item.set()  # flush() marker: everything queued before it is committed
+        db.close()
+
+    def flush(self, timeout=None):
+        """Wait until everything appended so far is committed. Returns False on timeout."""
+        if not self._writer.is_alive():
+            return True
+        done = threading.Event()
+        self._pending.put(done)
+        return done.wait(timeout)
+
+    def _rows(self, sql, args):
+        with self._read_lock:
+            return [(message_id, json.loads(body)) for message_id, body in self._reader.execute(sql, args)]
+
+    def recent(self, channel, n):
+        """The newest n (id, message) pairs of a channel, oldest first."""
+        rows = self._rows("SELECT id, body FROM messages WHERE channel = ? ORDER BY id DESC LIMIT ?",
+                          (channel, n))
+        rows.reverse()
+        return rows
+
+    def page(self, channel, before=None, limit=50):
+        """Up to limit (id, message) pairs older than id `before`, oldest first.
+
+        Returns (rows, has_more).
+        """
+        if before is None:
+            rows = self._rows("SELECT id, body FROM messages WHERE channel = ? "
+                              "ORDER BY id DESC LIMIT ?", (channel, limit + 1))
+        else:
+            rows = self._rows("SELECT id, body FROM messages WHERE channel = ? AND id < ? "
+                              "ORDER BY id DESC LIMIT ?", (channel, before, limit + 1))
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        return rows, has_more
+
+    def iter_channel(self, channel, after=0, upto=None):
+        """Yield (id, message) pairs with after < id <= upto, oldest first, a page at a time."""
+        while True:
+            if upto is None:
+                rows = self._rows("SELECT id, body FROM messages WHERE channel = ? AND id > ? "
+                                  "ORDER BY id LIMIT ?", (channel, after, PAGE_SIZE))
+            else:
+                rows = self._rows("SELECT id, body FROM messages WHERE channel = ? AND id > ? AND id <= ? "
+                                  "ORDER BY id LIMIT ?", (channel, after, upto, PAGE_SIZE))
+            yield from rows
+            if len(rows) < PAGE_SIZE:
+                return
+            after = rows[-1][0]
+
+    def last_id(self):
+        """Id of the newest committed row, 0 if there is none."""
+        with self._read_lock:
+            return self._reader.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+
+    def iter_newest(self, n, upto):
+        """Yield (id, channel, created, message) for the newest n rows of every
+        channel together with id <= upto, oldest first, a page at a time."""
+        with self._read_lock:
+            row = self._reader.execute("SELECT id FROM messages WHERE id <= ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                                       (upto, max(n, 1) - 1)).fetchone()
+            after = row[0] - 1 if row is not None else 0
+        while True:
+            with self._read_lock:
+                rows = [(message_id, channel, created, json.loads(body)) for message_id, channel, created, body
+                        in self._reader.execute("SELECT id, channel, created, body FROM messages "
+                                                "WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+                                                (after, upto, PAGE_SIZE))]
+            yield from rows
+            if len(rows) < PAGE_SIZE:
+                return
+            after = rows[-1][0]
+
+    def close(self):
+        """Commit what is queued, stop the writer and close the file."""
+        if self._writer.is_alive():
+            self._pending.put(None)
+            self._writer.join()
+        with self._read_lock:
+            self._reader.close()
@@ -0,0 +1,75 @@
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bus
+import payloads
+import protocol
+
+def deflated_reply():
+    """A 'private_messages' emit as a deflate client gets it: the data is bytes."""
+    messages = [{'id': i, 'sender': 'alice', 'message': f"message {i} " * 20} for i in range(50)]
+    data = payloads.deflate({'with_user': 'bob', 'messages': messages, 'before': None, 'has_more': True}, 0)
+    return {'method': 'emit', 'event': 'private_messages', 'data': data, 'namespace': '/',
+            'room': 'sid-1', 'skip_sid': None, 'callback': None, 'host_id': 'worker-1'}
+
+class RelayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'bus.sock')
+        broker = bus.Broker(self.path)
+        threading.Thread(target=broker.serve_forever, daemon=True).start()
+        for _ in range(100):
+            if os.path.exists(self.path):
+                break
+            time.sleep(0.01)
+        self.broker = broker
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(5)
+        sock.connect(self.path)
+        self.addCleanup(sock.close)
+        return sock
+
+    def subscribe(self):
+        sock = self.connect()
+        sock.sendall(protocol.encode_frame(bus.BUS_SUBSCRIBE, b""))
+        while not self.broker.subscribers:
+            time.sleep(0.01)
+        return sock
+
+    def receive(self, sock):
+        decoder = protocol.FrameDecoder()
+        while decoder.fill(sock):
+            for msg_type, text in decoder:
+                if msg_type == bus.BUS_MESSAGE:
+                    return bus.decode_event(text)
+
+    def test_deflated_reply_is_relayed_as_bytes(self):
+        sent = deflated_reply()
+        subscriber = self.subscribe()
+        self.connect().sendall(protocol.encode_text(bus.encode_event(sent), bus.BUS_PUBLISH))
+        received = self.receive(subscriber)
+        self.assertEqual(received, sent)
+        self.assertEqual(payloads.inflate(received['data']), payloads.inflate(sent['data']))
+
+    @unittest.skipIf(bus.socketio is None, "python-socketio is not installed")
+    def test_broker_manager_relays_deflated_reply(self):
+        sent = deflated_reply()
+        subscriber = self.subscribe()
+        manager = bus.BrokerManager("unix://" + self.path)
+        manager._publish(sent)
+        self.assertEqual(self.receive(subscriber), sent)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dmstore
+import store
+
+class CommittingStore(store.MessageStore):
+    """Commits each row before append() returns: the writer at its fastest."""
+
+    def append(self, channel, message):
+        message_id = super().append(channel, message)
+        self.flush()
+        return message_id
+
+class DMStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = CommittingStore(os.path.join(self.directory.name, 'dm.db'))
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_first_dm_of_a_pair_is_paged_once(self):
+        dms = dmstore.DMStore(self.store)
+        for i in range(20):
+            key = f"alice:user{i}"
+            sent = dms.append(key, {'sender': 'alice', 'message': 'hi'})
+            messages, has_more = dms.page(key)
+            self.assertEqual([message['id'] for message in messages], [sent['id']])
+            self.assertFalse(has_more)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import argparse
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import history
+import server
+import store
+
+class ZeroCapacityTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_segment_files_get_every_record(self):
+        chat = history.ChatHistory(0, os.path.join(self.directory.name, 'history'))
+        for i in range(3):
+            chat.append(f"12:00:0{i}", 'chat', f"alice: {i}")
+        self.assertEqual(len(chat), 0)
+        self.assertEqual(chat.recent(10), [])
+        self.assertEqual([record.content for record in chat.iter_all()], ["alice: 0", "alice: 1", "alice: 2"])
+        chat.close()
+
+    def test_store_gets_every_record_across_restarts(self):
+        path = os.path.join(self.directory.name, 'chat.db')
+        messages = store.MessageStore(path)
+        history.ChatHistory(0, store=messages).append("12:00:00", 'chat', "alice: before")
+        messages.close()
+
+        messages = store.MessageStore(path)
+        chat = history.ChatHistory(0, store=messages)
+        self.assertEqual([record.content for record in chat.iter_all()], ["alice: before"])
+        chat.append("12:00:01", 'chat', "alice: after")
+        self.assertEqual(chat.recent(10), [])
+        self.assertEqual([record.content for record in chat.iter_all()], ["alice: before", "alice: after"])
+        messages.close()
+
+    def test_negative_capacity_is_rejected(self):
+        with self.assertRaises(ValueError):
+            history.ChatHistory(-1)
+        self.assertEqual(server.history_size('0'), 0)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            server.history_size('-1')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,22 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics
+
+class ShardTest(unittest.TestCase):
+    def test_shards_of_exited_threads_are_retired_without_a_snapshot(self):
+        stats = metrics.Metrics()
+        for _ in range(200):
+            thread = threading.Thread(target=stats.inc, args=('connections_total',))
+            thread.start()
+            thread.join()
+        self.assertLessEqual(len(stats._shards), 1)  # Only the newest, until another thread registers
+        counters, _, _ = stats.snapshot()
+        self.assertEqual(counters['connections_total'], 200)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import argparse
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import outbound
+import server
+
+class QueueSizeTest(unittest.TestCase):
+    def test_sizes_below_one_are_rejected(self):
+        for size in (0, -1):
+            for policy in outbound.POLICIES:
+                with self.assertRaises(ValueError):
+                    outbound.OutboundQueue(None, size, policy)
+            with self.assertRaises(argparse.ArgumentTypeError):
+                server.queue_size(str(size))
+        self.assertEqual(server.queue_size('1'), 1)
+
+    def test_size_one_keeps_the_newest_payload(self):
+        queue = outbound.OutboundQueue(None, 1, outbound.DROP_OLDEST)
+        self.assertTrue(queue.put(b"first"))
+        self.assertTrue(queue.put(b"second"))
+        self.assertEqual(list(queue._items), [b"second"])
+        self.assertEqual(queue.dropped, 1)
+
+if __name__ == '__main__':
+    unittest.main()
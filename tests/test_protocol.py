@@ -0,0 +1,62 @@
+import os
+import socket
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import client
+import protocol
+import server
+
+class ClipTest(unittest.TestCase):
+    def test_clip_keeps_whole_characters(self):
+        text = "é" * protocol.MAX_TEXT
+        clipped = protocol.clip(text)
+        self.assertLessEqual(len(clipped.encode('utf-8')), protocol.MAX_TEXT)
+        self.assertTrue(text.startswith(clipped))
+        self.assertEqual(protocol.clip("short"), "short")
+
+    def test_encode_text_never_exceeds_a_frame(self):
+        frame = protocol.encode_text("x" * (70 * 1024))
+        self.assertEqual(len(frame), protocol.HEADER.size + protocol.MAX_PAYLOAD)
+
+class LongLineTest(unittest.TestCase):
+    """A text protocol client's overlong line must not disconnect framed peers."""
+
+    def setUp(self):
+        self.listener = server.serve(server.core, '127.0.0.1', 0)
+        self.port = self.listener.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+
+    def receive_until(self, conn, predicate, timeout=5):
+        deadline = time.time() + timeout
+        conn.settimeout(0.2)
+        while time.time() < deadline:
+            try:
+                lines = conn.dispatch(conn.receive() or [])
+            except socket.timeout:
+                continue
+            if any(predicate(line) for line in lines):
+                return True
+        return False
+
+    def test_70k_line_from_text_client(self):
+        peer = client.connect_to_server('127.0.0.1', self.port, 'framedpeer')
+        self.assertTrue(peer.framed)
+        legacy = socket.create_connection(('127.0.0.1', self.port))
+        legacy.sendall(b'legacy')
+        time.sleep(0.3)
+        legacy.sendall(b'y' * (70 * 1024) + b'\n')
+        self.assertTrue(self.receive_until(peer, lambda line: 'legacy: yyy' in line))
+        legacy.sendall(b'still here\n')
+        self.assertTrue(self.receive_until(peer, lambda line: line.endswith('legacy: still here')))
+        self.assertIsNotNone(server.find_session('framedpeer', exact=True))
+        peer.close()
+        legacy.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bus
+import history
+import searchindex
+import store
+
+class RestartTest(unittest.TestCase):
+    """Messages written before a restart are searchable after it."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'messages.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_finds_messages_from_before_a_restart(self):
+        message_store = store.MessageStore(self.path)
+        chat = history.ChatHistory(store=message_store)
+        chat.append('10:00:00 AM', 'system', 'alice has joined the chat.')
+        chat.append('10:00:01 AM', 'message', 'alice: notes from the routing lecture')
+        local = bus.LocalBus(message_store)
+        local.append_message('sockets', {'room': 'sockets', 'username': 'bob', 'message': 'routing in sockets',
+                                         'timestamp': '10:00:02', 'is_private': False})
+        local.append_dm('carol', 'alice', {'sender': 'carol', 'message': 'secret routing plan',
+                                           'timestamp': '10:00:03', 'is_private': True})
+        message_store.close()
+
+        message_store = store.MessageStore(self.path)  # The restart
+        index = searchindex.SearchIndex(max_docs=1000)
+        searchindex.load_in_background(index, message_store).join()
+        index.add('dave', 'routing after the restart', room='general')
+
+        results, has_more = index.search('alice', 'routing')
+        self.assertFalse(has_more)
+        self.assertEqual([(r['username'], r['room'], r['message']) for r in results], [
+            ('dave', 'general', 'routing after the restart'),
+            ('carol', None, 'secret routing plan'),
+            ('bob', 'sockets', 'routing in sockets'),
+            ('alice', 'general', 'notes from the routing lecture'),
+        ])
+        self.assertEqual(results[1]['to'], 'alice')
+        results, _ = index.search('bob', 'secret')
+        self.assertEqual(results, [])  # Someone else's DM
+        results, _ = index.search('bob', '', sender='alice')
+        self.assertEqual([r['message'] for r in results], ['notes from the routing lecture'])
+        message_store.close()
+        index.close()
+
+    def test_loads_only_the_newest_max_docs(self):
+        message_store = store.MessageStore(self.path)
+        chat = history.ChatHistory(store=message_store)
+        for i in range(50):
+            chat.append('10:00:00 AM', 'message', f'alice: message {i}')
+        message_store.flush()
+        index = searchindex.SearchIndex(max_docs=20, segment_size=8)
+        searchindex.load_in_background(index, message_store).join()
+        results, _ = index.search('alice', 'message', limit=100)
+        self.assertEqual([r['message'] for r in results], [f'message {i}' for i in range(49, 29, -1)])
+        message_store.close()
+        index.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol
+import ratelimit
+import server
+
+class RecordingQueue:
+    def __init__(self):
+        self.payloads = []
+
+    def put(self, payload):
+        self.payloads.append(payload)
+        return True
+
+class ThrottleTest(unittest.TestCase):
+    def setUp(self):
+        self.limiter = server.limiter
+        server.limiter = ratelimit.RateLimiter(ratelimit.parse_limit('0.001/1'))
+        self.state = server.ClientState(object(), ('127.0.0.1', 1), 'alice', protocol.LineDecoder(),
+                                        RecordingQueue())
+
+    def tearDown(self):
+        server.limiter = self.limiter
+
+    def test_back_leaves_dm_mode_while_throttled(self):
+        self.state.dm_recipient = 'bob'
+        self.assertTrue(server.allow_message(self.state))  # Uses up the burst
+        self.assertFalse(server.allow_message(self.state))
+        server.handle_client_text(self.state, '/back')
+        self.assertIsNone(self.state.dm_recipient)
+
+if __name__ == '__main__':
+    unittest.main()